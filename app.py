@@ -5,6 +5,12 @@ from flask import(
 )
 from urllib.parse import unquote, unquote_plus, unquote_to_bytes, quote
 import hashlib
+import io
+import csv
+import zipfile
+import base64
+import bisect
+import gzip
 import sqlite3
 from datetime import datetime, timedelta, timezone
 import os
@@ -14,15 +20,24 @@ from version import __version__
 import secrets
 import json
 import random
-from collections import defaultdict
+import itertools
+from collections import OrderedDict, defaultdict
 import re
+import threading
+import time
 try:
     import requests
 except ImportError:
     requests = None
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+    ImageOps = None
 from werkzeug.exceptions import HTTPException
-from werkzeug.utils import secure_filename
+from xml.sax.saxutils import escape as xml_escape
 import traceback
+from gwars_signatures import SignatureVerifier, SIGN_VARIANTS, SIGN3_VARIANTS
 
 app = Flask(__name__)
 app.secret_key = os.urandom(24)
@@ -112,7 +127,6 @@ LETTER_UPLOAD_RELATIVE = 'uploads/letter_attachments'
 LETTER_UPLOAD_FOLDER = os.path.join(app.static_folder, 'uploads', 'letter_attachments')
 ASSIGNMENT_RECEIPT_RELATIVE = 'uploads/assignment_receipts'
 ASSIGNMENT_RECEIPT_FOLDER = os.path.join(app.static_folder, 'uploads', 'assignment_receipts')
-ALLOWED_LETTER_IMAGE_EXTENSIONS = {'.png', '.jpg', '.jpeg', '.gif', '.webp'}
 os.makedirs(LETTER_UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(ASSIGNMENT_RECEIPT_FOLDER, exist_ok=True)
 
@@ -166,8 +180,9 @@ def log_activity(action, details=None, metadata=None, user_id=None, username=Non
         metadata_json = json.dumps(meta_dict, ensure_ascii=False) if meta_dict else None
         
         conn = get_db_connection()
-        conn.execute('''
-            INSERT INTO activity_logs (user_id, username, action, details, metadata, ip_address)
+        table_name = ensure_activity_log_partition(conn)
+        conn.execute(f'''
+            INSERT INTO {table_name} (user_id, username, action, details, metadata, ip_address)
             VALUES (?, ?, ?, ?, ?, ?)
         ''', (user_id, username, action, details, metadata_json, ip_address))
         conn.commit()
@@ -177,6 +192,339 @@ def log_activity(action, details=None, metadata=None, user_id=None, username=Non
         if conn:
             conn.close()
 
+# ========== Журнал действий: помесячные партиции ==========
+# Новые записи пишутся в таблицы activity_logs_YYYYMM (месяц по UTC, как CURRENT_TIMESTAMP).
+# Старая таблица activity_logs остается источником для чтения, пока cron не перенесет ее записи.
+# id сквозные: последовательность новой партиции продолжает максимальную из предыдущих.
+
+ACTIVITY_LOGS_LEGACY_TABLE = 'activity_logs'
+ACTIVITY_LOG_PARTITION_PREFIX = 'activity_logs_'
+_ACTIVITY_LOG_PARTITION_RE = re.compile(r'^activity_logs_(\d{4})(\d{2})$')
+_known_activity_log_partitions = set()
+_activity_log_partitions_lock = threading.Lock()
+
+
+def get_activity_log_partition_name(moment=None):
+    """Имя партиции журнала для указанного момента (UTC)"""
+    moment = moment or datetime.utcnow()
+    return f"{ACTIVITY_LOG_PARTITION_PREFIX}{moment.strftime('%Y%m')}"
+
+
+def ensure_activity_log_partition(conn, moment=None):
+    """Создает партицию журнала за месяц, если ее еще нет. Возвращает имя таблицы"""
+    table_name = get_activity_log_partition_name(moment)
+    if table_name in _known_activity_log_partitions:
+        return table_name
+    with _activity_log_partitions_lock:
+        exists = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table_name,)
+        ).fetchone()
+        if not exists:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                conn.execute(f'''
+                    CREATE TABLE IF NOT EXISTS {table_name} (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        user_id INTEGER,
+                        username TEXT,
+                        action TEXT NOT NULL,
+                        details TEXT,
+                        metadata TEXT,
+                        ip_address TEXT,
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    )
+                ''')
+                conn.execute(f'CREATE INDEX IF NOT EXISTS idx_{table_name}_created_at ON {table_name}(created_at, id)')
+                conn.execute(f'CREATE INDEX IF NOT EXISTS idx_{table_name}_action ON {table_name}(action, created_at)')
+                conn.execute(f'CREATE INDEX IF NOT EXISTS idx_{table_name}_user ON {table_name}(user_id, created_at)')
+                seeded = conn.execute('SELECT 1 FROM sqlite_sequence WHERE name = ?', (table_name,)).fetchone()
+                if not seeded:
+                    last_id = conn.execute('''
+                        SELECT COALESCE(MAX(seq), 0) FROM sqlite_sequence
+                        WHERE name = 'activity_logs' OR name GLOB 'activity_logs_[0-9]*'
+                    ''').fetchone()[0]
+                    conn.execute('INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)', (table_name, last_id))
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+        _known_activity_log_partitions.add(table_name)
+    return table_name
+
+
+def list_activity_log_partitions(conn):
+    """Список партиций журнала (имя, 'YYYY-MM') от новых к старым"""
+    rows = conn.execute('''
+        SELECT name FROM sqlite_master
+        WHERE type = 'table' AND name GLOB 'activity_logs_[0-9][0-9][0-9][0-9][0-9][0-9]'
+    ''').fetchall()
+    partitions = []
+    for row in rows:
+        match = _ACTIVITY_LOG_PARTITION_RE.match(row[0])
+        if match:
+            partitions.append((row[0], f'{match.group(1)}-{match.group(2)}'))
+    partitions.sort(key=lambda item: item[1], reverse=True)
+    return partitions
+
+
+def get_activity_log_tables(conn):
+    """Все таблицы журнала, включая непустую старую activity_logs"""
+    tables = [name for name, _ in list_activity_log_partitions(conn)]
+    try:
+        if conn.execute(f'SELECT 1 FROM {ACTIVITY_LOGS_LEGACY_TABLE} LIMIT 1').fetchone():
+            tables.append(ACTIVITY_LOGS_LEGACY_TABLE)
+    except sqlite3.OperationalError:
+        pass
+    return tables
+
+
+class ActivityLogRecord:
+    """Запись журнала с ленивым разбором metadata"""
+    __slots__ = ('id', 'user_id', 'username', 'action', 'details', 'ip_address', 'created_at',
+                 '_metadata_raw', '_metadata')
+
+    _NOT_DECODED = object()
+
+    def __init__(self, row):
+        self.id = row['id']
+        self.user_id = row['user_id']
+        self.username = row['username']
+        self.action = row['action']
+        self.details = row['details']
+        self.ip_address = row['ip_address']
+        self.created_at = row['created_at']
+        self._metadata_raw = row['metadata']
+        self._metadata = self._NOT_DECODED
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    @property
+    def metadata(self):
+        if self._metadata is self._NOT_DECODED:
+            value = self._metadata_raw
+            if value:
+                try:
+                    value = json.loads(value)
+                except (json.JSONDecodeError, TypeError):
+                    pass
+            self._metadata = value or None
+        return self._metadata
+
+    def to_dict(self, include_metadata=True):
+        data = {
+            'id': self.id,
+            'user_id': self.user_id,
+            'username': self.username,
+            'action': self.action,
+            'details': self.details,
+            'ip_address': self.ip_address,
+            'created_at': self.created_at,
+        }
+        if include_metadata:
+            data['metadata'] = self.metadata
+        return data
+
+
+_ACTIVITY_LOG_KEY_COLUMNS = ('created_at', 'id')
+_ACTIVITY_LOG_KEY_DESCENDING = (True, True)
+
+
+def query_activity_logs(user_id=None, action_prefix=None, date_from=None, date_to=None,
+                        cursor=None, limit=200):
+    """Страница журнала по всем партициям, от новых записей к старым.
+
+    Фильтры по пользователю, началу названия действия и диапазону дат используют
+    индексы партиций; партиции вне диапазона (и за курсором) не читаются.
+    """
+    cursor_key, direction = decode_page_cursor(cursor, len(_ACTIVITY_LOG_KEY_COLUMNS))
+    backwards = direction == 'prev'
+    keyset_sql, keyset_params, order_sql = build_keyset_sql(
+        _ACTIVITY_LOG_KEY_COLUMNS, _ACTIVITY_LOG_KEY_DESCENDING, cursor_key, backwards
+    )
+
+    where_clauses = []
+    params = []
+    if user_id:
+        where_clauses.append('user_id = ?')
+        params.append(user_id)
+    if action_prefix:
+        # Диапазон по префиксу вместо LIKE '%x%' - использует индекс по action
+        where_clauses.append('action >= ? AND action < ?')
+        params.extend([action_prefix, action_prefix + '\uffff'])
+    if date_from:
+        where_clauses.append('created_at >= ?')
+        params.append(date_from.strftime('%Y-%m-%d %H:%M:%S'))
+    if date_to:
+        where_clauses.append('created_at < ?')
+        params.append(date_to.strftime('%Y-%m-%d %H:%M:%S'))
+    if keyset_sql:
+        where_clauses.append(keyset_sql)
+        params.extend(keyset_params)
+    where_sql = ('WHERE ' + ' AND '.join(where_clauses)) if where_clauses else ''
+
+    month_from = date_from.strftime('%Y-%m') if date_from else None
+    month_to = (date_to - timedelta(seconds=1)).strftime('%Y-%m') if date_to else None
+    cursor_month = str(cursor_key[0])[:7] if cursor_key is not None and cursor_key[0] else None
+
+    conn = get_db_connection()
+    try:
+        partitions = []
+        for name, month in list_activity_log_partitions(conn):
+            if month_from and month < month_from:
+                continue
+            if month_to and month > month_to:
+                continue
+            if cursor_month and ((not backwards and month > cursor_month) or (backwards and month < cursor_month)):
+                continue
+            partitions.append(name)
+        if backwards:
+            partitions.reverse()
+
+        # Партиции не пересекаются по времени: читаем по порядку, пока не наберем страницу
+        wanted = limit + 1
+        rows = []
+        for table_name in partitions:
+            rows.extend(conn.execute(
+                f'SELECT * FROM {table_name} {where_sql} ORDER BY {order_sql} LIMIT ?',
+                params + [wanted - len(rows)]
+            ).fetchall())
+            if len(rows) >= wanted:
+                break
+
+        # Старая таблица может пересекаться с партициями по времени - сливаем отдельно
+        if ACTIVITY_LOGS_LEGACY_TABLE in get_activity_log_tables(conn):
+            legacy_rows = conn.execute(
+                f'SELECT * FROM {ACTIVITY_LOGS_LEGACY_TABLE} {where_sql} ORDER BY {order_sql} LIMIT ?',
+                params + [wanted]
+            ).fetchall()
+            if legacy_rows:
+                rows.extend(legacy_rows)
+                rows.sort(key=lambda row: (str(row['created_at'] or ''), row['id']), reverse=not backwards)
+                rows = rows[:wanted]
+    finally:
+        conn.close()
+
+    records = [ActivityLogRecord(row) for row in rows]
+    return _build_keyset_page(records, _ACTIVITY_LOG_KEY_COLUMNS, limit, cursor_key, direction)
+
+
+def update_activity_logs(conn, set_sql, where_sql, params):
+    """Выполняет UPDATE во всех таблицах журнала (для обезличивания и т.п.)"""
+    updated = 0
+    for table_name in get_activity_log_tables(conn):
+        updated += conn.execute(f'UPDATE {table_name} SET {set_sql} WHERE {where_sql}', params).rowcount
+    return updated
+
+
+def get_activity_log_archive_folder():
+    """Каталог для сжатых архивов старых партиций журнала"""
+    folder = os.path.join(os.path.dirname(get_db_path()), 'archive', 'activity_logs')
+    os.makedirs(folder, exist_ok=True)
+    return folder
+
+
+def archive_activity_log_partitions(keep_months=None):
+    """Выгружает партиции старше keep_months в gzip JSONL и удаляет их из БД"""
+    if keep_months is None:
+        try:
+            keep_months = int(get_setting('activity_logs_keep_months', '3'))
+        except (TypeError, ValueError):
+            keep_months = 3
+    keep_months = max(keep_months, 1)
+    now = datetime.utcnow()
+    month_index = now.year * 12 + (now.month - 1) - (keep_months - 1)
+    oldest_kept = f'{month_index // 12:04d}-{month_index % 12 + 1:02d}'
+
+    archived = []
+    conn = get_db_connection()
+    try:
+        # Пока перенос из старой таблицы не дошел до архивируемых месяцев, не архивируем:
+        # иначе следующий перенос заново создаст уже выгруженную партицию
+        try:
+            pending_legacy = conn.execute(
+                f'SELECT 1 FROM {ACTIVITY_LOGS_LEGACY_TABLE} WHERE created_at < ? LIMIT 1',
+                (f'{oldest_kept}-01',)
+            ).fetchone()
+        except sqlite3.OperationalError:
+            pending_legacy = None
+        if pending_legacy:
+            log_debug("Activity log archiving postponed: legacy rows are still being migrated")
+            return archived
+
+        folder = get_activity_log_archive_folder()
+        for table_name, month in list_activity_log_partitions(conn):
+            if month >= oldest_kept:
+                continue
+            archive_path = os.path.join(folder, f'{table_name}.jsonl.gz')
+            tmp_path = archive_path + '.tmp'
+            written = 0
+            kept = 0
+            with gzip.open(tmp_path, 'wt', encoding='utf-8') as archive_file:
+                # Партиция могла быть уже выгружена раньше - дописываем к прежнему архиву
+                if os.path.exists(archive_path):
+                    with gzip.open(archive_path, 'rt', encoding='utf-8') as previous_file:
+                        for line in previous_file:
+                            archive_file.write(line)
+                            kept += 1
+                for row in conn.execute(f'SELECT * FROM {table_name} ORDER BY id'):
+                    archive_file.write(json.dumps(dict(row), ensure_ascii=False, default=str) + '\n')
+                    written += 1
+            total = conn.execute(f'SELECT COUNT(*) FROM {table_name}').fetchone()[0]
+            if written != total:
+                os.remove(tmp_path)
+                log_error(f"Activity log archive mismatch for {table_name}: {written} != {total}")
+                continue
+            os.replace(tmp_path, archive_path)
+            conn.execute(f'DROP TABLE {table_name}')
+            conn.commit()
+            _known_activity_log_partitions.discard(table_name)
+            archived.append({
+                'partition': table_name, 'rows': written, 'previous_rows': kept,
+                'file': os.path.basename(archive_path)
+            })
+            log_debug(f"Archived activity log partition {table_name}: {written} rows")
+    finally:
+        conn.close()
+    return archived
+
+
+def migrate_legacy_activity_logs(batch_size=1000, max_batches=50):
+    """Переносит записи из старой activity_logs в помесячные партиции порциями"""
+    moved = 0
+    conn = get_db_connection()
+    try:
+        for _ in range(max_batches):
+            rows = conn.execute(f'''
+                SELECT id, user_id, username, action, details, metadata, ip_address, created_at
+                FROM {ACTIVITY_LOGS_LEGACY_TABLE}
+                ORDER BY id
+                LIMIT ?
+            ''', (batch_size,)).fetchall()
+            if not rows:
+                break
+            by_partition = defaultdict(list)
+            for row in rows:
+                moment = parse_event_datetime(row['created_at']) or datetime.utcnow()
+                by_partition[ensure_activity_log_partition(conn, moment)].append(tuple(row))
+            for table_name, values in by_partition.items():
+                conn.executemany(f'''
+                    INSERT OR IGNORE INTO {table_name}
+                    (id, user_id, username, action, details, metadata, ip_address, created_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ''', values)
+            conn.execute(
+                f'DELETE FROM {ACTIVITY_LOGS_LEGACY_TABLE} WHERE id IN ({",".join("?" * len(rows))})',
+                [row['id'] for row in rows]
+            )
+            conn.commit()
+            moved += len(rows)
+    finally:
+        conn.close()
+    if moved:
+        log_debug(f"Moved {moved} legacy activity log rows into monthly partitions")
+    return moved
+
 # Настройка локализации
 app.config['LANGUAGES'] = {
     'ru': 'Русский',
@@ -303,6 +651,63 @@ def get_db_path():
             _db_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'database.db')
     return _db_path
 
+# Учитываемые в рейтинге бубенчики: активные и не отозванные вручную
+def _rating_points_expr(row):
+    return (
+        f"CASE WHEN ({row}.active = 1 OR CAST({row}.active AS INTEGER) = 1) "
+        f"AND ({row}.manual_revoked IS NULL OR {row}.manual_revoked = 0 "
+        f"OR CAST({row}.manual_revoked AS INTEGER) = 0) "
+        f"THEN CAST({row}.points AS REAL) ELSE 0 END"
+    )
+
+
+_RATING_POINTS_SUBQUERY = f'''
+    SELECT COALESCE(SUM({_rating_points_expr('se')}), 0.0)
+    FROM snowflake_events se WHERE se.user_id = users.user_id
+'''
+
+# ROUND гасит накопление ошибки округления при многократных +/- дробных баллов
+_RATING_TRIGGERS = (
+    f'''
+    CREATE TRIGGER IF NOT EXISTS trg_snowflake_events_rating_insert
+    AFTER INSERT ON snowflake_events BEGIN
+        UPDATE users SET rating_points = ROUND(rating_points + {_rating_points_expr('NEW')}, 6)
+        WHERE user_id = NEW.user_id;
+    END
+    ''',
+    f'''
+    CREATE TRIGGER IF NOT EXISTS trg_snowflake_events_rating_update
+    AFTER UPDATE ON snowflake_events BEGIN
+        UPDATE users SET rating_points = ROUND(rating_points - {_rating_points_expr('OLD')}, 6)
+        WHERE user_id = OLD.user_id;
+        UPDATE users SET rating_points = ROUND(rating_points + {_rating_points_expr('NEW')}, 6)
+        WHERE user_id = NEW.user_id;
+    END
+    ''',
+    f'''
+    CREATE TRIGGER IF NOT EXISTS trg_snowflake_events_rating_delete
+    AFTER DELETE ON snowflake_events BEGIN
+        UPDATE users SET rating_points = ROUND(rating_points - {_rating_points_expr('OLD')}, 6)
+        WHERE user_id = OLD.user_id;
+    END
+    ''',
+    # Новый пользователь (в том числе INSERT OR REPLACE) получает уже начисленные ему баллы
+    f'''
+    CREATE TRIGGER IF NOT EXISTS trg_users_rating_insert
+    AFTER INSERT ON users BEGIN
+        UPDATE users SET rating_points = ({_RATING_POINTS_SUBQUERY}), rating_name = NULL
+        WHERE user_id = NEW.user_id;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_users_rating_rename
+    AFTER UPDATE OF username ON users WHEN NEW.username IS NOT OLD.username BEGIN
+        UPDATE users SET rating_name = NULL WHERE user_id = NEW.user_id;
+    END
+    ''',
+)
+
+
 def init_db():
     """Инициализирует базу данных, создавая таблицы если их нет"""
     global _db_initialized
@@ -343,6 +748,30 @@ def init_db():
             # Колонка уже существует, это нормально
             pass
         
+        # Уникальный индекс по avatar_seed: пустые значения сбрасываем в NULL,
+        # повторяющиеся seed (кроме первого владельца) заменяем на новые
+        try:
+            c.execute("UPDATE users SET avatar_seed = NULL WHERE avatar_seed = ''")
+            duplicate_seed_users = c.execute('''
+                SELECT u.user_id FROM users u
+                WHERE u.avatar_seed IS NOT NULL
+                  AND EXISTS (
+                      SELECT 1 FROM users other
+                      WHERE other.avatar_seed = u.avatar_seed AND other.rowid < u.rowid
+                  )
+            ''').fetchall()
+            for row in duplicate_seed_users:
+                c.execute('UPDATE users SET avatar_seed = ? WHERE user_id = ?',
+                          (generate_unique_avatar_seed(row[0]), row[0]))
+            c.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_users_avatar_seed ON users(avatar_seed)')
+        except sqlite3.OperationalError as e:
+            log_error(f"Error creating avatar seed index: {e}")
+        # Порядок списка участников (created_at, user_id) для курсорной пагинации
+        try:
+            c.execute("CREATE INDEX IF NOT EXISTS idx_users_created_order ON users(COALESCE(created_at, ''), user_id)")
+        except sqlite3.OperationalError:
+            pass
+        
         # Добавляем колонку language если её нет (миграция)
         try:
             c.execute('ALTER TABLE users ADD COLUMN language TEXT')
@@ -573,6 +1002,12 @@ def init_db():
             )
         ''')
         
+        try:
+            c.execute('CREATE INDEX IF NOT EXISTS idx_activity_logs_created_at ON activity_logs(created_at, id)')
+            c.execute('CREATE INDEX IF NOT EXISTS idx_activity_logs_user ON activity_logs(user_id, created_at)')
+        except sqlite3.OperationalError:
+            pass
+        
         # Таблица истории рассылок
         c.execute('''
             CREATE TABLE IF NOT EXISTS broadcasts_history (
@@ -625,6 +1060,22 @@ def init_db():
             )
         ''')
         
+        try:
+            c.execute('CREATE INDEX IF NOT EXISTS idx_telegram_users_code_expires ON telegram_users(verified, verification_code_expires_at)')
+            # Поиск подтвержденной привязки по chat_id (get_telegram_chat_user_id) и кода верификации
+            c.execute('''
+                CREATE INDEX IF NOT EXISTS idx_telegram_users_chat
+                ON telegram_users(CAST(telegram_chat_id AS INTEGER), verified_at)
+                WHERE verified = 1
+            ''')
+            c.execute('''
+                CREATE INDEX IF NOT EXISTS idx_telegram_users_code
+                ON telegram_users(verification_code)
+                WHERE verification_code IS NOT NULL
+            ''')
+        except sqlite3.OperationalError:
+            pass
+        
         # Таблица меню бота
         c.execute('''
             CREATE TABLE IF NOT EXISTS telegram_bot_menu (
@@ -698,6 +1149,37 @@ def init_db():
             )
         ''')
         
+        # Даты этапов хранятся как '%Y-%m-%d %H:%M:%S', чтобы их можно было сравнивать
+        # строками по индексам (старые записи могли сохраниться в формате datetime-local)
+        for column in ('start_datetime', 'end_datetime'):
+            c.execute(f'''
+                UPDATE event_stages
+                SET {column} = REPLACE({column}, 'T', ' ') || CASE WHEN LENGTH({column}) = 16 THEN ':00' ELSE '' END
+                WHERE {column} LIKE '____-__-__T__:__%'
+            ''')
+        try:
+            c.execute('CREATE INDEX IF NOT EXISTS idx_event_stages_type_start ON event_stages(stage_type, start_datetime)')
+            c.execute('CREATE INDEX IF NOT EXISTS idx_event_stages_type_end ON event_stages(stage_type, end_datetime)')
+        except sqlite3.OperationalError:
+            pass
+        
+        # Журнал переходов между этапами (см. run_stage_transitions)
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS event_stage_transitions (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                event_id INTEGER NOT NULL,
+                stage_type TEXT NOT NULL,
+                boundary TEXT NOT NULL,
+                due_at TIMESTAMP NOT NULL,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                details TEXT,
+                started_at TIMESTAMP,
+                finished_at TIMESTAMP,
+                UNIQUE(event_id, stage_type, boundary)
+            )
+        ''')
+        
         # Таблица регистраций на мероприятия
         c.execute('''
             CREATE TABLE IF NOT EXISTS event_registrations (
@@ -710,6 +1192,10 @@ def init_db():
                 UNIQUE(event_id, user_id)
             )
         ''')
+        try:
+            c.execute('CREATE INDEX IF NOT EXISTS idx_event_registrations_event_registered ON event_registrations(event_id, registered_at, id)')
+        except sqlite3.OperationalError:
+            pass
 
         # Снапшоты данных участника во время регистрации
         c.execute('''
@@ -835,6 +1321,11 @@ def init_db():
             c.execute('CREATE INDEX IF NOT EXISTS idx_snowflake_events_rating ON snowflake_events(active, manual_revoked, user_id)')
         except sqlite3.OperationalError:
             pass
+        # Бубенчики мероприятия выбираются по source (event:<id>:...)
+        try:
+            c.execute('CREATE INDEX IF NOT EXISTS idx_snowflake_events_source ON snowflake_events(source)')
+        except sqlite3.OperationalError:
+            pass
         try:
             c.execute('ALTER TABLE snowflake_events ADD COLUMN updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP')
         except sqlite3.OperationalError:
@@ -844,6 +1335,26 @@ def init_db():
         except sqlite3.OperationalError:
             pass
         
+        # Итог рейтинга хранится в users.rating_points и поддерживается триггерами на
+        # snowflake_events (записей пишут десятки мест), rating_name - имя для сортировки
+        # (заполняется в Python: LOWER в SQLite не переводит кириллицу в нижний регистр)
+        try:
+            c.execute('ALTER TABLE users ADD COLUMN rating_points REAL NOT NULL DEFAULT 0')
+            c.execute(f'UPDATE users SET rating_points = ({_RATING_POINTS_SUBQUERY})')
+        except sqlite3.OperationalError:
+            pass
+        try:
+            c.execute('ALTER TABLE users ADD COLUMN rating_name TEXT')
+        except sqlite3.OperationalError:
+            pass
+        for trigger_sql in _RATING_TRIGGERS:
+            c.execute(trigger_sql)
+        try:
+            c.execute('CREATE INDEX IF NOT EXISTS idx_users_rating ON users(rating_points DESC, rating_name, user_id)')
+            c.execute('CREATE INDEX IF NOT EXISTS idx_users_rating_name_pending ON users(user_id) WHERE rating_name IS NULL')
+        except sqlite3.OperationalError:
+            pass
+        
         # Таблица утверждений участников (для ревью администратором)
         c.execute('''
             CREATE TABLE IF NOT EXISTS event_participant_approvals (
@@ -915,6 +1426,10 @@ def init_db():
             c.execute('ALTER TABLE event_assignments ADD COLUMN recipient_receipt_image TEXT')
         except sqlite3.OperationalError:
             pass
+        try:
+            c.execute('CREATE INDEX IF NOT EXISTS idx_event_assignments_event_santa ON event_assignments(event_id, santa_user_id)')
+        except sqlite3.OperationalError:
+            pass
 
         # Таблица для хранения сообщений переписки
         c.execute('''
@@ -932,6 +1447,27 @@ def init_db():
             c.execute('ALTER TABLE letter_messages ADD COLUMN attachment_path TEXT')
         except sqlite3.OperationalError:
             pass
+        try:
+            c.execute('CREATE INDEX IF NOT EXISTS idx_letter_messages_assignment ON letter_messages(assignment_id, id)')
+        except sqlite3.OperationalError:
+            pass
+
+        # Сводка переписки по назначению (см. add_letter_message)
+        summary_exists = c.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'letter_chat_summary'"
+        ).fetchone()
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS letter_chat_summary (
+                assignment_id INTEGER PRIMARY KEY,
+                message_count INTEGER NOT NULL DEFAULT 0,
+                last_message_id INTEGER,
+                last_message_at TIMESTAMP,
+                last_sender TEXT,
+                has_santa_message INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+        if not summary_exists:
+            refresh_chat_summary(conn)
         
         # Таблица для архивных чатов (расформированных пар)
         c.execute('''
@@ -951,11 +1487,51 @@ def init_db():
             )
         ''')
         
+        try:
+            c.execute('CREATE INDEX IF NOT EXISTS idx_assignment_chat_history_archived_at ON assignment_chat_history(archived_at)')
+        except sqlite3.OperationalError:
+            pass
+        
         # Добавляем поле is_archived в event_assignments для пометки расформированных пар
         try:
             c.execute('ALTER TABLE event_assignments ADD COLUMN is_archived INTEGER DEFAULT 0')
         except sqlite3.OperationalError:
             pass
+
+        # Текущее назначение пары - единственная неархивная запись (event, santa, recipient).
+        # При первом создании индекса более старые неархивные дубликаты архивируются
+        # (раньше их и так скрывал подзапрос "последнее назначение пары")
+        current_pair_index_exists = c.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'idx_event_assignments_current_pair'"
+        ).fetchone()
+        if not current_pair_index_exists:
+            try:
+                c.execute('''
+                    UPDATE event_assignments SET is_archived = 1
+                    WHERE is_archived = 0
+                      AND EXISTS (
+                          SELECT 1 FROM event_assignments newer
+                          WHERE newer.event_id = event_assignments.event_id
+                            AND newer.santa_user_id = event_assignments.santa_user_id
+                            AND newer.recipient_user_id = event_assignments.recipient_user_id
+                            AND newer.is_archived = 0
+                            AND (COALESCE(newer.assigned_at, '') > COALESCE(event_assignments.assigned_at, '')
+                                 OR (COALESCE(newer.assigned_at, '') = COALESCE(event_assignments.assigned_at, '')
+                                     AND newer.id > event_assignments.id))
+                      )
+                ''')
+                c.execute('''
+                    CREATE UNIQUE INDEX IF NOT EXISTS idx_event_assignments_current_pair
+                    ON event_assignments(event_id, santa_user_id, recipient_user_id)
+                    WHERE is_archived = 0
+                ''')
+            except sqlite3.OperationalError as e:
+                log_error(f"Error creating current assignment index: {e}")
+        try:
+            c.execute('CREATE INDEX IF NOT EXISTS idx_event_assignments_santa_current ON event_assignments(santa_user_id, is_archived, assigned_at)')
+            c.execute('CREATE INDEX IF NOT EXISTS idx_event_assignments_recipient_current ON event_assignments(recipient_user_id, is_archived, assigned_at)')
+        except sqlite3.OperationalError:
+            pass
         
         # Таблица комментариев администраторов к профилям пользователей
         c.execute('''
@@ -1155,6 +1731,93 @@ def init_db():
         except Exception as e:
             log_error(f"Error initializing rating settings: {e}")
         
+        # Контрольные точки периодических задач (для продолжения прерванной очистки)
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS cron_checkpoints (
+                task TEXT PRIMARY KEY,
+                checkpoint TEXT,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+
+        # Аренда запуска cron (одна строка на блокировку, см. cron_tasks.acquire_cron_lease)
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS cron_leases (
+                name TEXT PRIMARY KEY,
+                holder TEXT NOT NULL,
+                expires_at TIMESTAMP NOT NULL
+            )
+        ''')
+
+        # История запусков cron и выполненных в них задач
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS cron_runs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                trigger TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'running',
+                started_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                finished_at TIMESTAMP,
+                duration_ms INTEGER,
+                tasks_count INTEGER DEFAULT 0,
+                rows_count INTEGER DEFAULT 0,
+                deferred TEXT,
+                error TEXT
+            )
+        ''')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_cron_runs_started ON cron_runs(started_at)')
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS cron_run_tasks (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                run_id INTEGER NOT NULL,
+                task TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'running',
+                started_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                duration_ms INTEGER,
+                rows_count INTEGER,
+                finished INTEGER DEFAULT 1,
+                result TEXT,
+                FOREIGN KEY (run_id) REFERENCES cron_runs(id) ON DELETE CASCADE
+            )
+        ''')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_cron_run_tasks_task ON cron_run_tasks(task, id)')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_cron_run_tasks_run ON cron_run_tasks(run_id)')
+
+        # Очередь обезличивания журнала действий удаленных пользователей (обрабатывает cron)
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS user_log_anonymization_queue (
+                user_id INTEGER PRIMARY KEY,
+                deleted_before TIMESTAMP NOT NULL,
+                requested_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
+        # Очередь уведомлений участникам (рассылает cron, см. dispatch_notifications)
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS notification_outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                recipient_user_id INTEGER NOT NULL,
+                kind TEXT NOT NULL,
+                assignment_id INTEGER,
+                sender TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                last_error TEXT,
+                status TEXT,
+                dispatched_at TIMESTAMP
+            )
+        ''')
+        try:
+            c.execute('CREATE INDEX IF NOT EXISTS idx_notification_outbox_pending ON notification_outbox(dispatched_at, recipient_user_id, created_at)')
+        except sqlite3.OperationalError:
+            pass
+        
+        # Индексы по колонкам-ссылкам на пользователей: удаление не просматривает таблицы целиком
+        for table_name, column in USER_REFERENCE_COLUMNS:
+            try:
+                c.execute(f'CREATE INDEX IF NOT EXISTS idx_{table_name}_{column} ON {table_name}({column})')
+            except sqlite3.OperationalError:
+                pass
+        
         # Создаем системные роли, если их еще нет
         system_roles = [
             ('admin', 'Администратор', 'Полный доступ ко всем функциям системы', 1),
@@ -1205,43 +1868,217 @@ def generate_unique_avatar_seed(user_id):
     seed = f"{user_id}_{random_part}"
     return seed
 
-def get_used_avatar_seeds(exclude_user_id=None):
-    """Получает список всех используемых avatar_seed в системе"""
-    conn = get_db_connection()
-    if exclude_user_id:
-        used_seeds = conn.execute(
-            'SELECT avatar_seed FROM users WHERE avatar_seed IS NOT NULL AND user_id != ?',
-            (exclude_user_id,)
-        ).fetchall()
-    else:
-        used_seeds = conn.execute(
-            'SELECT avatar_seed FROM users WHERE avatar_seed IS NOT NULL'
+def get_used_avatar_seeds(seeds, exclude_user_id=None, conn=None):
+    """Возвращает те seed из переданных, которые уже заняты (поиск по уникальному индексу)"""
+    seeds = [seed for seed in dict.fromkeys(seeds) if seed]
+    if not seeds:
+        return set()
+    own_conn = conn is None
+    if own_conn:
+        conn = get_db_connection()
+    try:
+        placeholders = ','.join('?' * len(seeds))
+        rows = conn.execute(
+            f'SELECT avatar_seed FROM users WHERE avatar_seed IN ({placeholders}) AND user_id != ?',
+            seeds + [exclude_user_id if exclude_user_id is not None else -1]
         ).fetchall()
-    conn.close()
-    return set(seed['avatar_seed'] for seed in used_seeds if seed['avatar_seed'])
+        return {row['avatar_seed'] for row in rows}
+    finally:
+        if own_conn:
+            conn.close()
+
+def avatar_seed_in_use(seed, exclude_user_id=None, conn=None):
+    """Проверяет, занят ли seed другим пользователем"""
+    return bool(seed) and seed in get_used_avatar_seeds([seed], exclude_user_id, conn)
+
+def reserve_avatar_seed(conn, user_id, seed, style):
+    """Атомарно закрепляет seed за пользователем в транзакции вызывающего (без commit).
+
+    Уникальность обеспечивает индекс idx_users_avatar_seed: если seed успели занять,
+    возвращается False и данные пользователя не меняются - SQLite откатывает только
+    неудавшийся UPDATE, открытая транзакция продолжается. Изменение остается
+    незафиксированным: его сохраняет commit() вызывающего, а rollback() отменяет.
+    """
+    try:
+        conn.execute(
+            'UPDATE users SET avatar_seed = ?, avatar_style = ? WHERE user_id = ?',
+            (seed, style, user_id)
+        )
+        return True
+    except sqlite3.IntegrityError:
+        return False
 
 def generate_unique_avatar_candidates(style, count=20, exclude_user_id=None):
     """Генерирует список уникальных кандидатов аватаров для выбранного стиля"""
-    used_seeds = get_used_avatar_seeds(exclude_user_id)
     candidates = []
-    attempts = 0
-    max_attempts = count * 10  # Лимит попыток
-    
-    while len(candidates) < count and attempts < max_attempts:
-        seed = secrets.token_hex(12)  # Генерируем случайный seed
-        if seed not in used_seeds and seed not in candidates:
-            candidates.append(seed)
-        attempts += 1
-    
-    return candidates
+    conn = get_db_connection()
+    try:
+        for _ in range(5):  # Коллизии 96-битных seed практически невозможны
+            needed = count - len(candidates)
+            if needed <= 0:
+                break
+            fresh = [secrets.token_hex(12) for _ in range(needed)]
+            used = get_used_avatar_seeds(fresh, exclude_user_id, conn)
+            candidates.extend(seed for seed in fresh if seed not in used and seed not in candidates)
+    finally:
+        conn.close()
+    return candidates[:count]
+
+# ========== Аватары: локальная отрисовка и кэш ==========
+# Все аватары отдаются с нашего маршрута /avatars/<style>/<size>/<seed>.svg.
+# identicon и initials рисуются в процессе; остальные стили DiceBear загружаются
+# с их API только для seed, сохраненных в users.avatar_seed: такой SVG загружается
+# один раз и дальше отдается с диска, для чужих seed - временный identicon без кэша.
+# Размеры - только из AVATAR_SIZES, так что маршрут не становится прокси и не растит
+# кэш произвольными ключами. Варианты для выбора аватара (еще не сохраненные seed)
+# браузер получает напрямую с DiceBear. Настройка avatar_remote_fallback = 0
+# отключает обращения к DiceBear: все стили заменяются identicon.
+
+DICEBEAR_AVATAR_STYLES = (
+    'adventurer', 'adventurer-neutral', 'avataaars', 'avataaars-neutral',
+    'big-ears', 'big-ears-neutral', 'big-smile', 'bottts', 'bottts-neutral',
+    'croodles', 'croodles-neutral', 'fun-emoji', 'icons', 'identicon', 'initials',
+    'lorelei', 'lorelei-neutral', 'micah', 'miniavs', 'open-peeps', 'personas',
+    'pixel-art', 'pixel-art-neutral', 'rings', 'shapes', 'thumbs'
+)
+LOCAL_AVATAR_STYLES = ('identicon', 'initials')
+AVATAR_SIZES = (32, 40, 64, 80, 128, 256)
+AVATAR_SEED_MAX_LENGTH = 200
+AVATAR_CACHE_MAX_AGE = 365 * 24 * 3600
+DICEBEAR_AVATAR_URL = 'https://api.dicebear.com/7.x/{style}/svg'
+
+
+def _avatar_color(digest, saturation, lightness):
+    return f"hsl({int(digest[:4], 16) % 360}, {saturation}%, {lightness}%)"
+
+
+def render_identicon_svg(seed, size):
+    """Симметричный узор 5x5, цвет и клетки берутся из хэша seed"""
+    digest = hashlib.sha256(seed.encode('utf-8')).hexdigest()
+    bits = int(digest[4:20], 16)
+    cells = []
+    for row in range(5):
+        for col in range(3):
+            if bits >> (row * 3 + col) & 1:
+                cells.append((col, row))
+                if col < 2:
+                    cells.append((4 - col, row))
+    rects = ''.join(f'<rect x="{x}" y="{y}" width="1" height="1"/>' for x, y in cells)
+    return (
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{size}" height="{size}" viewBox="-0.5 -0.5 6 6" '
+        f'shape-rendering="crispEdges"><rect x="-0.5" y="-0.5" width="6" height="6" fill="#f0f0f0"/>'
+        f'<g fill="{_avatar_color(digest, 60, 48)}">{rects}</g></svg>'
+    )
+
+
+def render_initials_svg(seed, size):
+    """Две первые буквы/цифры seed на цветном фоне"""
+    digest = hashlib.sha256(seed.encode('utf-8')).hexdigest()
+    initials = re.sub(r'[^0-9A-Za-zА-Яа-яЁё]', '', seed)[:2].upper() or '?'
+    return (
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{size}" height="{size}" viewBox="0 0 100 100">'
+        f'<rect width="100" height="100" fill="{_avatar_color(digest, 55, 45)}"/>'
+        f'<text x="50" y="50" dy="0.35em" text-anchor="middle" font-family="Arial, sans-serif" '
+        f'font-size="42" font-weight="600" fill="#ffffff">{initials}</text></svg>'
+    )
+
+
+def get_avatar_cache_folder():
+    """Каталог дискового кэша аватаров (рядом с базой данных)"""
+    return os.path.join(os.path.dirname(get_db_path()), 'cache', 'avatars')
+
+
+def _avatar_cache_path(style, seed, size):
+    key = hashlib.sha1(f"{style}\n{seed}\n{size}".encode('utf-8')).hexdigest()
+    return os.path.join(get_avatar_cache_folder(), style, key[:2], f"{key}.svg")
+
+
+def avatar_remote_enabled():
+    return requests is not None and get_setting('avatar_remote_fallback', '1') == '1'
+
+
+def _is_known_avatar_seed(seed):
+    conn = get_db_connection()
+    try:
+        return conn.execute('SELECT 1 FROM users WHERE avatar_seed = ? LIMIT 1', (seed,)).fetchone() is not None
+    finally:
+        conn.close()
+
+
+def _fetch_remote_avatar(style, seed, size):
+    """Загружает SVG с DiceBear (None - недоступно)"""
+    try:
+        response = requests.get(
+            DICEBEAR_AVATAR_URL.format(style=style),
+            params={'seed': seed, 'size': size},
+            timeout=5
+        )
+        content = response.content
+        if response.status_code == 200 and b'<svg' in content[:512]:
+            return content
+        log_error(f"DiceBear returned {response.status_code} for avatar style {style}")
+    except Exception as e:
+        log_error(f"Error fetching avatar from DiceBear: {e}")
+    return None
+
+
+def get_avatar_svg(style, seed, size):
+    """Возвращает (SVG в байтах, можно ли кэшировать навсегда)"""
+    if style == 'initials':
+        return render_initials_svg(seed, size).encode('utf-8'), True
+    if style == 'identicon':
+        return render_identicon_svg(seed, size).encode('utf-8'), True
+
+    cache_path = _avatar_cache_path(style, seed, size)
+    try:
+        with open(cache_path, 'rb') as f:
+            return f.read(), True
+    except OSError:
+        pass
+
+    svg = None
+    if avatar_remote_enabled() and _is_known_avatar_seed(seed):
+        svg = _fetch_remote_avatar(style, seed, size)
+    if svg is None:
+        # Временная замена: не кэшируем, чтобы позже получить настоящий стиль
+        return render_identicon_svg(seed, size).encode('utf-8'), False
+
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        _write_file_atomic(cache_path, svg)
+    except OSError as e:
+        log_error(f"Error caching avatar {style}/{size}: {e}")
+    return svg, True
+
 
 def get_avatar_url(avatar_seed, style=None, size=128):
-    """Генерирует URL аватара DiceBear"""
+    """Генерирует URL аватара (локальный маршрут с кэшем)"""
     if not avatar_seed:
         return None
-    if style is None:
+    if style is None or style not in DICEBEAR_AVATAR_STYLES:
         style = 'avataaars'  # Стиль по умолчанию
-    return f"https://api.dicebear.com/7.x/{style}/svg?seed={avatar_seed}&size={size}"
+    return url_for('avatar_image', style=style, size=_avatar_size(size), seed=str(avatar_seed))
+
+
+def _avatar_size(size):
+    """Ближайший допустимый размер не меньше запрошенного"""
+    try:
+        size = int(size)
+    except (TypeError, ValueError):
+        return 128
+    return next((allowed for allowed in AVATAR_SIZES if allowed >= size), AVATAR_SIZES[-1])
+
+
+def get_avatar_preview_url(avatar_seed, style=None, size=128):
+    """URL варианта аватара при выборе стиля: seed еще не сохранен, поэтому
+    при включенной загрузке DiceBear браузер берет его напрямую, не через наш кэш"""
+    if (avatar_seed and style in DICEBEAR_AVATAR_STYLES and style not in LOCAL_AVATAR_STYLES
+            and avatar_remote_enabled()):
+        return requests.Request(
+            'GET', DICEBEAR_AVATAR_URL.format(style=style),
+            params={'seed': str(avatar_seed), 'size': _avatar_size(size)}
+        ).prepare().url
+    return get_avatar_url(avatar_seed, style, size)
 
 def get_user_avatar_url(user, size=128):
     """Получает URL аватара пользователя с учетом его стиля"""
@@ -1261,6 +2098,356 @@ def get_db_connection():
     conn.row_factory = sqlite3.Row
     return conn
 
+# ========== Справочник пользователей (кэш в памяти) ==========
+
+# Биты доступности контактов
+CONTACT_EMAIL = 1
+CONTACT_TELEGRAM = 2
+CONTACT_PHONE = 4
+CONTACT_WHATSAPP = 8
+CONTACT_VIBER = 16
+
+# Полная пересборка раз в N секунд подхватывает изменения из других процессов
+USER_DIRECTORY_TTL_SECONDS = 300
+
+_user_directory = {}
+_user_directory_built_at = None
+_user_directory_lock = threading.RLock()
+
+_USER_DIRECTORY_COLUMNS = '''
+    u.user_id, u.username, u.level, u.synd, u.created_at, u.last_login,
+    u.avatar_seed, u.avatar_style, COALESCE(u.is_blocked, 0) AS is_blocked,
+    u.email, u.telegram, u.phone, u.whatsapp, u.viber,
+    u.first_name, u.last_name, u.city, u.country
+'''
+
+
+class UserDirectoryEntry:
+    """Запись справочника пользователей"""
+    __slots__ = (
+        'user_id', 'username', 'level', 'synd', 'created_at', 'last_login',
+        'avatar_seed', 'avatar_style', 'is_blocked', 'contact_flags',
+        'email', 'telegram', 'phone', 'first_name', 'last_name', 'city', 'country',
+        'role_ids', 'role_names', 'role_titles', 'comments_count', 'search_text'
+    )
+
+    def __init__(self, row, roles=(), comments_count=0):
+        self.user_id = row['user_id']
+        self.username = row['username']
+        self.level = row['level']
+        self.synd = row['synd']
+        self.created_at = row['created_at']
+        self.last_login = row['last_login']
+        self.avatar_seed = row['avatar_seed']
+        self.avatar_style = row['avatar_style']
+        self.is_blocked = 1 if row['is_blocked'] else 0
+        self.email = row['email']
+        self.telegram = row['telegram']
+        self.phone = row['phone']
+        self.first_name = row['first_name']
+        self.last_name = row['last_name']
+        self.city = row['city']
+        self.country = row['country']
+        flags = 0
+        for bit, column in ((CONTACT_EMAIL, 'email'), (CONTACT_TELEGRAM, 'telegram'),
+                            (CONTACT_PHONE, 'phone'), (CONTACT_WHATSAPP, 'whatsapp'),
+                            (CONTACT_VIBER, 'viber')):
+            if row[column] and str(row[column]).strip():
+                flags |= bit
+        self.contact_flags = flags
+        self.role_ids = tuple(role[0] for role in roles)
+        self.role_names = tuple(role[1] for role in roles)
+        self.role_titles = tuple(role[2] for role in roles if role[2])
+        self.comments_count = comments_count
+        self.search_text = ' '.join((
+            (self.username or '').lower(),
+            str(self.user_id),
+            self.roles.lower()
+        ))
+
+    @property
+    def roles(self):
+        """Отображаемые названия ролей через запятую (как GROUP_CONCAT)"""
+        return ', '.join(self.role_titles)
+
+    def has_contact(self, bit):
+        return bool(self.contact_flags & bit)
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__ if name != 'search_text'}
+
+
+def _load_user_directory_entries(conn, user_ids=None):
+    """Загружает записи справочника из БД (всех или указанных пользователей)"""
+    where_users = ''
+    where_roles = ''
+    where_comments = ''
+    params = []
+    if user_ids is not None:
+        placeholders = ','.join(['?'] * len(user_ids))
+        where_users = f'WHERE u.user_id IN ({placeholders})'
+        where_roles = f'WHERE ur.user_id IN ({placeholders})'
+        where_comments = f'WHERE user_id IN ({placeholders})'
+        params = list(user_ids)
+
+    roles_by_user = defaultdict(list)
+    for row in conn.execute(f'''
+        SELECT ur.user_id, r.id, r.name, r.display_name
+        FROM user_roles ur
+        JOIN roles r ON ur.role_id = r.id
+        {where_roles}
+        ORDER BY ur.user_id, r.id
+    ''', params):
+        roles_by_user[row[0]].append((row[1], row[2], row[3]))
+
+    comments_by_user = {
+        row[0]: row[1]
+        for row in conn.execute(f'''
+            SELECT user_id, COUNT(*) FROM user_admin_comments
+            {where_comments}
+            GROUP BY user_id
+        ''', params)
+    }
+
+    entries = {}
+    for row in conn.execute(f'SELECT {_USER_DIRECTORY_COLUMNS} FROM users u {where_users}', params):
+        user_id = row['user_id']
+        entries[user_id] = UserDirectoryEntry(
+            row,
+            roles_by_user.get(user_id, ()),
+            comments_by_user.get(user_id, 0)
+        )
+    return entries
+
+
+def _ensure_user_directory():
+    """Строит справочник при первом обращении или по истечении TTL"""
+    global _user_directory, _user_directory_built_at
+    with _user_directory_lock:
+        now = datetime.now()
+        if (_user_directory_built_at is not None
+                and (now - _user_directory_built_at).total_seconds() < USER_DIRECTORY_TTL_SECONDS):
+            return _user_directory
+        conn = get_db_connection()
+        try:
+            _user_directory = _load_user_directory_entries(conn)
+            _user_directory_built_at = now
+            log_debug(f"User directory built: {len(_user_directory)} users")
+        finally:
+            conn.close()
+        return _user_directory
+
+
+def invalidate_user_directory():
+    """Сбрасывает справочник целиком (например, после переименования роли)"""
+    global _user_directory_built_at
+    with _user_directory_lock:
+        _user_directory_built_at = None
+
+
+def refresh_user_directory_entry(*user_ids):
+    """Точечно обновляет записи справочника после изменения пользователей или их ролей"""
+    user_ids = [int(uid) for uid in user_ids if uid is not None]
+    if not user_ids:
+        return
+    with _user_directory_lock:
+        if _user_directory_built_at is None:
+            return  # Справочник еще не построен - соберется при первом обращении
+        try:
+            conn = get_db_connection()
+            try:
+                entries = _load_user_directory_entries(conn, user_ids)
+            finally:
+                conn.close()
+        except Exception as e:
+            log_error(f"Error refreshing user directory for {user_ids}: {e}")
+            invalidate_user_directory()
+            return
+        for user_id in user_ids:
+            if user_id in entries:
+                _user_directory[user_id] = entries[user_id]
+            else:
+                _user_directory.pop(user_id, None)
+
+
+def get_user_directory_entry(user_id):
+    """Возвращает запись справочника для пользователя или None"""
+    try:
+        return _ensure_user_directory().get(int(user_id))
+    except (TypeError, ValueError):
+        return None
+
+
+def query_user_directory(search=None, user_ids=None, contact=None, exclude_blocked=False,
+                         role_name=None, sort_by='created_at', descending=False, fresh=False):
+    """Фильтрует и сортирует справочник пользователей.
+
+    fresh=True читает записи прямо из БД, минуя кэш процесса: справочник в другом
+    воркере может отставать до USER_DIRECTORY_TTL_SECONDS, поэтому все, что
+    отправляет сообщения или проверяет блокировку, должно брать свежие данные.
+    """
+    wanted = None
+    if user_ids is not None:
+        wanted = set()
+        for uid in user_ids:
+            try:
+                wanted.add(int(uid))
+            except (TypeError, ValueError):
+                continue
+
+    if fresh:
+        if wanted is not None and not wanted:
+            return []
+        conn = get_db_connection()
+        try:
+            entries = list(_load_user_directory_entries(
+                conn, sorted(wanted) if wanted is not None else None
+            ).values())
+        finally:
+            conn.close()
+    else:
+        with _user_directory_lock:
+            entries = list(_ensure_user_directory().values())
+        if wanted is not None:
+            entries = [entry for entry in entries if entry.user_id in wanted]
+    if search:
+        needle = search.lower()
+        entries = [entry for entry in entries if needle in entry.search_text]
+    if contact:
+        entries = [entry for entry in entries if entry.contact_flags & contact]
+    if exclude_blocked:
+        entries = [entry for entry in entries if not entry.is_blocked]
+    if role_name:
+        entries = [entry for entry in entries if role_name in entry.role_names]
+
+    if sort_by == 'username':
+        key = lambda entry: ((entry.username or '').lower(), entry.user_id)
+    else:
+        key = lambda entry: (str(getattr(entry, sort_by) or ''), entry.user_id)
+    entries.sort(key=key, reverse=descending)
+    return entries
+
+
+def paginate_user_directory(entries, page, per_page):
+    """Возвращает срез страницы и общее количество записей"""
+    page = max(page, 1)
+    offset = (page - 1) * per_page
+    return entries[offset:offset + per_page], len(entries)
+
+
+def get_user_directory_role_counts():
+    """Количество пользователей по каждой роли (ключ - id роли)"""
+    counts = defaultdict(int)
+    with _user_directory_lock:
+        for entry in _ensure_user_directory().values():
+            for role_id in entry.role_ids:
+                counts[role_id] += 1
+    return counts
+
+# ========== Курсорная пагинация ==========
+
+def encode_page_cursor(key_values, direction='next'):
+    """Кодирует ключ сортировки в непрозрачный токен для query string"""
+    payload = json.dumps({'k': list(key_values), 'd': direction}, ensure_ascii=False, separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_page_cursor(token, key_size):
+    """Декодирует токен курсора. Возвращает (ключ, направление) или (None, 'next')"""
+    if not token:
+        return None, 'next'
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')).decode('utf-8'))
+        key_values = payload['k']
+        direction = payload.get('d', 'next')
+        if not isinstance(key_values, list) or len(key_values) != key_size or direction not in ('next', 'prev'):
+            raise ValueError('bad cursor shape')
+        return tuple(key_values), direction
+    except (ValueError, KeyError, TypeError, UnicodeDecodeError, json.JSONDecodeError) as e:
+        log_debug(f"Invalid page cursor {token!r}: {e}")
+        return None, 'next'
+
+
+def _build_keyset_page(rows, key_columns, per_page, cursor_key, direction, get_key=None):
+    """Формирует страницу и соседние курсоры из выборки размером per_page + 1"""
+    if get_key is None:
+        get_key = lambda row: tuple(row[column] for column in key_columns)
+    has_more = len(rows) > per_page
+    rows = list(rows[:per_page])
+    if direction == 'prev':
+        rows.reverse()
+        has_prev = has_more
+        has_next = cursor_key is not None
+    else:
+        has_prev = cursor_key is not None
+        has_next = has_more
+    return {
+        'items': rows,
+        'has_prev': has_prev,
+        'has_next': has_next,
+        'prev_cursor': encode_page_cursor(get_key(rows[0]), 'prev') if has_prev and rows else None,
+        'next_cursor': encode_page_cursor(get_key(rows[-1]), 'next') if has_next and rows else None,
+    }
+
+
+def build_keyset_sql(key_columns, descending, cursor_key, backwards=False):
+    """Возвращает (условие, параметры, ORDER BY) для выборки страницы после/перед cursor_key"""
+    condition_sql = ''
+    condition_params = []
+    if cursor_key is not None:
+        clauses = []
+        for i, column in enumerate(key_columns):
+            parts = [f'{key_columns[j]} = ?' for j in range(i)]
+            forward_desc = descending[i] != backwards
+            parts.append(f'{column} {"<" if forward_desc else ">"} ?')
+            clauses.append('(' + ' AND '.join(parts) + ')')
+            condition_params.extend(cursor_key[:i + 1])
+        # Диапазон по первой колонке дает SQLite начать поиск по индексу с курсора,
+        # а не собирать OR-ветки целиком и сортировать их
+        first_desc = descending[0] != backwards
+        condition_sql = f'{key_columns[0]} {"<=" if first_desc else ">="} ? AND (' + ' OR '.join(clauses) + ')'
+        condition_params.insert(0, cursor_key[0])
+    order_sql = ', '.join(
+        f'{column} {"DESC" if desc != backwards else "ASC"}'
+        for column, desc in zip(key_columns, descending)
+    )
+    return condition_sql, condition_params, order_sql
+
+
+def fetch_keyset_page(conn, base_query, params, key_columns, descending, cursor, per_page):
+    """Выбирает страницу по составному ключу сортировки без OFFSET.
+
+    key_columns - имена колонок результата base_query, descending - направление
+    сортировки для каждой из них. Последняя колонка должна быть уникальной.
+    """
+    cursor_key, direction = decode_page_cursor(cursor, len(key_columns))
+    condition_sql, condition_params, order_sql = build_keyset_sql(
+        key_columns, descending, cursor_key, direction == 'prev'
+    )
+    where_sql = f'WHERE {condition_sql}' if condition_sql else ''
+    rows = conn.execute(
+        f'SELECT * FROM ({base_query}) AS keyset_src {where_sql} ORDER BY {order_sql} LIMIT ?',
+        list(params) + condition_params + [per_page + 1]
+    ).fetchall()
+    return _build_keyset_page(rows, key_columns, per_page, cursor_key, direction)
+
+
+def keyset_slice(items, get_key, cursor, per_page):
+    """Курсорная пагинация по уже отсортированному (по возрастанию get_key) списку в памяти"""
+    cursor_key, direction = decode_page_cursor(cursor, len(get_key(items[0])) if items else 0)
+    if cursor_key is None:
+        rows = items[:per_page + 1]
+    else:
+        keys = [tuple(get_key(item)) for item in items]
+        if direction == 'prev':
+            end = bisect.bisect_left(keys, cursor_key)
+            rows = list(reversed(items[max(0, end - per_page - 1):end]))
+        else:
+            start = bisect.bisect_right(keys, cursor_key)
+            rows = items[start:start + per_page + 1]
+    return _build_keyset_page(rows, None, per_page, cursor_key, direction, get_key=lambda item: tuple(get_key(item)))
+
 # ========== Система ролей и прав доступа ==========
 
 def get_user_roles(user_id):
@@ -1313,6 +2500,7 @@ def assign_role(user_id, role_name, assigned_by=None):
             VALUES (?, ?, ?)
         ''', (user_id, role['id'], assigned_by))
         conn.commit()
+        refresh_user_directory_entry(user_id)
         log_activity(
             'role_assign',
             details=f'Назначена роль {role_name} пользователю {user_id}',
@@ -1340,6 +2528,7 @@ def remove_role(user_id, role_name):
             WHERE user_id = ? AND role_id = ?
         ''', (user_id, role['id']))
         conn.commit()
+        refresh_user_directory_entry(user_id)
         log_activity(
             'role_remove',
             details=f'Удалена роль {role_name} у пользователя {user_id}',
@@ -1665,6 +2854,7 @@ def add_user_admin_comment(user_id, admin_user_id, comment, is_admin_only=False)
             VALUES (?, ?, ?, ?)
         ''', (user_id, admin_user_id, comment.strip(), 1 if is_admin_only else 0))
         conn.commit()
+        refresh_user_directory_entry(user_id)
         log_activity(
             'admin_comment_add',
             details=f'Добавлен комментарий к профилю пользователя {user_id}',
@@ -1705,6 +2895,7 @@ def add_thanks_comment_from_recipient(user_id, assignment_id, thanks_message):
         
         conn.commit()
         conn.close()
+        refresh_user_directory_entry(user_id)
         return True
     except Exception as e:
         log_error(f"Error adding thanks comment: {e}")
@@ -1758,6 +2949,7 @@ def delete_user_admin_comment(comment_id, admin_user_id):
         target_user_id = existing['user_id']
         conn.execute('DELETE FROM user_admin_comments WHERE id = ?', (comment_id,))
         conn.commit()
+        refresh_user_directory_entry(target_user_id)
         log_activity(
             'admin_comment_delete',
             details=f'Удален комментарий {comment_id} к профилю пользователя {target_user_id}',
@@ -1894,6 +3086,241 @@ def remove_award(user_id, award_id):
         conn.close()
         return False
 
+# ========== Массовые операции с пользователями ==========
+# Роль, звание, награда или блокировка применяются к списку пользователей одной
+# транзакцией: назначения пишутся через INSERT ... SELECT ... WHERE NOT EXISTS,
+# бубенчики за звание/награду - одним executemany с ON CONFLICT, в журнал
+# попадает одна сводная запись вместо записи на каждого пользователя.
+
+BULK_USER_OPERATIONS = ('assign_role', 'assign_title', 'assign_award', 'block', 'unblock')
+BULK_USER_CHUNK_SIZE = 500
+
+# Назначения, которые хранятся в таблицах связей user_id + <column>
+_BULK_ASSIGNMENT_SPECS = {
+    'assign_role': {'table': 'user_roles', 'column': 'role_id'},
+    'assign_title': {
+        'table': 'user_titles', 'column': 'title_id',
+        'source': 'title:{id}', 'reason': 'Назначено звание (ID: {id})', 'rating_key': 'rating_title_{id}'
+    },
+    'assign_award': {
+        'table': 'user_awards', 'column': 'award_id',
+        'source': 'award:{id}', 'reason': 'Назначена награда (ID: {id})', 'rating_key': 'rating_award_{id}'
+    },
+}
+
+
+def _unique_user_ids(user_ids):
+    result = []
+    seen = set()
+    for user_id in user_ids or ():
+        try:
+            user_id = int(user_id)
+        except (TypeError, ValueError):
+            continue
+        if user_id not in seen:
+            seen.add(user_id)
+            result.append(user_id)
+    return result
+
+
+def _resolve_bulk_target(conn, operation, target):
+    """id роли/звания/награды для операции или None, если объект не найден"""
+    if operation == 'assign_role':
+        row = conn.execute('SELECT id FROM roles WHERE name = ?', (target,)).fetchone()
+        return row['id'] if row else None
+    table = 'titles' if operation == 'assign_title' else 'awards'
+    try:
+        target_id = int(target)
+    except (TypeError, ValueError):
+        return None
+    row = conn.execute(f'SELECT id FROM {table} WHERE id = ?', (target_id,)).fetchone()
+    return row['id'] if row else None
+
+
+def _apply_bulk_assignment(conn, operation, target_id, user_ids, actor_id, result):
+    spec = _BULK_ASSIGNMENT_SPECS[operation]
+    table, column = spec['table'], spec['column']
+    # Настройка рейтинга читается один раз на всю операцию
+    points = get_rating_setting(spec['rating_key'].format(id=target_id), 0) if 'rating_key' in spec else 0
+    for start in range(0, len(user_ids), BULK_USER_CHUNK_SIZE):
+        chunk = user_ids[start:start + BULK_USER_CHUNK_SIZE]
+        placeholders = ','.join(['?'] * len(chunk))
+        rows = conn.execute(f'''
+            SELECT u.user_id,
+                   EXISTS(SELECT 1 FROM {table} t WHERE t.user_id = u.user_id AND t.{column} = ?) AS assigned
+            FROM users u
+            WHERE u.user_id IN ({placeholders})
+        ''', [target_id] + chunk).fetchall()
+        state = {row['user_id']: row['assigned'] for row in rows}
+        for user_id in chunk:
+            if user_id not in state:
+                result['missing'].append(user_id)
+            elif state[user_id]:
+                result['unchanged'].append(user_id)
+            else:
+                result['changed'].append(user_id)
+        conn.execute(f'''
+            INSERT INTO {table} (user_id, {column}, assigned_by)
+            SELECT u.user_id, ?, ?
+            FROM users u
+            WHERE u.user_id IN ({placeholders})
+              AND NOT EXISTS (
+                  SELECT 1 FROM {table} t WHERE t.user_id = u.user_id AND t.{column} = ?
+              )
+        ''', [target_id, actor_id] + chunk + [target_id])
+
+    if points == 0 or not result['changed']:
+        return
+    source = spec['source'].format(id=target_id)
+    reason = spec['reason'].format(id=target_id)
+    conn.executemany('''
+        INSERT INTO snowflake_events (user_id, source, reason, points, active, manual_revoked)
+        VALUES (?, ?, ?, ?, 1, 0)
+        ON CONFLICT(user_id, source) DO UPDATE SET
+            points = excluded.points,
+            active = 1,
+            manual_revoked = 0,
+            revoked_at = NULL,
+            updated_at = CURRENT_TIMESTAMP
+    ''', [(user_id, source, reason, points) for user_id in result['changed']])
+
+
+def _apply_bulk_block(conn, blocked, user_ids, actor_id, reason, result):
+    for start in range(0, len(user_ids), BULK_USER_CHUNK_SIZE):
+        chunk = user_ids[start:start + BULK_USER_CHUNK_SIZE]
+        placeholders = ','.join(['?'] * len(chunk))
+        state = {
+            row['user_id']: bool(row['is_blocked'])
+            for row in conn.execute(
+                f'SELECT user_id, is_blocked FROM users WHERE user_id IN ({placeholders})', chunk
+            )
+        }
+        for user_id in chunk:
+            if user_id not in state:
+                result['missing'].append(user_id)
+            elif blocked and user_id == actor_id:
+                result['skipped'].append(user_id)
+            elif state[user_id] == blocked:
+                result['unchanged'].append(user_id)
+            else:
+                result['changed'].append(user_id)
+
+    changed = result['changed']
+    for start in range(0, len(changed), BULK_USER_CHUNK_SIZE):
+        chunk = changed[start:start + BULK_USER_CHUNK_SIZE]
+        placeholders = ','.join(['?'] * len(chunk))
+        if blocked:
+            conn.execute(f'''
+                UPDATE users SET
+                    is_blocked = 1,
+                    blocked_by = ?,
+                    blocked_reason = ?,
+                    blocked_at = ?
+                WHERE user_id IN ({placeholders})
+            ''', [actor_id, reason, datetime.utcnow()] + chunk)
+        else:
+            conn.execute(f'''
+                UPDATE users SET
+                    is_blocked = 0,
+                    blocked_by = NULL,
+                    blocked_reason = NULL,
+                    blocked_at = NULL
+                WHERE user_id IN ({placeholders})
+            ''', chunk)
+
+
+def apply_bulk_user_operation(conn, operation, user_ids, target=None, actor_id=None, reason=None):
+    """Применяет операцию к списку пользователей (без commit).
+
+    Возвращает (результат, ошибка); результат содержит списки changed/unchanged/missing/skipped.
+    """
+    if operation not in BULK_USER_OPERATIONS:
+        return None, 'Неизвестная операция'
+    user_ids = _unique_user_ids(user_ids)
+    if not user_ids:
+        return None, 'Не выбраны пользователи'
+    result = {
+        'operation': operation,
+        'target': target,
+        'target_id': None,
+        'reason': reason,
+        'actor_id': actor_id,
+        'changed': [],
+        'unchanged': [],
+        'missing': [],
+        'skipped': [],
+    }
+    if operation in _BULK_ASSIGNMENT_SPECS:
+        target_id = _resolve_bulk_target(conn, operation, target)
+        if target_id is None:
+            return None, {
+                'assign_role': 'Роль не найдена',
+                'assign_title': 'Звание не найдено',
+                'assign_award': 'Награда не найдена',
+            }[operation]
+        result['target_id'] = target_id
+        _apply_bulk_assignment(conn, operation, target_id, user_ids, actor_id, result)
+    else:
+        if operation == 'block' and not reason:
+            return None, 'Причина блокировки обязательна'
+        _apply_bulk_block(conn, operation == 'block', user_ids, actor_id, reason, result)
+    return result, None
+
+
+def finish_bulk_user_operation(result):
+    """После commit: обновляет справочник пользователей и пишет одну запись в журнал"""
+    changed = result['changed']
+    if not changed:
+        return
+    if result['operation'] in ('assign_role', 'block', 'unblock'):
+        for start in range(0, len(changed), BULK_USER_CHUNK_SIZE):
+            refresh_user_directory_entry(*changed[start:start + BULK_USER_CHUNK_SIZE])
+
+    operation = result['operation']
+    metadata = {
+        'target_user_ids': changed,
+        'unchanged_count': len(result['unchanged']),
+        'assigned_by': result['actor_id'],
+    }
+    if operation == 'assign_role':
+        action, details = 'role_bulk_assign', f'Назначена роль {result["target"]}'
+        metadata['role'] = result['target']
+    elif operation == 'assign_title':
+        action, details = 'title_bulk_assign', f'Назначено звание {result["target_id"]}'
+        metadata['title_id'] = result['target_id']
+    elif operation == 'assign_award':
+        action, details = 'award_bulk_assign', f'Назначена награда {result["target_id"]}'
+        metadata['award_id'] = result['target_id']
+    elif operation == 'block':
+        action, details = 'admin_users_bulk_blocked', 'Заблокированы пользователи'
+        metadata['blocked_reason'] = result['reason']
+    else:
+        action, details = 'admin_users_bulk_unblocked', 'Разблокированы пользователи'
+    log_activity(
+        action,
+        details=f'{details}: {len(changed)} польз.',
+        metadata=metadata,
+        user_id=result['actor_id']
+    )
+
+
+def bulk_user_operation(operation, user_ids, target=None, actor_id=None, reason=None):
+    """Массовая операция над пользователями одной транзакцией. Возвращает (результат, ошибка)"""
+    conn = get_db_connection()
+    try:
+        result, error = apply_bulk_user_operation(conn, operation, user_ids, target, actor_id, reason)
+        if error:
+            return None, error
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        log_error(f"Error in bulk user operation {operation}: {e}")
+        return None, 'Не удалось выполнить операцию'
+    finally:
+        conn.close()
+    finish_bulk_user_operation(result)
+    return result, None
+
 # Декораторы для проверки прав доступа
 def require_role(role_name):
     """Декоратор для проверки наличия роли у пользователя"""
@@ -1938,85 +3365,20 @@ def require_login(f):
         return f(*args, **kwargs)
     return decorated_function
 # Проверка подписи sign
+_sign_verifier = SignatureVerifier(GWARS_PASSWORD, SIGN_VARIANTS)
+_sign3_verifier = SignatureVerifier(GWARS_PASSWORD, SIGN3_VARIANTS, length=10)
+
 def verify_sign(username, user_id, sign, encoded_name=None):
     # Формируем подпись: md5(password + username + user_id)
     # В PHP: $sign=md5($pass.$user_name.$user_user_id);
-    # ВАЖНО: В PHP подпись вычисляется с оригинальными байтами ДО urlencode!
-    # Поэтому нужно использовать unquote_to_bytes для получения оригинальных байтов
-    
-    variants = []
-    
-    # Вариант 1: ОРИГИНАЛЬНЫЕ БАЙТЫ из URL (правильный способ!)
-    # В PHP подпись вычисляется с оригинальными байтами, а не с декодированной строкой
-    if encoded_name:
-        encoded_variations = [encoded_name]
-        if '+' in encoded_name:
-            encoded_variations.append(encoded_name.replace('+', '%20'))
-        for encoded_variant in encoded_variations:
-            try:
-                name_bytes = unquote_to_bytes(encoded_variant)
-                expected_sign_bytes = hashlib.md5(
-                    GWARS_PASSWORD.encode('utf-8') + name_bytes + str(user_id).encode('utf-8')
-                ).hexdigest()
-                suffix = '' if encoded_variant == encoded_name else '_space'
-                variants.append((f'bytes{suffix}', expected_sign_bytes))
-            except:
-                pass
-    
-    # Вариант 2: декодированное имя через UTF-8
-    expected_sign_decoded = hashlib.md5(
-        (GWARS_PASSWORD + username + str(user_id)).encode('utf-8')
-    ).hexdigest()
-    variants.append(('decoded', expected_sign_decoded))
-    
-    # Вариант 3: закодированное имя (как пришло в URL)
-    if encoded_name:
-        encoded_variations = [encoded_name]
-        if '+' in encoded_name:
-            encoded_variations.append(encoded_name.replace('+', '%20'))
-        for encoded_variant in encoded_variations:
-            expected_sign_encoded = hashlib.md5(
-                (GWARS_PASSWORD + encoded_variant + str(user_id)).encode('utf-8')
-            ).hexdigest()
-            suffix = '' if encoded_variant == encoded_name else '_space'
-            variants.append((f'encoded{suffix}', expected_sign_encoded))
-    
-    # Вариант 4: декодированное через CP1251 (Windows-1251)
-    if encoded_name:
-        try:
-            name_cp1251 = unquote_plus(encoded_name, encoding='cp1251')
-            expected_sign_cp1251 = hashlib.md5(
-                (GWARS_PASSWORD + name_cp1251 + str(user_id)).encode('utf-8')
-            ).hexdigest()
-            variants.append(('cp1251', expected_sign_cp1251))
-        except:
-            pass
-        
-        # Вариант 5: декодированное через latin1, затем байты
-        try:
-            name_latin1 = unquote_plus(encoded_name, encoding='latin1')
-            name_latin1_bytes = name_latin1.encode('latin1')
-            expected_sign_latin1_bytes = hashlib.md5(
-                GWARS_PASSWORD.encode('utf-8') + name_latin1_bytes + str(user_id).encode('utf-8')
-            ).hexdigest()
-            variants.append(('latin1_bytes', expected_sign_latin1_bytes))
-        except:
-            pass
-    
-    # Логирование для отладки
-    log_error(f"verify_sign: username={username}, user_id={user_id}")
-    log_error(f"verify_sign: encoded_name={encoded_name}")
-    for variant_name, variant_sign in variants:
-        match_status = "MATCH" if variant_sign == sign else "NO MATCH"
-        log_error(f"verify_sign: variant {variant_name}={variant_sign}, {match_status}")
-    
-    # Проверяем все варианты
-    for variant_name, variant_sign in variants:
-        if variant_sign == sign:
-            log_error(f"verify_sign: SUCCESS with variant {variant_name}!")
-            return True
-    
-    log_error(f"verify_sign: ALL VARIANTS FAILED! Received sign={sign}")
+    # ВАЖНО: В PHP подпись вычисляется с оригинальными байтами ДО urlencode,
+    # поэтому первым проверяется вариант unquote_to_bytes(encoded_name)
+    variant, tried = _sign_verifier.verify(user_id, sign, username, encoded_name)
+    if variant:
+        log_debug(f"verify_sign: user_id={user_id} matched variant {variant} ({tried} tried)")
+        return True
+    log_error(f"verify_sign: user_id={user_id} no variant matched ({tried} tried), "
+              f"encoded_name={encoded_name!r}, sign={sign}")
     return False
 
 # Проверка подписи sign2
@@ -2030,38 +3392,13 @@ def verify_sign2(level, synd, user_id, sign2):
 def verify_sign3(username, user_id, has_passport, has_mobile, old_passport, sign3, encoded_name=None):
     # В PHP: $sign3=substr(md5($pass.$user_name.$user_id.$has_passport.$has_mobile.$old_passport),0,10);
     # ВАЖНО: Используем оригинальные байты, как и для sign!
-    variants = []
-    
-    # Вариант 1: ОРИГИНАЛЬНЫЕ БАЙТЫ из URL (правильный способ!)
-    if encoded_name:
-        encoded_variations = [encoded_name]
-        if '+' in encoded_name:
-            encoded_variations.append(encoded_name.replace('+', '%20'))
-        for encoded_variant in encoded_variations:
-            try:
-                name_bytes = unquote_to_bytes(encoded_variant)
-                expected_sign3_bytes = hashlib.md5(
-                    GWARS_PASSWORD.encode('utf-8') + name_bytes + str(user_id).encode('utf-8') + 
-                    str(has_passport).encode('utf-8') + str(has_mobile).encode('utf-8') + str(old_passport).encode('utf-8')
-                ).hexdigest()[:10]
-                suffix = '' if encoded_variant == encoded_name else '_space'
-                variants.append((f'bytes{suffix}', expected_sign3_bytes))
-            except:
-                pass
-    
-    # Вариант 2: декодированное имя
-    expected_sign3_decoded = hashlib.md5(
-        (GWARS_PASSWORD + username + str(user_id) + str(has_passport) + str(has_mobile) + str(old_passport)).encode('utf-8')
-    ).hexdigest()[:10]
-    variants.append(('decoded', expected_sign3_decoded))
-    
-    # Проверяем все варианты
-    for variant_name, variant_sign in variants:
-        if variant_sign == sign3:
-            log_error(f"verify_sign3: SUCCESS with variant {variant_name}!")
-            return True
-    
-    log_error(f"verify_sign3: ALL VARIANTS FAILED! Received sign3={sign3}")
+    variant, tried = _sign3_verifier.verify(
+        user_id, sign3, username, encoded_name, suffix=f"{has_passport}{has_mobile}{old_passport}"
+    )
+    if variant:
+        log_debug(f"verify_sign3: user_id={user_id} matched variant {variant} ({tried} tried)")
+        return True
+    log_error(f"verify_sign3: user_id={user_id} no variant matched ({tried} tried), sign3={sign3}")
     return False
 # Проверка подписи sign4 (дата)
 def verify_sign4(sign3, sign4):
@@ -2130,6 +3467,8 @@ def inject_default_theme():
         return dict(
             default_theme=default_theme, 
             get_avatar_url=get_avatar_url,
+            get_avatar_preview_url=get_avatar_preview_url,
+            get_image_thumbnail_path=get_image_thumbnail_path,
             current_user_avatar_seed=current_user_avatar_seed,
             current_user_avatar_style=current_user_avatar_style,
             get_role_permissions=get_role_permissions,
@@ -2150,6 +3489,8 @@ def inject_default_theme():
         return dict(
             default_theme='dark',
             get_avatar_url=get_avatar_url,
+            get_avatar_preview_url=get_avatar_preview_url,
+            get_image_thumbnail_path=get_image_thumbnail_path,
             current_user_avatar_seed=None,
             current_user_avatar_style=None,
             get_role_permissions=get_role_permissions,
@@ -2438,6 +3779,7 @@ def login_dev():
         return redirect(url_for('index'))
     finally:
         conn.close()
+    refresh_user_directory_entry(user_id)
     
     # Автоматически назначаем роль админа для администраторов по умолчанию
     if user_id in ADMIN_USER_IDS:
@@ -2490,44 +3832,15 @@ def login():
                     name_encoded = param.split('=', 1)[1]  # Берем все после первого =
                     break
         
-        # Если не получилось получить из query_string, пробуем через request.args (но это уже декодированное)
+        # Если не получилось получить из query_string, берем через request.args (уже декодированное)
         if not name_encoded or name_encoded == '':
             name_encoded = request.args.get('name', '')
-            # Если получили через args, значит оно уже декодировано, нужно закодировать обратно для проверки
-            if name_encoded:
-                name_encoded_for_comparison = quote(name_encoded, safe='')
-            else:
-                name_encoded_for_comparison = ''
-        else:
-            name_encoded_for_comparison = name_encoded
         
-        # Пробуем декодировать разными способами
         # ВАЖНО: GWars использует CP1251 (Windows-1251) для кодирования русских символов!
-        name = name_encoded if name_encoded else ''
+        # unquote_plus не бросает исключений (неизвестные байты заменяются), поэтому декодируем один раз
+        name = unquote_plus(name_encoded, encoding='cp1251') if name_encoded else ''
+        name_cp1251 = name or None
         name_latin1 = None
-        name_cp1251 = None
-        if name_encoded:
-            try:
-                # Сначала пробуем CP1251 (Windows-1251) - это основная кодировка для русских символов
-                name_cp1251 = unquote_plus(name_encoded, encoding='cp1251')
-                name = name_cp1251  # Используем CP1251 как основной вариант
-            except:
-                try:
-                    name = unquote_plus(name_encoded, encoding='utf-8')
-                except:
-                    try:
-                        name = unquote_plus(name_encoded, encoding='latin1')
-                        name_latin1 = name
-                    except:
-                        name = name_encoded
-                        name_latin1 = name_encoded
-            
-            # Если CP1251 декодирование не сработало, пробуем еще раз
-            if not name_cp1251:
-                try:
-                    name_cp1251 = unquote_plus(name_encoded, encoding='cp1251')
-                except:
-                    name_cp1251 = None
         
         level = request.args.get('level', '0')
         synd = request.args.get('synd', '0')
@@ -2591,23 +3904,7 @@ def login():
             gwars_login_url = f"https://www.gwars.io/cross-server-login.php?site_id={GWARS_SITE_ID}&url={quote(callback_url)}"
             return redirect(gwars_login_url)
         
-        # Логируем все полученные параметры для отладки
-        log_error("=== LOGIN DEBUG ===")
-        log_error(f"Received parameters:")
-        log_error(f"  sign={sign}")
-        log_error(f"  name (from args)={request.args.get('name', '')}")
-        log_error(f"  name (encoded/raw from query_string)={name_encoded}")
-        log_error(f"  name (decoded)={name}")
-        log_error(f"  name (repr)={repr(name)}")
-        log_error(f"  name_encoded (repr)={repr(name_encoded)}")
-        log_error(f"  user_id={user_id}")
-        log_error(f"  level={level}")
-        log_error(f"  synd={synd}")
-        log_error(f"  sign2={sign2}")
-        log_error(f"Full URL: {request.url}")
-        log_error(f"Query string (raw bytes): {request.query_string}")
-        log_error(f"Query string (decoded): {query_string}")
-        log_error(f"All args: {dict(request.args)}")
+        log_debug(f"Login attempt: user_id={user_id}, name_encoded={name_encoded!r}, level={level}, synd={synd}")
         
         # Проверяем подписи (пробуем оба варианта - с декодированным и закодированным именем)
         if not verify_sign(name, user_id, sign, name_encoded):
@@ -2926,6 +4223,7 @@ def login():
                 return redirect(url_for('index'))
         finally:
             conn.close()
+        refresh_user_directory_entry(user_id)
         
         # Автоматически назначаем роль админа для администраторов по умолчанию
         if int(user_id) in ADMIN_USER_IDS:
@@ -3036,6 +4334,7 @@ def telegram_verify_unlink():
             WHERE user_id = ?
         ''', (user_id,))
         conn.commit()
+        invalidate_telegram_chat(user_ids=[user_id])
         return jsonify({'success': True, 'message': 'Telegram аккаунт успешно отвязан'})
     except Exception as e:
         log_error(f"Error unlinking Telegram: {e}")
@@ -3082,6 +4381,23 @@ def dashboard():
                          telegram_info=telegram_info)
 
 
+@app.route('/avatars/<style>/<int:size>/<path:seed>.svg')
+def avatar_image(style, size, seed):
+    """Отдает SVG аватара из локального кэша"""
+    if style not in DICEBEAR_AVATAR_STYLES or size not in AVATAR_SIZES or len(seed) > AVATAR_SEED_MAX_LENGTH:
+        abort(404)
+    svg, cacheable = get_avatar_svg(style, seed, size)
+    response = Response(svg, mimetype='image/svg+xml')
+    if cacheable:
+        response.headers['Cache-Control'] = f'public, max-age={AVATAR_CACHE_MAX_AGE}, immutable'
+    else:
+        response.headers['Cache-Control'] = 'public, max-age=300'
+    # SVG из внешнего источника не должен выполнять скрипты при прямом открытии
+    response.headers['Content-Security-Policy'] = "default-src 'none'; style-src 'unsafe-inline'"
+    response.headers['X-Content-Type-Options'] = 'nosniff'
+    return response
+
+
 @app.route('/api/avatar/generate-options', methods=['POST'])
 @require_login
 def api_generate_avatar_options():
@@ -3093,38 +4409,20 @@ def api_generate_avatar_options():
     if not style:
         return jsonify({'error': 'Style is required'}), 400
     
-    conn = get_db_connection()
     try:
-        # Получаем все использованные seeds
-        used_seeds = set(row[0] for row in conn.execute(
-            'SELECT avatar_seed FROM users WHERE avatar_seed IS NOT NULL'
-        ).fetchall())
-        conn.close()
-    except Exception as e:
-        log_error(f"Error fetching used seeds: {e}")
-        conn.close()
-        used_seeds = set()
-    
-    # Генерируем варианты аватаров
-    options = []
-    attempts = 0
-    max_attempts = count * 10  # Максимальное количество попыток
-    
-    while len(options) < count and attempts < max_attempts:
-        # Генерируем случайный seed
-        random_part = secrets.token_hex(8)
-        seed = f"option_{random_part}"
-        
-        # Проверяем уникальность
-        if seed not in used_seeds:
-            options.append({
-                'seed': seed,
-                'url': get_avatar_url(seed, style, 128),
-                'unique': True
-            })
-            used_seeds.add(seed)  # Добавляем в список использованных для этой сессии
-        
-        attempts += 1
+        count = min(max(int(count), 1), 100)
+    except (TypeError, ValueError):
+        count = 20
+    
+    # Генерируем варианты аватаров; занятость проверяется одним запросом по индексу
+    options = [
+        {
+            'seed': seed,
+            'url': get_avatar_preview_url(seed, style, 128),
+            'unique': True
+        }
+        for seed in generate_unique_avatar_candidates(style, count, exclude_user_id=session.get('user_id'))
+    ]
     
     return jsonify({
         'style': style,
@@ -3172,44 +4470,31 @@ def edit_profile():
         apartment = request.form.get('apartment', '').strip()
         
         try:
-            # Если передан новый avatar_seed и avatar_style, проверяем уникальность
+            # Если передан новый avatar_seed и avatar_style, закрепляем seed за пользователем;
+            # уникальность гарантирует индекс, поэтому одновременный выбор того же seed не пройдет
             if avatar_seed and avatar_style:
-                # Проверяем, что выбранный seed уникален (не используется другими пользователями)
-                used_seeds = get_used_avatar_seeds(exclude_user_id=session['user_id'])
-                if avatar_seed in used_seeds:
+                if not reserve_avatar_seed(conn, session['user_id'], avatar_seed, avatar_style):
+                    conn.rollback()
                     flash('Выбранный аватар уже используется другим пользователем. Пожалуйста, выберите другой.', 'error')
                     conn.close()
                     return render_template('edit_profile.html', user=user)
             
             # Обновляем профиль
-            if avatar_seed and avatar_style:
-                # Обновляем с новым аватаром и всеми полями
-                conn.execute('''
-                    UPDATE users 
-                    SET bio = ?, contact_info = ?, avatar_style = ?, avatar_seed = ?, 
-                        email = ?, phone = ?, telegram = ?, whatsapp = ?, viber = ?,
-                        last_name = ?, first_name = ?, middle_name = ?,
-                        postal_code = ?, country = ?, city = ?, street = ?, house = ?, building = ?, apartment = ?
-                    WHERE user_id = ?
-                ''', (bio, contact_info, avatar_style, avatar_seed, email, phone, telegram, whatsapp, viber,
-                      last_name, first_name, middle_name,
-                      postal_code, country, city, street, house, building, apartment, session['user_id']))
-            else:
-                # Обновляем без изменения аватара, но со всеми остальными полями
-                conn.execute('''
-                    UPDATE users 
-                    SET bio = ?, contact_info = ?, 
-                        email = ?, phone = ?, telegram = ?, whatsapp = ?, viber = ?,
-                        last_name = ?, first_name = ?, middle_name = ?,
-                        postal_code = ?, country = ?, city = ?, street = ?, house = ?, building = ?, apartment = ?
-                    WHERE user_id = ?
-                ''', (bio, contact_info, email, phone, telegram, whatsapp, viber,
-                      last_name, first_name, middle_name,
-                      postal_code, country, city, street, house, building, apartment, session['user_id']))
+            conn.execute('''
+                UPDATE users 
+                SET bio = ?, contact_info = ?, 
+                    email = ?, phone = ?, telegram = ?, whatsapp = ?, viber = ?,
+                    last_name = ?, first_name = ?, middle_name = ?,
+                    postal_code = ?, country = ?, city = ?, street = ?, house = ?, building = ?, apartment = ?
+                WHERE user_id = ?
+            ''', (bio, contact_info, email, phone, telegram, whatsapp, viber,
+                  last_name, first_name, middle_name,
+                  postal_code, country, city, street, house, building, apartment, session['user_id']))
             
             conn.commit()
             flash('Профиль успешно обновлен', 'success')
             conn.close()
+            refresh_user_directory_entry(session['user_id'])
             return redirect(url_for('dashboard'))
         except Exception as e:
             log_error(f"Error updating profile: {e}")
@@ -3244,6 +4529,7 @@ def clear_profile():
         
         conn.commit()
         conn.close()
+        refresh_user_directory_entry(user_id)
         
         return jsonify({'success': True, 'message': 'Все редактируемые поля профиля очищены'})
     except Exception as e:
@@ -3256,17 +4542,12 @@ def clear_profile():
 def get_avatar_candidates():
     """API endpoint для получения уникальных кандидатов аватаров выбранного стиля"""
     style = request.args.get('style', 'avataaars')
-    count = int(request.args.get('count', 20))
-    
-    valid_styles = [
-        'adventurer', 'adventurer-neutral', 'avataaars', 'avataaars-neutral',
-        'big-ears', 'big-ears-neutral', 'big-smile', 'bottts', 'bottts-neutral',
-        'croodles', 'croodles-neutral', 'fun-emoji', 'icons', 'identicon', 'initials',
-        'lorelei', 'lorelei-neutral', 'micah', 'miniavs', 'open-peeps', 'personas',
-        'pixel-art', 'pixel-art-neutral', 'rings', 'shapes', 'thumbs'
-    ]
+    try:
+        count = min(max(int(request.args.get('count', 20)), 1), 100)
+    except (TypeError, ValueError):
+        count = 20
     
-    if style not in valid_styles:
+    if style not in DICEBEAR_AVATAR_STYLES:
         return jsonify({'error': 'Invalid style'}), 400
     
     candidates = generate_unique_avatar_candidates(style, count, exclude_user_id=session['user_id'])
@@ -3275,7 +4556,7 @@ def get_avatar_candidates():
         'candidates': [
             {
                 'seed': seed,
-                'url': get_avatar_url(seed, style, size=128)
+                'url': get_avatar_preview_url(seed, style, size=128)
             }
             for seed in candidates
         ]
@@ -3428,14 +4709,123 @@ def delete_admin_comment(user_id, comment_id):
     
     return redirect(url_for('view_profile', user_id=user_id) + '#comments')
 
+def _participant_card(user, now):
+    """Формирует данные участника для списка (статус по last_login)"""
+    last_login = user.last_login
+    status = 'Оффлайн'
+    if last_login:
+        try:
+            # Обрабатываем разные форматы даты
+            last_login_str = str(last_login).split('.')[0] if '.' in str(last_login) else str(last_login)
+            last_login_date = datetime.strptime(last_login_str, '%Y-%m-%d %H:%M:%S')
+            if (now - last_login_date).total_seconds() < 3600:  # Меньше часа
+                status = 'Онлайн'
+            elif (now - last_login_date).days == 0:  # Сегодня
+                status = 'Был сегодня'
+        except Exception as e:
+            log_debug(f"Error parsing last_login for user {user.user_id}: {e}")
+    
+    return {
+        'user_id': user.user_id,
+        'username': user.username or 'Неизвестно',
+        'avatar_seed': user.avatar_seed,
+        'avatar_style': user.avatar_style,
+        'status': status,
+        # Если ролей нет, используем 'Пользователь'
+        'roles': user.roles or 'Пользователь',
+        'created_at': user.created_at or 'N/A'
+    }
+
+def _participants_sort_key(user):
+    return (str(user.created_at or ''), user.user_id)
+
+_PARTICIPANTS_KEY_COLUMNS = ('sort_created', 'user_id')
+
+
+def _get_participants_sql_page(search_query, page, per_page, cursor):
+    """Страница участников из SQL: поиск по индексу idx_users_created_order от курсора.
+
+    Поиск (LIKE) без учета регистра работает только для ASCII - его ведет этот путь,
+    остальной поиск идет по справочнику в памяти.
+    """
+    where_sql = ''
+    params = []
+    if search_query:
+        pattern = '%' + re.sub(r'([\\%_])', r'\\\1', search_query) + '%'
+        where_sql = '''
+            WHERE (u.username LIKE ? ESCAPE '\\' OR CAST(u.user_id AS TEXT) LIKE ? ESCAPE '\\'
+                OR EXISTS (
+                    SELECT 1 FROM user_roles ur JOIN roles r ON r.id = ur.role_id
+                    WHERE ur.user_id = u.user_id AND r.display_name LIKE ? ESCAPE '\\'
+                ))
+        '''
+        params = [pattern] * 3
+    base_query = f"SELECT COALESCE(u.created_at, '') AS sort_created, u.user_id FROM users u {where_sql}"
+
+    conn = get_db_connection()
+    try:
+        total_count = conn.execute(f'SELECT COUNT(*) FROM users u {where_sql}', params).fetchone()[0]
+        if cursor or page <= 1:
+            result = fetch_keyset_page(
+                conn, base_query, params, _PARTICIPANTS_KEY_COLUMNS, (False, False), cursor, per_page
+            )
+        else:
+            rows = conn.execute(
+                f'{base_query} ORDER BY sort_created, u.user_id LIMIT ? OFFSET ?',
+                params + [per_page + 1, (page - 1) * per_page]
+            ).fetchall()
+            result = _build_keyset_page(rows, _PARTICIPANTS_KEY_COLUMNS, per_page, None, 'next')
+            result['has_prev'] = True
+            if result['items']:
+                result['prev_cursor'] = encode_page_cursor(
+                    tuple(result['items'][0][column] for column in _PARTICIPANTS_KEY_COLUMNS), 'prev'
+                )
+        user_ids = [row['user_id'] for row in result['items']]
+        entries = _load_user_directory_entries(conn, user_ids) if user_ids else {}
+    finally:
+        conn.close()
+    result['items'] = [entries[user_id] for user_id in user_ids if user_id in entries]
+    result['total_count'] = total_count
+    return result
+
+
+def _get_participants_page(search_query, page, per_page, cursor):
+    """Страница участников: по курсору (created_at, user_id) или по номеру страницы"""
+    if not search_query or search_query.isascii():
+        result = _get_participants_sql_page(search_query, page, per_page, cursor)
+        now = datetime.now()
+        result['items'] = [_participant_card(user, now) for user in result['items']]
+        return result
+
+    # Кириллический поиск - по справочнику пользователей в памяти
+    # (SQLite LOWER() и LIKE не учитывают регистр кириллицы)
+    filtered_users = query_user_directory(search=search_query, sort_by='created_at')
+    total_count = len(filtered_users)
+    if cursor:
+        result = keyset_slice(filtered_users, _participants_sort_key, cursor, per_page)
+    else:
+        users, _ = paginate_user_directory(filtered_users, page, per_page)
+        result = {
+            'items': users,
+            'has_prev': page > 1,
+            'has_next': page * per_page < total_count,
+            'prev_cursor': encode_page_cursor(_participants_sort_key(users[0]), 'prev') if page > 1 and users else None,
+            'next_cursor': encode_page_cursor(_participants_sort_key(users[-1]), 'next') if page * per_page < total_count and users else None,
+        }
+    now = datetime.now()
+    result['items'] = [_participant_card(user, now) for user in result['items']]
+    result['total_count'] = total_count
+    return result
+
 @app.route('/participants')
 def participants():
     """Страница со списком участников"""
     try:
         # Параметры пагинации и поиска
-        page = request.args.get('page', 1, type=int)
+        page = max(request.args.get('page', 1, type=int), 1)
         per_page = request.args.get('per_page', 50, type=int)
         search_query = request.args.get('search', '').strip()
+        cursor = request.args.get('cursor', '').strip()
         
         # Логирование для отладки поиска
         if search_query:
@@ -3444,134 +4834,12 @@ def participants():
         # Ограничиваем per_page разумными значениями
         per_page = min(max(per_page, 10), 100)
         
-        conn = get_db_connection()
+        page_data = _get_participants_page(search_query, page, per_page, cursor)
+        participants_data = page_data['items']
+        total_count = page_data['total_count']
         
-        # Формируем условия поиска
-        # SQLite LOWER() не работает с кириллицей, поэтому используем другой подход:
-        # Загружаем всех пользователей и фильтруем в Python
-        search_params = []
-        if search_query:
-            search_lower = search_query.lower()
-            # Используем оригинальный запрос и нижний регистр для SQL
-            # Но основной фильтр будет в Python
-            search_pattern = f'%{search_query}%'
-            search_params = [search_pattern, search_pattern, search_pattern]
-        
-        # Для поиска загружаем всех пользователей и фильтруем в Python
-        # (так как SQLite LOWER() не работает с кириллицей)
-        if search_query:
-            # Загружаем всех пользователей для фильтрации в Python
-            all_users = conn.execute('''
-                SELECT 
-                    u.user_id,
-                    u.username,
-                    u.avatar_seed,
-                    u.avatar_style,
-                    u.created_at,
-                    u.last_login,
-                    GROUP_CONCAT(r.display_name, ', ') as roles
-                FROM users u
-                LEFT JOIN user_roles ur ON u.user_id = ur.user_id
-                LEFT JOIN roles r ON ur.role_id = r.id
-                GROUP BY u.user_id
-                ORDER BY u.created_at ASC
-            ''').fetchall()
-            
-            # Фильтруем в Python с учетом регистра
-            search_lower = search_query.lower()
-            filtered_users = []
-            for user in all_users:
-                user_keys = user.keys()
-                username = user['username'] if 'username' in user_keys else ''
-                user_id_str = str(user['user_id']) if 'user_id' in user_keys else ''
-                roles_str = user['roles'] if ('roles' in user_keys and user['roles']) else ''
-                
-                # Проверяем совпадение (регистронезависимо)
-                if (search_query.lower() in username.lower() or 
-                    search_query.lower() in user_id_str.lower() or
-                    search_query.lower() in roles_str.lower()):
-                    filtered_users.append(user)
-            
-            # Применяем пагинацию к отфильтрованным результатам
-            total_count = len(filtered_users)
-            offset = (page - 1) * per_page
-            users = filtered_users[offset:offset + per_page]
-        else:
-            # Без поиска - обычная пагинация
-            total_count = conn.execute('''
-                SELECT COUNT(DISTINCT u.user_id)
-                FROM users u
-            ''').fetchone()[0]
-            
-            offset = (page - 1) * per_page
-            users_query = '''
-                SELECT 
-                    u.user_id,
-                    u.username,
-                    u.avatar_seed,
-                    u.avatar_style,
-                    u.created_at,
-                    u.last_login,
-                    GROUP_CONCAT(r.display_name, ', ') as roles
-                FROM users u
-                LEFT JOIN user_roles ur ON u.user_id = ur.user_id
-                LEFT JOIN roles r ON ur.role_id = r.id
-                GROUP BY u.user_id
-                ORDER BY u.created_at ASC
-                LIMIT ? OFFSET ?
-            '''
-            users = conn.execute(users_query, [per_page, offset]).fetchall()
-        
-        # Для каждого пользователя определяем статус
-        participants_data = []
-        for user in users:
-            # sqlite3.Row работает как словарь, но не имеет метода .get()
-            # Используем прямой доступ с проверкой наличия ключей
-            user_keys = user.keys()
-            
-            last_login = user['last_login'] if 'last_login' in user_keys else None
-            
-            status = 'Оффлайн'
-            if last_login:
-                try:
-                    # Обрабатываем разные форматы даты
-                    last_login_str = str(last_login).split('.')[0] if '.' in str(last_login) else str(last_login)
-                    last_login_date = datetime.strptime(last_login_str, '%Y-%m-%d %H:%M:%S')
-                    now = datetime.now()
-                    if (now - last_login_date).total_seconds() < 3600:  # Меньше часа
-                        status = 'Онлайн'
-                    elif (now - last_login_date).days == 0:  # Сегодня
-                        status = 'Был сегодня'
-                except Exception as e:
-                    user_id = user['user_id'] if 'user_id' in user_keys else 'unknown'
-                    log_debug(f"Error parsing last_login for user {user_id}: {e}")
-            
-            # Обрабатываем роли - если их нет, используем 'Пользователь'
-            roles_str = user['roles'] if ('roles' in user_keys and user['roles']) else 'Пользователь'
-            
-            # Получаем значения с обработкой отсутствующих ключей
-            user_id = user['user_id'] if 'user_id' in user_keys else None
-            username = user['username'] if ('username' in user_keys and user['username']) else 'Неизвестно'
-            avatar_seed = user['avatar_seed'] if 'avatar_seed' in user_keys else None
-            avatar_style = user['avatar_style'] if 'avatar_style' in user_keys else None
-            created_at = user['created_at'] if ('created_at' in user_keys and user['created_at']) else 'N/A'
-            
-            participants_data.append({
-                'user_id': user_id,
-                'username': username,
-                'avatar_seed': avatar_seed,
-                'avatar_style': avatar_style,
-                'status': status,
-                'roles': roles_str,
-                'created_at': created_at
-            })
-        
-        conn.close()
-        
-        # Вычисляем данные для пагинации
-        total_pages = (total_count + per_page - 1) // per_page if total_count > 0 else 1
-        has_prev = page > 1
-        has_next = page < total_pages
+        # Вычисляем данные для пагинации
+        total_pages = (total_count + per_page - 1) // per_page if total_count > 0 else 1
         
         # Логирование для отладки
         log_debug(f"Participants pagination: page={page}, per_page={per_page}, total_count={total_count}, total_pages={total_pages}, participants_count={len(participants_data)}")
@@ -3583,18 +4851,35 @@ def participants():
                              per_page=per_page,
                              total_count=total_count,
                              total_pages=total_pages,
-                             has_prev=has_prev,
-                             has_next=has_next,
+                             has_prev=page_data['has_prev'],
+                             has_next=page_data['has_next'],
+                             prev_cursor=page_data['prev_cursor'],
+                             next_cursor=page_data['next_cursor'],
                              search_query=search_query)
     except Exception as e:
         log_error(f"Error in participants route: {e}")
         log_error(traceback.format_exc())
-        try:
-            conn.close()
-        except:
-            pass
         return f"Ошибка при загрузке участников: {str(e)}", 500
 
+@app.route('/api/participants', methods=['GET'])
+def api_participants():
+    """JSON API списка участников с курсорной пагинацией"""
+    per_page = min(max(request.args.get('per_page', 50, type=int), 10), 100)
+    search_query = request.args.get('search', '').strip()
+    cursor = request.args.get('cursor', '').strip()
+    try:
+        page_data = _get_participants_page(search_query, 1, per_page, cursor)
+    except Exception as e:
+        log_error(f"Error in api_participants: {e}")
+        return jsonify({'success': False, 'error': 'Не удалось загрузить участников'}), 500
+    return jsonify({
+        'success': True,
+        'items': page_data['items'],
+        'total_count': page_data['total_count'],
+        'next_cursor': page_data['next_cursor'],
+        'prev_cursor': page_data['prev_cursor'],
+    })
+
 @app.route('/logout')
 def logout():
     if session.get('user_id'):
@@ -3972,14 +5257,10 @@ def admin_rating_settings():
 @require_role('admin')
 def admin_broadcasts():
     """Страница рассылок"""
-    conn = get_db_connection()
     # Получаем всех пользователей с email и telegram
-    users = conn.execute('''
-        SELECT user_id, username, email, telegram, is_blocked
-        FROM users
-        ORDER BY username COLLATE NOCASE
-    ''').fetchall()
+    users = query_user_directory(sort_by='username')
     
+    conn = get_db_connection()
     # Получаем историю рассылок
     broadcasts_history_raw = conn.execute('''
         SELECT id, created_by, created_by_username, recipient_type, delivery_method,
@@ -4049,48 +5330,19 @@ def admin_broadcasts_send():
         return redirect(url_for('admin_broadcasts'))
     
     # Получаем список получателей с расширенными данными для плейсхолдеров
-    conn = get_db_connection()
-    if recipient_type == 'all':
-        if delivery_method == 'email':
-            recipients = conn.execute('''
-                SELECT user_id, username, email, level, synd, phone, telegram,
-                       first_name, last_name, city, country
-                FROM users
-                WHERE email IS NOT NULL AND email != '' AND is_blocked = 0
-            ''').fetchall()
-        else:  # telegram
-            recipients = conn.execute('''
-                SELECT user_id, username, email, level, synd, phone, telegram,
-                       first_name, last_name, city, country
-                FROM users
-                WHERE telegram IS NOT NULL AND telegram != '' AND is_blocked = 0
-            ''').fetchall()
-    else:
-        # Выбранные пользователи
-        if not selected_users:
-            conn.close()
-            flash('Выберите хотя бы одного получателя', 'error')
-            return redirect(url_for('admin_broadcasts'))
-        
-        placeholders = ','.join(['?'] * len(selected_users))
-        if delivery_method == 'email':
-            recipients = conn.execute(f'''
-                SELECT user_id, username, email, level, synd, phone, telegram,
-                       first_name, last_name, city, country
-                FROM users
-                WHERE user_id IN ({placeholders}) 
-                  AND email IS NOT NULL AND email != '' AND is_blocked = 0
-            ''', selected_users).fetchall()
-        else:  # telegram
-            recipients = conn.execute(f'''
-                SELECT user_id, username, email, level, synd, phone, telegram,
-                       first_name, last_name, city, country
-                FROM users
-                WHERE user_id IN ({placeholders}) 
-                  AND telegram IS NOT NULL AND telegram != '' AND is_blocked = 0
-            ''', selected_users).fetchall()
+    if recipient_type != 'all' and not selected_users:
+        flash('Выберите хотя бы одного получателя', 'error')
+        return redirect(url_for('admin_broadcasts'))
     
-    conn.close()
+    recipients = [
+        entry.to_dict()
+        for entry in query_user_directory(
+            user_ids=selected_users if recipient_type != 'all' else None,
+            contact=CONTACT_EMAIL if delivery_method == 'email' else CONTACT_TELEGRAM,
+            exclude_blocked=True,
+            fresh=True
+        )
+    ]
     
     if not recipients:
         flash('Не найдено получателей с указанным способом доставки', 'error')
@@ -4128,7 +5380,7 @@ def admin_broadcasts_send():
         
         result = text
         for placeholder, value in replacements.items():
-            result = result.replace(placeholder, value)
+            result = result.replace(placeholder, value or '')
         
         return result
     
@@ -4390,8 +5642,9 @@ def admin_telegram_menu():
                     VALUES (?, ?, ?, ?, 1)
                 ''', (button_text, button_type, action_value, sort_order))
                 conn.commit()
-                # Обновляем команды меню в Telegram
-                token = get_setting('telegram_bot_token', '')
+                # Пересобираем меню и обновляем команды в Telegram
+                invalidate_telegram_bot_menu()
+                token = get_telegram_bot_token()
                 if token:
                     set_telegram_bot_commands(token)
                 flash('Пункт меню успешно добавлен', 'success')
@@ -4419,8 +5672,9 @@ def admin_telegram_menu():
                     WHERE id = ?
                 ''', (button_text, button_type, action_value, sort_order, is_active, menu_id))
                 conn.commit()
-                # Обновляем команды меню в Telegram
-                token = get_setting('telegram_bot_token', '')
+                # Пересобираем меню и обновляем команды в Telegram
+                invalidate_telegram_bot_menu()
+                token = get_telegram_bot_token()
                 if token:
                     set_telegram_bot_commands(token)
                 flash('Пункт меню успешно обновлен', 'success')
@@ -4434,8 +5688,9 @@ def admin_telegram_menu():
                 try:
                     conn.execute('DELETE FROM telegram_bot_menu WHERE id = ?', (menu_id,))
                     conn.commit()
-                    # Обновляем команды меню в Telegram
-                    token = get_setting('telegram_bot_token', '')
+                    # Пересобираем меню и обновляем команды в Telegram
+                    invalidate_telegram_bot_menu()
+                    token = get_telegram_bot_token()
                     if token:
                         set_telegram_bot_commands(token)
                     flash('Пункт меню успешно удален', 'success')
@@ -4479,9 +5734,8 @@ def telegram_webhook():
         return jsonify({'ok': False, 'error': 'requests library not available'}), 500
     
     # Проверяем, что бот включен
-    telegram_enabled = get_setting('telegram_enabled', '0') == '1'
-    telegram_verified = get_setting('telegram_verified', '0') == '1'
-    if not telegram_enabled or not telegram_verified:
+    bot_settings = get_telegram_bot_settings()
+    if not bot_settings['enabled'] or not bot_settings['verified']:
         return jsonify({'ok': False, 'error': 'Telegram bot not enabled or verified'}), 503
     
     try:
@@ -4564,6 +5818,15 @@ def handle_telegram_callback(callback_query):
     if not chat_id:
         return jsonify({'ok': False, 'error': 'No chat_id'}), 400
     
+    # Сначала подтверждаем нажатие кнопки, чтобы Telegram убрал индикатор загрузки
+    token = get_telegram_bot_token()
+    if token:
+        try:
+            api_url = f'https://api.telegram.org/bot{token}/answerCallbackQuery'
+            get_telegram_http_session().post(api_url, json={'callback_query_id': callback_query.get('id')}, timeout=5)
+        except Exception:
+            pass
+    
     # Обработка callback_data
     if data.startswith('cmd_'):
         command = data.replace('cmd_', '')
@@ -4576,15 +5839,6 @@ def handle_telegram_callback(callback_query):
         elif command == 'rules':
             return handle_rules_command(chat_id)
     
-    # Отправляем подтверждение нажатия кнопки
-    token = get_setting('telegram_bot_token', '')
-    if token:
-        try:
-            api_url = f'https://api.telegram.org/bot{token}/answerCallbackQuery'
-            requests.post(api_url, json={'callback_query_id': callback_query.get('id')}, timeout=5)
-        except:
-            pass
-    
     return jsonify({'ok': True})
 
 def handle_start_command(chat_id, username, full_text):
@@ -4596,45 +5850,8 @@ def handle_start_command(chat_id, username, full_text):
         # Это может быть код верификации или user_id
         return handle_start_with_code(chat_id, username, verification_code)
     
-    # Обычное приветствие
-    welcome_text = (
-        "👋 Добро пожаловать в бота Анонимных Дедов Морозов!\n\n"
-        "Для использования бота необходимо привязать ваш аккаунт.\n"
-        "Перейдите в свой профиль на сайте и запросите код верификации."
-    )
-    
-    # Проверяем, есть ли настроенное меню
-    menu_items = get_telegram_bot_menu()
-    keyboard = None
-    if menu_items:
-        # Формируем inline клавиатуру из меню
-        keyboard = {'inline_keyboard': []}
-        row = []
-        
-        for item in menu_items:
-            button_text = item['button_text']
-            button_type = item['button_type']
-            action = item['action']
-            
-            if button_type == 'command':
-                row.append({'text': button_text, 'callback_data': f'cmd_{action}'})
-            elif button_type == 'url':
-                # Получаем базовый URL сайта
-                base_url = get_base_url()
-                full_url = action if action.startswith('http') else f"{base_url}{action}"
-                row.append({'text': button_text, 'url': full_url})
-            
-            # Добавляем кнопки по 2 в ряд
-            if len(row) >= 2:
-                keyboard['inline_keyboard'].append(row)
-                row = []
-        
-        if row:
-            keyboard['inline_keyboard'].append(row)
-        
-        welcome_text += "\n\n📋 Выберите раздел:"
-    
-    send_telegram_message_with_keyboard(welcome_text, chat_id, keyboard)
+    # Обычное приветствие (с меню, если оно настроено)
+    send_telegram_prepared_message(chat_id, get_compiled_telegram_bot_menu().start_body)
     return jsonify({'ok': True})
 
 def handle_start_with_code(chat_id, username, code):
@@ -4683,38 +5900,7 @@ def handle_start_with_code(chat_id, username, code):
 
 def handle_menu_command(chat_id):
     """Показывает меню бота"""
-    menu_items = get_telegram_bot_menu()
-    if not menu_items:
-        send_telegram_message_with_keyboard("Меню пока не настроено.", chat_id)
-        return jsonify({'ok': True})
-    
-    # Формируем inline клавиатуру
-    keyboard = {'inline_keyboard': []}
-    row = []
-    
-    for item in menu_items:
-        button_text = item['button_text']
-        button_type = item['button_type']
-        action = item['action']
-        
-        if button_type == 'command':
-            row.append({'text': button_text, 'callback_data': f'cmd_{action}'})
-        elif button_type == 'url':
-            # Получаем базовый URL сайта
-            base_url = get_base_url()
-            full_url = action if action.startswith('http') else f"{base_url}{action}"
-            row.append({'text': button_text, 'url': full_url})
-        
-        # Добавляем кнопки по 2 в ряд
-        if len(row) >= 2:
-            keyboard['inline_keyboard'].append(row)
-            row = []
-    
-    if row:
-        keyboard['inline_keyboard'].append(row)
-    
-    menu_text = "📋 Главное меню:\n\nВыберите раздел:"
-    send_telegram_message_with_keyboard(menu_text, chat_id, keyboard)
+    send_telegram_prepared_message(chat_id, get_compiled_telegram_bot_menu().menu_body)
     return jsonify({'ok': True})
 
 def handle_verify_command(chat_id, full_text):
@@ -4734,14 +5920,17 @@ def handle_verify_command(chat_id, full_text):
 
 def handle_verification_code(chat_id, code, username):
     """Обрабатывает код верификации"""
-    conn = get_db_connection()
     try:
         # Ищем пользователя с этим кодом
-        telegram_user = conn.execute('''
-            SELECT user_id, verification_code, verification_code_expires_at
-            FROM telegram_users
-            WHERE verification_code = ? AND verified = 0
-        ''', (code,)).fetchone()
+        conn = get_db_connection()
+        try:
+            telegram_user = conn.execute('''
+                SELECT user_id, verification_code, verification_code_expires_at
+                FROM telegram_users
+                WHERE verification_code = ? AND verified = 0
+            ''', (code,)).fetchone()
+        finally:
+            conn.close()
         
         if not telegram_user:
             send_telegram_message_with_keyboard(
@@ -4785,8 +5974,6 @@ def handle_verification_code(chat_id, code, username):
             chat_id
         )
         return jsonify({'ok': True})
-    finally:
-        conn.close()
 
 def get_base_url():
     """Получает базовый URL сайта"""
@@ -4845,36 +6032,33 @@ def handle_events_command(chat_id):
 
 def handle_assignments_command(chat_id):
     """Показывает задания пользователя"""
-    conn = get_db_connection()
     try:
         # Находим user_id по chat_id
-        telegram_user = conn.execute('''
-            SELECT user_id FROM telegram_users
-            WHERE telegram_chat_id = ? AND verified = 1
-        ''', (str(chat_id),)).fetchone()
+        user_id = get_telegram_chat_user_id(chat_id)
         
-        if not telegram_user:
+        if not user_id:
             send_telegram_message_with_keyboard(
                 "Ваш аккаунт не привязан к Telegram. Используйте /verify для привязки.",
                 chat_id
             )
             return jsonify({'ok': True})
         
-        user_id = telegram_user['user_id']
-        
         # Получаем задания пользователя
-        assignments = conn.execute('''
-            SELECT ea.id, ea.event_id, e.name as event_name,
-                   ea.recipient_user_id, u.username as recipient_username,
-                   ea.santa_sent_at, ea.recipient_received_at
-            FROM event_assignments ea
-            JOIN events e ON ea.event_id = e.id
-            JOIN users u ON ea.recipient_user_id = u.user_id
-            WHERE ea.santa_user_id = ? AND e.deleted_at IS NULL
-            ORDER BY ea.assigned_at DESC
-            LIMIT 10
-        ''', (user_id,)).fetchall()
-        conn.close()
+        conn = get_db_connection()
+        try:
+            assignments = conn.execute('''
+                SELECT ea.id, ea.event_id, e.name as event_name,
+                       ea.recipient_user_id, u.username as recipient_username,
+                       ea.santa_sent_at, ea.recipient_received_at
+                FROM event_assignments ea
+                JOIN events e ON ea.event_id = e.id
+                JOIN users u ON ea.recipient_user_id = u.user_id
+                WHERE ea.santa_user_id = ? AND e.deleted_at IS NULL
+                ORDER BY ea.assigned_at DESC
+                LIMIT 10
+            ''', (user_id,)).fetchall()
+        finally:
+            conn.close()
         
         if not assignments:
             send_telegram_message_with_keyboard(
@@ -4954,32 +6138,54 @@ def admin_test():
 @require_role('admin')
 def admin_users():
     """Управление пользователями"""
-    conn = get_db_connection()
-    users = conn.execute('''
-        SELECT u.*,
-               GROUP_CONCAT(r.display_name, ', ') as roles,
-               (SELECT COUNT(*) FROM user_admin_comments WHERE user_id = u.user_id) as comments_count
-        FROM users u
-        LEFT JOIN user_roles ur ON u.user_id = ur.user_id
-        LEFT JOIN roles r ON ur.role_id = r.id
-        GROUP BY u.user_id
-        ORDER BY u.created_at DESC
-    ''').fetchall()
+    users = query_user_directory(sort_by='created_at', descending=True)
+    role_counts = get_user_directory_role_counts()
     
+    conn = get_db_connection()
     roles = conn.execute('SELECT * FROM roles ORDER BY is_system DESC, display_name').fetchall()
-    roles_with_counts = []
-    for role in roles:
-        count = conn.execute('''
-            SELECT COUNT(*) as count FROM user_roles WHERE role_id = ?
-        ''', (role['id'],)).fetchone()
-        roles_with_counts.append({
-            **dict(role),
-            'user_count': count['count']
-        })
-    
+    awards = conn.execute('SELECT id, title FROM awards ORDER BY sort_order, title').fetchall()
     conn.close()
+    roles_with_counts = [
+        {**dict(role), 'user_count': role_counts.get(role['id'], 0)}
+        for role in roles
+    ]
     
-    return render_template('admin/users.html', users=users, roles=roles_with_counts)
+    titles = get_all_titles()
+    return render_template('admin/users.html', users=users, roles=roles_with_counts, titles=titles, awards=awards)
+
+@app.route('/admin/users/bulk', methods=['POST'])
+@require_role('admin')
+def admin_users_bulk():
+    """Массовое назначение роли/звания/награды или блокировка выбранных пользователей"""
+    operation = request.form.get('operation', '')
+    target = None
+    if operation == 'assign_role':
+        target = request.form.get('role_name')
+    elif operation == 'assign_title':
+        target = request.form.get('title_id')
+    elif operation == 'assign_award':
+        target = request.form.get('award_id')
+
+    result, error = bulk_user_operation(
+        operation,
+        request.form.getlist('user_ids'),
+        target=target,
+        actor_id=session['user_id'],
+        reason=request.form.get('blocked_reason', '').strip() or None
+    )
+    if error:
+        flash(error, 'error')
+        return redirect(url_for('admin_users'))
+
+    message = f'Изменено пользователей: {len(result["changed"])}'
+    if result['unchanged']:
+        message += f', без изменений: {len(result["unchanged"])}'
+    if result['missing']:
+        message += f', не найдено: {len(result["missing"])}'
+    if result['skipped']:
+        message += '. Нельзя заблокировать самого себя'
+    flash(message, 'success' if result['changed'] else 'info')
+    return redirect(url_for('admin_users'))
 
 @app.route('/admin/users/<int:user_id>/impersonate', methods=['POST'])
 @require_role('admin')
@@ -5174,6 +6380,9 @@ def admin_user_create():
             if language not in available_languages:
                 language = 'ru'
             avatar_seed = avatar_seed_form or generate_unique_avatar_seed(user_id_int)
+            if avatar_seed_form and avatar_seed_in_use(avatar_seed_form, conn=conn):
+                flash('Указанный seed аватара уже используется, сгенерирован новый', 'warning')
+                avatar_seed = generate_unique_avatar_seed(user_id_int)
             if not avatar_style or avatar_style not in AVATAR_STYLES:
                 avatar_style = 'avataaars'
             
@@ -5191,6 +6400,7 @@ def admin_user_create():
                   last_name, first_name, middle_name,
                   postal_code, country, city, street, house, building, apartment))
             conn.commit()
+            refresh_user_directory_entry(user_id_int)
             log_activity(
                 'admin_user_create',
                 details=f'Создан пользователь {username} (ID {user_id_int})',
@@ -5278,6 +6488,7 @@ def admin_user_edit(user_id):
                             WHERE user_id = ?
                         ''', (blocked_by, blocked_reason, blocked_at, user_id))
                         conn.commit()
+                        refresh_user_directory_entry(user_id)
                         log_activity(
                             'admin_user_blocked',
                             details=f'Пользователь {user_id} заблокирован',
@@ -5302,6 +6513,7 @@ def admin_user_edit(user_id):
                         WHERE user_id = ?
                     ''', (user_id,))
                     conn.commit()
+                    refresh_user_directory_entry(user_id)
                     log_activity(
                         'admin_user_unblocked',
                         details=f'Пользователь {user_id} разблокирован',
@@ -5410,6 +6622,9 @@ def admin_user_edit(user_id):
                 language = 'ru'
             if not avatar_seed:
                 avatar_seed = user['avatar_seed']
+            elif avatar_seed != user['avatar_seed'] and avatar_seed_in_use(avatar_seed, user_id, conn):
+                flash('Указанный seed аватара уже используется другим пользователем, аватар не изменен', 'warning')
+                avatar_seed = user['avatar_seed']
             if not avatar_style or avatar_style not in AVATAR_STYLES:
                 avatar_style = user['avatar_style'] or 'avataaars'
             conn.execute('''
@@ -5429,6 +6644,7 @@ def admin_user_edit(user_id):
                   avatar_seed, avatar_style, language,
                   user_id))
             conn.commit()
+            refresh_user_directory_entry(user_id)
             log_activity(
                 'admin_user_update',
                 details=f'Обновлены данные пользователя {user_id}',
@@ -5497,6 +6713,85 @@ def admin_user_edit(user_id):
                          available_languages=available_languages,
                          blocker_info=blocker_info)
 
+# ========== Удаление пользователей ==========
+# Ссылки на удаляемых пользователей в служебных колонках (кто назначил, создал,
+# изменил) обнуляются по индексам idx_<таблица>_<колонка> короткой транзакцией.
+# Журнал действий может быть большим, поэтому его записи не трогаются при удалении:
+# пользователь ставится в очередь user_log_anonymization_queue, и cron
+# (anonymize_deleted_user_logs) обезличивает записи порциями.
+
+USER_REFERENCE_COLUMNS = (
+    ('user_roles', 'assigned_by'),
+    ('user_titles', 'assigned_by'),
+    ('user_awards', 'assigned_by'),
+    ('awards', 'created_by'),
+    ('events', 'created_by'),
+    ('event_participant_approvals', 'approved_by'),
+    ('event_assignments', 'assigned_by'),
+    ('faq_categories', 'created_by'),
+    ('faq_categories', 'updated_by'),
+    ('contacts', 'created_by'),
+    ('contacts', 'updated_by'),
+    ('faq_items', 'created_by'),
+    ('faq_items', 'updated_by'),
+    ('settings', 'updated_by'),
+)
+USER_REMOVAL_CHUNK_SIZE = 500
+
+
+def remove_users(conn, user_ids):
+    """Удаляет пользователей и обнуляет ссылки на них (без commit). Возвращает id удаленных"""
+    user_ids = _unique_user_ids(user_ids)
+    removed = []
+    for start in range(0, len(user_ids), USER_REMOVAL_CHUNK_SIZE):
+        chunk = user_ids[start:start + USER_REMOVAL_CHUNK_SIZE]
+        placeholders = ','.join(['?'] * len(chunk))
+        existing = [
+            row['user_id']
+            for row in conn.execute(f'SELECT user_id FROM users WHERE user_id IN ({placeholders})', chunk)
+        ]
+        if not existing:
+            continue
+        placeholders = ','.join(['?'] * len(existing))
+        for table_name, column in USER_REFERENCE_COLUMNS:
+            conn.execute(f'UPDATE {table_name} SET {column} = NULL WHERE {column} IN ({placeholders})', existing)
+        conn.execute(f'DELETE FROM telegram_users WHERE user_id IN ({placeholders})', existing)
+        conn.execute(f'DELETE FROM users WHERE user_id IN ({placeholders})', existing)
+        invalidate_telegram_chat(user_ids=existing)
+        conn.executemany('''
+            INSERT INTO user_log_anonymization_queue (user_id, deleted_before)
+            VALUES (?, CURRENT_TIMESTAMP)
+            ON CONFLICT(user_id) DO UPDATE SET
+                deleted_before = excluded.deleted_before,
+                requested_at = CURRENT_TIMESTAMP
+        ''', [(user_id,) for user_id in existing])
+        removed.extend(existing)
+    return removed
+
+
+def find_inactive_user_ids(conn, inactive_since, limit=None):
+    """Пользователи без входа с inactive_since, не участвовавшие в мероприятиях и не администраторы"""
+    query = '''
+        SELECT u.user_id
+        FROM users u
+        WHERE COALESCE(u.last_login, u.created_at) < ?
+          AND NOT EXISTS (
+              SELECT 1 FROM user_roles ur
+              JOIN roles r ON r.id = ur.role_id
+              WHERE ur.user_id = u.user_id AND r.name = 'admin'
+          )
+          AND NOT EXISTS (SELECT 1 FROM event_registrations er WHERE er.user_id = u.user_id)
+          AND NOT EXISTS (SELECT 1 FROM event_assignments ea WHERE ea.santa_user_id = u.user_id)
+          AND NOT EXISTS (SELECT 1 FROM event_assignments ea WHERE ea.recipient_user_id = u.user_id)
+        ORDER BY u.user_id
+    '''
+    params = [inactive_since]
+    if limit:
+        query += ' LIMIT ?'
+        params.append(limit)
+    return [row['user_id'] for row in conn.execute(query, params)]
+
+
 @app.route('/admin/users/<int:user_id>/delete', methods=['POST'])
 @require_role('admin')
 def admin_user_delete(user_id):
@@ -5516,23 +6811,10 @@ def admin_user_delete(user_id):
         username = user['username']
 
         conn.execute('BEGIN')
-        conn.execute('UPDATE user_roles SET assigned_by = NULL WHERE assigned_by = ?', (user_id,))
-        conn.execute('UPDATE user_titles SET assigned_by = NULL WHERE assigned_by = ?', (user_id,))
-        conn.execute('UPDATE user_awards SET assigned_by = NULL WHERE assigned_by = ?', (user_id,))
-        conn.execute('UPDATE awards SET created_by = NULL WHERE created_by = ?', (user_id,))
-        conn.execute('UPDATE events SET created_by = NULL WHERE created_by = ?', (user_id,))
-        conn.execute('UPDATE activity_logs SET user_id = NULL WHERE user_id = ?', (user_id,))
-        conn.execute('UPDATE event_participant_approvals SET approved_by = NULL WHERE approved_by = ?', (user_id,))
-        conn.execute('UPDATE event_assignments SET assigned_by = NULL WHERE assigned_by = ?', (user_id,))
-        conn.execute('UPDATE faq_categories SET created_by = NULL WHERE created_by = ?', (user_id,))
-        conn.execute('UPDATE faq_categories SET updated_by = NULL WHERE updated_by = ?', (user_id,))
-        conn.execute('UPDATE contacts SET created_by = NULL WHERE created_by = ?', (user_id,))
-        conn.execute('UPDATE contacts SET updated_by = NULL WHERE updated_by = ?', (user_id,))
-        conn.execute('UPDATE faq_items SET created_by = NULL WHERE created_by = ?', (user_id,))
-        conn.execute('UPDATE faq_items SET updated_by = NULL WHERE updated_by = ?', (user_id,))
-        conn.execute('UPDATE settings SET updated_by = NULL WHERE updated_by = ?', (user_id,))
-        conn.execute('DELETE FROM users WHERE user_id = ?', (user_id,))
+        # Записи журнала обезличиваются позже порциями (см. anonymize_deleted_user_logs в cron_tasks)
+        remove_users(conn, [user_id])
         conn.commit()
+        refresh_user_directory_entry(user_id)
     except Exception as e:
         try:
             conn.rollback()
@@ -5703,6 +6985,7 @@ def admin_role_edit(role_id):
                     assign_permission_to_role(role_id, perm_id)
             
             conn.commit()
+            invalidate_user_directory()
             flash('Роль успешно обновлена', 'success')
             conn.close()
             return redirect(url_for('admin_roles'))
@@ -5738,6 +7021,7 @@ def admin_role_delete(role_id):
     try:
         conn.execute('DELETE FROM roles WHERE id = ?', (role_id,))
         conn.commit()
+        invalidate_user_directory()
         flash('Роль успешно удалена', 'success')
     except Exception as e:
         log_error(f"Error deleting role: {e}")
@@ -6049,6 +7333,8 @@ def admin_settings():
                 log_error(f"Error updating setting {key}: {e}")
         
         conn.commit()
+        invalidate_telegram_bot_settings()
+        invalidate_telegram_bot_menu()
         # Возвращаем иконку/логотип к дефолтной эмодзи
         conn.execute('''
             UPDATE settings 
@@ -6464,6 +7750,7 @@ def verify_telegram():
                 conn.execute('UPDATE settings SET value = ? WHERE key = ?', (chat_id, 'telegram_chat_id'))
             conn.execute('UPDATE settings SET value = ? WHERE key = ?', ('1', 'telegram_verified'))
             conn.commit()
+            invalidate_telegram_bot_settings()
         except Exception as e:
             log_error(f"Error saving Telegram settings: {e}")
             conn.close()
@@ -6472,6 +7759,28 @@ def verify_telegram():
     
     return jsonify({'success': success, 'message': message})
 
+_telegram_http_session = None
+_telegram_http_lock = threading.Lock()
+
+
+def get_telegram_http_session():
+    """Общая HTTP-сессия для отправки в Telegram: соединение с API переиспользуется"""
+    global _telegram_http_session
+    with _telegram_http_lock:
+        if _telegram_http_session is None:
+            _telegram_http_session = requests.Session()
+        return _telegram_http_session
+
+def _telegram_send_result(response):
+    """Результат sendMessage: (success, message)"""
+    if response.status_code == 200:
+        result = response.json()
+        if result.get('ok'):
+            return True, "Сообщение успешно отправлено"
+        error_desc = result.get('description', 'Неизвестная ошибка')
+        return False, f"Ошибка отправки: {error_desc}"
+    return False, f"Ошибка отправки: HTTP {response.status_code}"
+
 def send_telegram_message(message, chat_id=None, parse_mode=None):
     """Отправляет сообщение через Telegram бота
     
@@ -6496,7 +7805,7 @@ def send_telegram_message(message, chat_id=None, parse_mode=None):
     if not telegram_verified:
         return False, "Telegram бот не проверен. Проверьте подключение в настройках"
     
-    token = get_setting('telegram_bot_token', '')
+    token = get_telegram_bot_token()
     if not token:
         return False, "Токен бота не настроен"
     
@@ -6514,19 +7823,9 @@ def send_telegram_message(message, chat_id=None, parse_mode=None):
         if parse_mode:
             data['parse_mode'] = parse_mode
         
-        response = requests.post(api_url, json=data, timeout=10)
+        response = get_telegram_http_session().post(api_url, json=data, timeout=10)
         
-        if response.status_code == 200:
-            result = response.json()
-            if result.get('ok'):
-                return True, "Сообщение успешно отправлено"
-            else:
-                error_desc = result.get('description', 'Неизвестная ошибка')
-                return False, f"Ошибка отправки: {error_desc}"
-        else:
-            error_data = response.json() if response.status_code == 200 else {}
-            error_desc = error_data.get('description', f'HTTP {response.status_code}')
-            return False, f"Ошибка отправки: {error_desc}"
+        return _telegram_send_result(response)
             
     except requests.exceptions.Timeout:
         return False, "Таймаут при отправке сообщения"
@@ -6551,7 +7850,7 @@ def send_telegram_message_with_keyboard(message, chat_id, keyboard=None, parse_m
     if not requests:
         return False, "Библиотека requests не установлена"
     
-    token = get_setting('telegram_bot_token', '')
+    token = get_telegram_bot_token()
     if not token:
         return False, "Токен бота не настроен"
     
@@ -6566,24 +7865,120 @@ def send_telegram_message_with_keyboard(message, chat_id, keyboard=None, parse_m
         if keyboard:
             data['reply_markup'] = keyboard
         
-        response = requests.post(api_url, json=data, timeout=10)
+        response = get_telegram_http_session().post(api_url, json=data, timeout=10)
         
-        if response.status_code == 200:
-            result = response.json()
-            if result.get('ok'):
-                return True, "Сообщение успешно отправлено"
-            else:
-                error_desc = result.get('description', 'Неизвестная ошибка')
-                return False, f"Ошибка отправки: {error_desc}"
-        else:
-            error_data = response.json() if response.status_code == 200 else {}
-            error_desc = error_data.get('description', f'HTTP {response.status_code}')
-            return False, f"Ошибка отправки: {error_desc}"
+        return _telegram_send_result(response)
             
     except Exception as e:
         log_error(f"Error sending Telegram message with keyboard: {e}")
         return False, f"Ошибка при отправке: {str(e)}"
 
+# ========== Привязки чатов Telegram ==========
+# Команды бота находят пользователя по chat_id через частичный индекс
+# idx_telegram_users_chat по CAST(telegram_chat_id AS INTEGER) среди подтвержденных
+# привязок. Найденные привязки кешируются в процессе (LRU на TELEGRAM_CHAT_CACHE_SIZE
+# чатов); кеш сбрасывается при привязке, отвязке и новом коде верификации, а запись
+# живет не дольше TELEGRAM_CHAT_CACHE_TTL_SECONDS, чтобы подхватить изменения из
+# других процессов. Токен и флаги бота кешируются так же (TELEGRAM_SETTINGS_TTL_SECONDS).
+
+TELEGRAM_CHAT_CACHE_SIZE = 4096
+TELEGRAM_CHAT_CACHE_TTL_SECONDS = 300
+TELEGRAM_SETTINGS_TTL_SECONDS = 60
+
+_telegram_chat_cache = OrderedDict()
+_telegram_chat_cache_generation = 0
+_telegram_chat_cache_lock = threading.Lock()
+_telegram_bot_settings = None
+_telegram_bot_settings_loaded_at = None
+
+
+def _telegram_chat_key(chat_id):
+    try:
+        return int(chat_id)
+    except (TypeError, ValueError):
+        return None
+
+
+def get_telegram_chat_user_id(chat_id):
+    """user_id подтвержденной привязки чата или None"""
+    key = _telegram_chat_key(chat_id)
+    if key is None:
+        return None
+    now = time.monotonic()
+    with _telegram_chat_cache_lock:
+        cached = _telegram_chat_cache.get(key)
+        if cached and now - cached[1] < TELEGRAM_CHAT_CACHE_TTL_SECONDS:
+            _telegram_chat_cache.move_to_end(key)
+            return cached[0]
+        generation = _telegram_chat_cache_generation
+
+    conn = get_db_connection()
+    try:
+        # При нескольких привязках одного чата действует последняя
+        row = conn.execute('''
+            SELECT user_id FROM telegram_users
+            WHERE CAST(telegram_chat_id AS INTEGER) = ? AND verified = 1
+            ORDER BY verified_at DESC
+            LIMIT 1
+        ''', (key,)).fetchone()
+    finally:
+        conn.close()
+
+    with _telegram_chat_cache_lock:
+        # Пока шел запрос, привязки могли измениться - тогда результат не кешируем
+        if generation == _telegram_chat_cache_generation:
+            if row:
+                _telegram_chat_cache[key] = (row['user_id'], now)
+                _telegram_chat_cache.move_to_end(key)
+                while len(_telegram_chat_cache) > TELEGRAM_CHAT_CACHE_SIZE:
+                    _telegram_chat_cache.popitem(last=False)
+            else:
+                _telegram_chat_cache.pop(key, None)
+    return row['user_id'] if row else None
+
+
+def invalidate_telegram_chat(chat_id=None, user_ids=()):
+    """Сбрасывает кешированные привязки чата и/или пользователей"""
+    global _telegram_chat_cache_generation
+    key = _telegram_chat_key(chat_id)
+    user_ids = set(user_ids)
+    with _telegram_chat_cache_lock:
+        _telegram_chat_cache_generation += 1
+        if key is not None:
+            _telegram_chat_cache.pop(key, None)
+        if user_ids:
+            for cached_key in [k for k, (user_id, _) in _telegram_chat_cache.items() if user_id in user_ids]:
+                del _telegram_chat_cache[cached_key]
+
+
+def get_telegram_bot_settings():
+    """Токен и флаги бота из настроек (кешируются на TELEGRAM_SETTINGS_TTL_SECONDS)"""
+    global _telegram_bot_settings, _telegram_bot_settings_loaded_at
+    now = time.monotonic()
+    with _telegram_chat_cache_lock:
+        if (_telegram_bot_settings_loaded_at is not None
+                and now - _telegram_bot_settings_loaded_at < TELEGRAM_SETTINGS_TTL_SECONDS):
+            return _telegram_bot_settings
+    settings = {
+        'token': get_setting('telegram_bot_token', ''),
+        'enabled': get_setting('telegram_enabled', '0') == '1',
+        'verified': get_setting('telegram_verified', '0') == '1',
+    }
+    with _telegram_chat_cache_lock:
+        _telegram_bot_settings, _telegram_bot_settings_loaded_at = settings, now
+    return settings
+
+
+def get_telegram_bot_token():
+    return get_telegram_bot_settings()['token']
+
+
+def invalidate_telegram_bot_settings():
+    global _telegram_bot_settings_loaded_at
+    with _telegram_chat_cache_lock:
+        _telegram_bot_settings_loaded_at = None
+
+
 def generate_telegram_verification_code(user_id):
     """Генерирует код верификации для пользователя"""
     conn = get_db_connection()
@@ -6594,14 +7989,15 @@ def generate_telegram_verification_code(user_id):
         
         # Сохраняем или обновляем код
         conn.execute('''
-            INSERT INTO telegram_users (user_id, verification_code, verification_code_expires_at)
-            VALUES (?, ?, ?)
+            INSERT INTO telegram_users (user_id, telegram_chat_id, verification_code, verification_code_expires_at)
+            VALUES (?, '', ?, ?)
             ON CONFLICT(user_id) DO UPDATE SET
                 verification_code = excluded.verification_code,
                 verification_code_expires_at = excluded.verification_code_expires_at,
                 verified = 0
         ''', (user_id, code, expires_at))
         conn.commit()
+        invalidate_telegram_chat(user_ids=[user_id])
         return code
     except Exception as e:
         log_error(f"Error generating verification code: {e}")
@@ -6648,6 +8044,7 @@ def verify_telegram_code(user_id, code, telegram_chat_id, telegram_username=None
             WHERE user_id = ?
         ''', (telegram_chat_id, telegram_username, user_id))
         conn.commit()
+        invalidate_telegram_chat(telegram_chat_id, user_ids=[user_id])
         
         return True, "Telegram успешно привязан к вашему аккаунту!"
     except Exception as e:
@@ -6680,47 +8077,16 @@ def set_telegram_bot_commands(token):
         return False
     
     try:
-        menu_items = get_telegram_bot_menu()
-        if not menu_items:
-            # Если меню не настроено, устанавливаем базовые команды
-            commands = [
-                {'command': 'start', 'description': 'Начать работу с ботом'},
-                {'command': 'menu', 'description': 'Показать главное меню'},
-                {'command': 'verify', 'description': 'Привязать аккаунт'},
-            ]
-        else:
-            # Формируем команды из меню
-            commands = []
-            for item in menu_items:
-                if item['button_type'] == 'command':
-                    action = item['action']
-                    button_text = item['button_text']
-                    # Создаем команду только для основных действий
-                    if action in ['events', 'assignments', 'faq', 'rules']:
-                        commands.append({
-                            'command': action,
-                            'description': button_text[:32]  # Максимум 32 символа
-                        })
-            
-            # Всегда добавляем базовые команды
-            base_commands = [
-                {'command': 'start', 'description': 'Начать работу с ботом'},
-                {'command': 'menu', 'description': 'Показать главное меню'},
-            ]
-            # Объединяем, избегая дубликатов
-            existing_commands = {cmd['command'] for cmd in commands}
-            for base_cmd in base_commands:
-                if base_cmd['command'] not in existing_commands:
-                    commands.append(base_cmd)
-        
-        # Устанавливаем команды через API
+        menu = get_compiled_telegram_bot_menu()
         api_url = f'https://api.telegram.org/bot{token}/setMyCommands'
-        response = requests.post(api_url, json={'commands': commands}, timeout=10)
+        response = get_telegram_http_session().post(
+            api_url, data=menu.commands_json, headers=_TELEGRAM_JSON_HEADERS, timeout=10
+        )
         
         if response.status_code == 200:
             result = response.json()
             if result.get('ok'):
-                log_debug(f"Bot commands set successfully: {len(commands)} commands")
+                log_debug(f"Bot commands set successfully: {len(menu.commands)} commands")
                 return True
             else:
                 log_error(f"Failed to set bot commands: {result.get('description')}")
@@ -6732,20 +8098,157 @@ def set_telegram_bot_commands(token):
         log_error(f"Error setting Telegram bot commands: {e}")
         return False
 
-def send_email_via_smtp(to_email, subject, body, html_body=None):
-    """Отправляет email через настроенный SMTP сервер"""
+# ========== Меню бота ==========
+# Активные пункты telegram_bot_menu собираются один раз в CompiledBotMenu: клавиатура,
+# команды для setMyCommands и готовые тела sendMessage для /start и /menu (JSON в
+# байтах без chat_id). Команды бота дописывают chat_id в начало тела и отправляют
+# его как есть, без запросов к БД и повторной сериализации. Меню пересобирается после
+# правок в admin_telegram_menu и сохранения настроек (ссылки зависят от site_url),
+# в других процессах - не позже чем через TELEGRAM_MENU_TTL_SECONDS.
+
+TELEGRAM_MENU_TTL_SECONDS = 300
+TELEGRAM_MENU_ROW_SIZE = 2
+TELEGRAM_MENU_COMMANDS = ('events', 'assignments', 'faq', 'rules')
+TELEGRAM_BASE_COMMANDS = (
+    {'command': 'start', 'description': 'Начать работу с ботом'},
+    {'command': 'menu', 'description': 'Показать главное меню'},
+)
+TELEGRAM_WELCOME_TEXT = (
+    "👋 Добро пожаловать в бота Анонимных Дедов Морозов!\n\n"
+    "Для использования бота необходимо привязать ваш аккаунт.\n"
+    "Перейдите в свой профиль на сайте и запросите код верификации."
+)
+
+_TELEGRAM_JSON_HEADERS = {'Content-Type': 'application/json'}
+
+_telegram_menu = None
+_telegram_menu_built_at = None
+_telegram_menu_generation = 0
+_telegram_menu_lock = threading.Lock()
+
+
+def _compact_json_bytes(value):
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def _message_body_tail(text, keyboard=None):
+    """Тело sendMessage без chat_id: b',"text":...}' (см. send_telegram_prepared_message)"""
+    body = {'text': text}
+    if keyboard:
+        body['reply_markup'] = keyboard
+    return b',' + _compact_json_bytes(body)[1:]
+
+
+class CompiledBotMenu:
+    """Меню бота, собранное в готовые к отправке данные"""
+    __slots__ = ('items', 'keyboard', 'commands', 'commands_json', 'start_body', 'menu_body')
+
+    def __init__(self, items, base_url):
+        self.items = tuple(items)
+        self.keyboard = None
+        if self.items:
+            rows = []
+            row = []
+            for item in self.items:
+                if item['button_type'] == 'command':
+                    row.append({'text': item['button_text'], 'callback_data': f"cmd_{item['action']}"})
+                elif item['button_type'] == 'url':
+                    action = item['action']
+                    full_url = action if action.startswith('http') else f"{base_url}{action}"
+                    row.append({'text': item['button_text'], 'url': full_url})
+                if len(row) >= TELEGRAM_MENU_ROW_SIZE:
+                    rows.append(row)
+                    row = []
+            if row:
+                rows.append(row)
+            self.keyboard = {'inline_keyboard': rows}
+
+        if self.items:
+            # Команды из меню (только основные действия) и базовые команды без дубликатов
+            commands = [
+                {'command': item['action'], 'description': item['button_text'][:32]}
+                for item in self.items
+                if item['button_type'] == 'command' and item['action'] in TELEGRAM_MENU_COMMANDS
+            ]
+            existing_commands = {command['command'] for command in commands}
+            commands.extend(dict(command) for command in TELEGRAM_BASE_COMMANDS
+                            if command['command'] not in existing_commands)
+        else:
+            # Если меню не настроено, устанавливаем базовые команды
+            commands = [dict(command) for command in TELEGRAM_BASE_COMMANDS]
+            commands.append({'command': 'verify', 'description': 'Привязать аккаунт'})
+        self.commands = commands
+        self.commands_json = _compact_json_bytes({'commands': commands})
+
+        if self.items:
+            self.start_body = _message_body_tail(TELEGRAM_WELCOME_TEXT + "\n\n📋 Выберите раздел:", self.keyboard)
+            self.menu_body = _message_body_tail("📋 Главное меню:\n\nВыберите раздел:", self.keyboard)
+        else:
+            self.start_body = _message_body_tail(TELEGRAM_WELCOME_TEXT)
+            self.menu_body = _message_body_tail("Меню пока не настроено.")
+
+
+def get_compiled_telegram_bot_menu():
+    """Собранное меню бота из кеша (пересобирается после invalidate или по TTL)"""
+    global _telegram_menu, _telegram_menu_built_at
+    now = time.monotonic()
+    with _telegram_menu_lock:
+        if _telegram_menu is not None and now - _telegram_menu_built_at < TELEGRAM_MENU_TTL_SECONDS:
+            return _telegram_menu
+        generation = _telegram_menu_generation
+    menu = CompiledBotMenu(
+        [{'button_text': row['button_text'], 'button_type': row['button_type'], 'action': row['action']}
+         for row in get_telegram_bot_menu()],
+        get_base_url()
+    )
+    with _telegram_menu_lock:
+        if generation == _telegram_menu_generation:
+            _telegram_menu, _telegram_menu_built_at = menu, now
+    return menu
+
+
+def invalidate_telegram_bot_menu():
+    global _telegram_menu, _telegram_menu_generation
+    with _telegram_menu_lock:
+        _telegram_menu = None
+        _telegram_menu_generation += 1
+
+
+def send_telegram_prepared_message(chat_id, body_tail):
+    """Отправляет готовое тело sendMessage (например, CompiledBotMenu.menu_body) в чат"""
+    if not requests:
+        return False, "Библиотека requests не установлена"
+    
+    token = get_telegram_bot_token()
+    if not token:
+        return False, "Токен бота не настроен"
+    
+    if isinstance(chat_id, int):
+        chat_json = str(chat_id).encode('ascii')
+    else:
+        chat_json = _compact_json_bytes(str(chat_id))
+    try:
+        api_url = f'https://api.telegram.org/bot{token}/sendMessage'
+        response = get_telegram_http_session().post(
+            api_url, data=b'{"chat_id":' + chat_json + body_tail, headers=_TELEGRAM_JSON_HEADERS, timeout=10
+        )
+        return _telegram_send_result(response)
+    except Exception as e:
+        log_error(f"Error sending prepared Telegram message: {e}")
+        return False, f"Ошибка при отправке: {str(e)}"
+
+def open_smtp_connection():
+    """Подключается к настроенному SMTP серверу. Возвращает (server, from_email, ошибка)"""
     import smtplib
-    from email.mime.text import MIMEText
-    from email.mime.multipart import MIMEMultipart
     
     # Получаем настройки SMTP
     smtp_enabled = get_setting('smtp_enabled', '0') == '1'
     if not smtp_enabled:
-        return False, "SMTP не включен в настройках"
+        return None, None, "SMTP не включен в настройках"
     
     smtp_verified = get_setting('smtp_verified', '0') == '1'
     if not smtp_verified:
-        return False, "SMTP не проверен. Проверьте подключение в настройках"
+        return None, None, "SMTP не проверен. Проверьте подключение в настройках"
     
     smtp_host = get_setting('smtp_host', '')
     smtp_port = get_setting('smtp_port', '587')
@@ -6756,15 +8259,55 @@ def send_email_via_smtp(to_email, subject, body, html_body=None):
     smtp_from_name = get_setting('smtp_from_name', 'Анонимные Деды Морозы')
     
     if not smtp_host or not smtp_username or not smtp_password or not smtp_from_email:
-        return False, "SMTP настройки неполные. Проверьте настройки в админ-панели"
+        return None, None, "SMTP настройки неполные. Проверьте настройки в админ-панели"
     
     try:
         port_int = int(smtp_port)
         
+        # Подключаемся к SMTP серверу
+        if smtp_use_tls:
+            server = smtplib.SMTP(smtp_host, port_int, timeout=10)
+            server.starttls()
+        else:
+            if port_int == 465:
+                server = smtplib.SMTP_SSL(smtp_host, port_int, timeout=10)
+            else:
+                server = smtplib.SMTP(smtp_host, port_int, timeout=10)
+        
+        server.login(smtp_username, smtp_password)
+        return server, f"{smtp_from_name} <{smtp_from_email}>", None
+    
+    except smtplib.SMTPAuthenticationError:
+        return None, None, "Ошибка аутентификации SMTP. Проверьте логин и пароль"
+    except smtplib.SMTPException as e:
+        return None, None, f"Ошибка SMTP: {str(e)}"
+    except Exception as e:
+        log_error(f"Error connecting to SMTP: {e}")
+        return None, None, f"Ошибка подключения к SMTP: {str(e)}"
+
+def send_email_via_smtp(to_email, subject, body, html_body=None, connection=None):
+    """Отправляет email через настроенный SMTP сервер
+    
+    connection - (server, from_email) из open_smtp_connection, чтобы отправить
+    несколько писем за одно подключение; без него подключение открывается на одно письмо.
+    """
+    import smtplib
+    from email.utils import parseaddr
+    from email.mime.text import MIMEText
+    from email.mime.multipart import MIMEMultipart
+    
+    if connection:
+        server, from_email = connection
+    else:
+        server, from_email, error = open_smtp_connection()
+        if error:
+            return False, error
+    
+    try:
         # Создаем сообщение
         msg = MIMEMultipart('alternative')
         msg['Subject'] = subject
-        msg['From'] = f"{smtp_from_name} <{smtp_from_email}>"
+        msg['From'] = from_email
         msg['To'] = to_email
         
         # Добавляем текстовую и HTML версию
@@ -6777,30 +8320,20 @@ def send_email_via_smtp(to_email, subject, body, html_body=None):
             part = MIMEText(body, 'plain', 'utf-8')
             msg.attach(part)
         
-        # Подключаемся к SMTP серверу
-        if smtp_use_tls:
-            server = smtplib.SMTP(smtp_host, port_int, timeout=10)
-            server.starttls()
-        else:
-            if port_int == 465:
-                server = smtplib.SMTP_SSL(smtp_host, port_int, timeout=10)
-            else:
-                server = smtplib.SMTP(smtp_host, port_int, timeout=10)
-        
-        # Авторизуемся и отправляем
-        server.login(smtp_username, smtp_password)
-        server.sendmail(smtp_from_email, [to_email], msg.as_string())
-        server.quit()
-        
+        server.sendmail(parseaddr(from_email)[1], [to_email], msg.as_string())
         return True, "Письмо успешно отправлено"
         
-    except smtplib.SMTPAuthenticationError:
-        return False, "Ошибка аутентификации SMTP. Проверьте логин и пароль"
     except smtplib.SMTPException as e:
         return False, f"Ошибка SMTP: {str(e)}"
     except Exception as e:
         log_error(f"Error sending email: {e}")
         return False, f"Ошибка при отправке письма: {str(e)}"
+    finally:
+        if not connection:
+            try:
+                server.quit()
+            except Exception:
+                pass
 
 def init_default_modal_texts():
     """Инициализирует дефолтные тексты модальных окон для регистрации на мероприятия"""
@@ -7644,38 +9177,26 @@ def distribute_event_awards(event_id, require_sent=False):
             SELECT DISTINCT user_id FROM event_registrations WHERE event_id = ?
         ''', (event_id,)).fetchall()
     
+    conn.close()
     if not participants:
-        conn.close()
         return False
     
-    # Выдаем награду каждому участнику
-    admin_user_id = session.get('user_id') or 1  # Используем текущего пользователя или системного
-    awarded_count = 0
-    
-    for participant in participants:
-        user_id = participant['user_id']
-        try:
-            # Проверяем, не выдана ли уже награда
-            existing = conn.execute('''
-                SELECT id FROM user_awards WHERE user_id = ? AND award_id = ?
-            ''', (user_id, award_id)).fetchone()
-            
-            if not existing:
-                conn.execute('''
-                    INSERT INTO user_awards (user_id, award_id, assigned_by)
-                    VALUES (?, ?, ?)
-                ''', (user_id, award_id, admin_user_id))
-                awarded_count += 1
-        except sqlite3.IntegrityError:
-            pass  # Награда уже выдана
-        except Exception as e:
-            log_error(f"Error awarding user {user_id} with award {award_id}: {e}")
+    # Выдаем награду всем участникам одной операцией
+    # Используем текущего пользователя или системного (переходы этапов выполняются вне запроса)
+    admin_user_id = (session.get('user_id') if has_request_context() else None) or 1
+    result, error = bulk_user_operation(
+        'assign_award',
+        [participant['user_id'] for participant in participants],
+        target=award_id,
+        actor_id=admin_user_id
+    )
+    if error:
+        log_error(f"Error distributing award {award_id} for event {event_id}: {error}")
+        return False
     
+    awarded_count = len(result['changed'])
     if awarded_count > 0:
-        conn.commit()
         log_debug(f"Distributed {awarded_count} awards for event {event_id} (require_sent={require_sent})")
-    
-    conn.close()
     return awarded_count > 0
 def get_current_event_stage(event_id):
     """Определяет текущий этап мероприятия на основе текущей даты"""
@@ -7701,24 +9222,7 @@ def get_current_event_stage(event_id):
     
     now = get_event_now()
     
-    # Проверяем, начался ли этап "Закрытие регистрации" - если да, создаем записи для ревью
-    registration_closed_stage = None
-    for stage in stages:
-        if stage['stage_type'] == 'registration_closed' and stage['start_datetime']:
-            try:
-                start_dt = datetime.strptime(stage['start_datetime'], '%Y-%m-%d %H:%M:%S')
-            except:
-                try:
-                    start_dt = datetime.strptime(stage['start_datetime'], '%Y-%m-%dT%H:%M')
-                except:
-                    continue
-            if now >= start_dt:
-                registration_closed_stage = stage
-                break
-    
-    # Если регистрация закрылась, создаем записи для ревью
-    if registration_closed_stage:
-        create_participant_approvals_for_event(event_id)
+    # Записи для ревью при закрытии регистрации создает run_stage_transitions (cron)
     
     # Создаем словарь этапов с их информацией
     stages_dict = {stage['stage_type']: dict(stage) for stage in stages}
@@ -7799,66 +9303,155 @@ def get_current_event_stage(event_id):
     
     return current_stage
 
-def get_event_gifts_statistics(event_id):
-    """Получает статистику по подаркам для мероприятия"""
-    conn = get_db_connection()
-    try:
-        # Всего назначений (сколько подарков должно быть отправлено)
-        total_result = conn.execute('''
-            SELECT COUNT(*) as count
-            FROM event_assignments
-            WHERE event_id = ?
-        ''', (event_id,)).fetchone()
-        total_assignments = total_result['count'] if total_result else 0
-        
-        # Отправлено, но не подтверждено получение
-        # Учитываем только явно отмеченные (santa_sent_at) - нажатие кнопки "Отправил"
-        # Сообщения не считаются признаком отправки подарка
-        sent_not_received_result = conn.execute('''
-            SELECT COUNT(DISTINCT ea.id) as count
-            FROM event_assignments ea
-            WHERE ea.event_id = ?
-              AND (ea.santa_sent_at IS NOT NULL AND ea.santa_sent_at != '')
-              AND (ea.recipient_received_at IS NULL OR ea.recipient_received_at = '')
-        ''', (event_id,)).fetchone()
-        sent_not_received = sent_not_received_result['count'] if sent_not_received_result else 0
-        
-        # Отправлено и подтверждено получение
-        # Учитываем только явно отмеченные (santa_sent_at) - нажатие кнопки "Отправил"
-        # Сообщения не считаются признаком отправки подарка
-        sent_and_received_result = conn.execute('''
-            SELECT COUNT(DISTINCT ea.id) as count
-            FROM event_assignments ea
-            WHERE ea.event_id = ?
-              AND (ea.santa_sent_at IS NOT NULL AND ea.santa_sent_at != '')
-              AND ea.recipient_received_at IS NOT NULL
-              AND ea.recipient_received_at != ''
-        ''', (event_id,)).fetchone()
-        sent_and_received = sent_and_received_result['count'] if sent_and_received_result else 0
-        
-        # Не отправлено
-        not_sent = total_assignments - sent_not_received - sent_and_received
-        
-        # Логирование для отладки
-        log_debug(f"Event {event_id} gifts stats: total={total_assignments}, sent_not_received={sent_not_received}, sent_and_received={sent_and_received}, not_sent={not_sent}")
-        
-        return {
-            'total': total_assignments,
+# ========== Сводные показатели мероприятия ==========
+# Подарки (всего/отправлено/получено/не отправлено) и группы участников
+# (pre/main/позитив/негатив/N/A) считаются одним SQL-запросом через SUM(CASE ...)
+# и кэшируются на EVENT_AGGREGATES_TTL_SECONDS. Кэш сбрасывается при отметке
+# отправки/получения подарка, ревью участника и сохранении распределения.
+
+EVENT_AGGREGATES_TTL_SECONDS = 60
+_event_aggregates_cache = {}
+_event_aggregates_lock = threading.Lock()
+
+# Этап регистрации (pre/main) и статус ревью (approved/rejected/pending) для каждого
+# участника мероприятия; используется и в сводке, и в списке участников
+_EVENT_PARTICIPANT_BUCKETS_CTE = '''
+    stage_bounds AS (
+        SELECT
+            MAX(CASE WHEN stage_type = 'pre_registration' THEN datetime(start_datetime) END) AS pre_start,
+            MAX(CASE WHEN stage_type = 'main_registration' THEN datetime(start_datetime) END) AS main_start,
+            MAX(CASE WHEN stage_type = 'registration_closed' THEN datetime(start_datetime) END) AS closed_start
+        FROM event_stages
+        WHERE event_id = :event_id
+    ),
+    participant_buckets AS (
+        SELECT
+            p.user_id,
+            CASE
+                WHEN p.registered_dt IS NULL THEN 'main'
+                WHEN sb.closed_start IS NOT NULL AND p.registered_dt >= sb.closed_start THEN 'main'
+                WHEN sb.pre_start IS NOT NULL AND sb.main_start IS NOT NULL THEN
+                    CASE WHEN p.registered_dt >= sb.pre_start AND p.registered_dt < sb.main_start
+                         THEN 'pre' ELSE 'main' END
+                WHEN sb.pre_start IS NOT NULL THEN
+                    CASE WHEN p.registered_dt < sb.pre_start THEN 'pre' ELSE 'main' END
+                WHEN sb.main_start IS NOT NULL THEN
+                    CASE WHEN p.registered_dt < sb.main_start THEN 'pre' ELSE 'main' END
+                ELSE 'main'
+            END AS stage,
+            CASE
+                WHEN p.approved = 1 THEN 'approved'
+                WHEN p.approved = 0 AND COALESCE(p.approved_at, '') != '' THEN 'rejected'
+                ELSE 'pending'
+            END AS approval_status
+        FROM (
+            SELECT er.user_id, datetime(er.registered_at) AS registered_dt, epa.approved, epa.approved_at
+            FROM event_registrations er
+            LEFT JOIN event_participant_approvals epa
+                ON epa.event_id = er.event_id AND epa.user_id = er.user_id
+            WHERE er.event_id = :event_id
+        ) p
+        CROSS JOIN stage_bounds sb
+    )
+'''
+
+_EVENT_AGGREGATES_QUERY = f'''
+    WITH {_EVENT_PARTICIPANT_BUCKETS_CTE},
+    gifts AS (
+        SELECT
+            COUNT(*) AS total,
+            SUM(CASE WHEN COALESCE(santa_sent_at, '') != '' AND COALESCE(recipient_received_at, '') = ''
+                     THEN 1 ELSE 0 END) AS sent_not_received,
+            SUM(CASE WHEN COALESCE(santa_sent_at, '') != '' AND COALESCE(recipient_received_at, '') != ''
+                     THEN 1 ELSE 0 END) AS sent_and_received
+        FROM event_assignments
+        WHERE event_id = :event_id
+    ),
+    participants AS (
+        SELECT
+            COUNT(*) AS total,
+            SUM(CASE WHEN stage = 'pre' THEN 1 ELSE 0 END) AS pre,
+            SUM(CASE WHEN stage = 'main' THEN 1 ELSE 0 END) AS main,
+            SUM(CASE WHEN approval_status = 'approved' THEN 1 ELSE 0 END) AS positive,
+            SUM(CASE WHEN approval_status = 'rejected' THEN 1 ELSE 0 END) AS negative,
+            SUM(CASE WHEN stage = 'main' AND approval_status = 'pending' THEN 1 ELSE 0 END) AS na
+        FROM participant_buckets
+    )
+    SELECT
+        gifts.total AS gifts_total,
+        gifts.sent_not_received,
+        gifts.sent_and_received,
+        participants.total AS participants_total,
+        participants.pre,
+        participants.main,
+        participants.positive,
+        participants.negative,
+        participants.na
+    FROM gifts CROSS JOIN participants
+'''
+
+
+def _compute_event_aggregates(conn, event_id):
+    row = conn.execute(_EVENT_AGGREGATES_QUERY, {'event_id': event_id}).fetchone()
+    total = row['gifts_total'] or 0
+    sent_not_received = row['sent_not_received'] or 0
+    sent_and_received = row['sent_and_received'] or 0
+    return {
+        'gifts': {
+            'total': total,
             'sent_not_received': sent_not_received,
             'sent_and_received': sent_and_received,
-            'not_sent': not_sent
+            'not_sent': total - sent_not_received - sent_and_received
+        },
+        'participants': {
+            'total': row['participants_total'] or 0,
+            'pre': row['pre'] or 0,
+            'main': row['main'] or 0,
+            'positive': row['positive'] or 0,
+            'negative': row['negative'] or 0,
+            'na': row['na'] or 0
         }
+    }
+
+
+def get_event_aggregates(event_id):
+    """Сводные показатели мероприятия (из кэша, если он свежий)"""
+    now = datetime.now()
+    with _event_aggregates_lock:
+        cached = _event_aggregates_cache.get(event_id)
+    if cached and (now - cached[0]).total_seconds() < EVENT_AGGREGATES_TTL_SECONDS:
+        return cached[1]
+    conn = get_db_connection()
+    try:
+        aggregates = _compute_event_aggregates(conn, event_id)
+    finally:
+        conn.close()
+    with _event_aggregates_lock:
+        _event_aggregates_cache[event_id] = (now, aggregates)
+    return aggregates
+
+
+def invalidate_event_aggregates(event_id=None):
+    """Сбрасывает кэш сводки мероприятия (или всех мероприятий)"""
+    with _event_aggregates_lock:
+        if event_id is None:
+            _event_aggregates_cache.clear()
+        else:
+            _event_aggregates_cache.pop(event_id, None)
+
+
+def get_event_gifts_statistics(event_id):
+    """Получает статистику по подаркам для мероприятия"""
+    try:
+        return dict(get_event_aggregates(event_id)['gifts'])
     except Exception as e:
         log_error(f"Error getting gifts statistics for event {event_id}: {e}")
-        log_error(traceback.format_exc())
         return {
             'total': 0,
             'sent_not_received': 0,
             'sent_and_received': 0,
             'not_sent': 0
         }
-    finally:
-        conn.close()
 
 def is_registration_open(event_id):
     """Проверяет, открыта ли регистрация на мероприятие"""
@@ -7906,10 +9499,14 @@ def get_event_registrations(event_id):
     conn.close()
     return registrations
 
-def get_event_registrations_paginated(event_id, page=1, per_page=20):
-    """Получает список зарегистрированных пользователей на мероприятие с пагинацией"""
+def get_event_registrations_paginated(event_id, page=1, per_page=20, cursor=None):
+    """Получает список зарегистрированных пользователей на мероприятие с пагинацией
+
+    При переданном cursor используется курсорная пагинация по (registered_at, id).
+    """
     # Ограничиваем per_page разумными значениями
     per_page = min(max(per_page, 10), 100)
+    page = max(page, 1)
     
     conn = get_db_connection()
     
@@ -7921,35 +9518,69 @@ def get_event_registrations_paginated(event_id, page=1, per_page=20):
     ''', (event_id,)).fetchone()
     total_count = total_count['count'] if total_count else 0
     
-    # Вычисляем offset
-    offset = (page - 1) * per_page
-    
-    # Получаем участников с пагинацией
-    registrations = conn.execute('''
-        SELECT er.*, u.user_id, u.username, u.avatar_seed, u.avatar_style, u.level, u.synd
+    registrations_query = '''
+        SELECT er.*, u.username, u.avatar_seed, u.avatar_style, u.level, u.synd
         FROM event_registrations er
         JOIN users u ON er.user_id = u.user_id
         WHERE er.event_id = ?
-        ORDER BY er.registered_at ASC
-        LIMIT ? OFFSET ?
-    ''', (event_id, per_page, offset)).fetchall()
+    '''
+    key_columns = ('registered_at', 'id')
+    if cursor or page == 1:
+        page_data = fetch_keyset_page(conn, registrations_query, (event_id,), key_columns, (False, False), cursor, per_page)
+    else:
+        # Прямой переход на номер страницы
+        offset = (page - 1) * per_page
+        rows = conn.execute(
+            registrations_query + ' ORDER BY er.registered_at ASC, er.id ASC LIMIT ? OFFSET ?',
+            (event_id, per_page + 1, offset)
+        ).fetchall()
+        page_data = _build_keyset_page(rows, key_columns, per_page, None, 'next')
+        page_data['has_prev'] = True
+        if page_data['items']:
+            first = page_data['items'][0]
+            page_data['prev_cursor'] = encode_page_cursor((first['registered_at'], first['id']), 'prev')
     conn.close()
     
     # Вычисляем данные для пагинации
     total_pages = (total_count + per_page - 1) // per_page if total_count > 0 else 1
-    has_prev = page > 1
-    has_next = page < total_pages
     
     return {
-        'registrations': registrations,
+        'registrations': page_data['items'],
         'total_count': total_count,
         'page': page,
         'per_page': per_page,
         'total_pages': total_pages,
-        'has_prev': has_prev,
-        'has_next': has_next
+        'has_prev': page_data['has_prev'],
+        'has_next': page_data['has_next'],
+        'prev_cursor': page_data['prev_cursor'],
+        'next_cursor': page_data['next_cursor']
     }
 
+@app.route('/api/events/<int:event_id>/registrations', methods=['GET'])
+def api_event_registrations(event_id):
+    """JSON API списка участников мероприятия с курсорной пагинацией"""
+    per_page = request.args.get('per_page', 20, type=int)
+    cursor = request.args.get('cursor', '').strip()
+    data = get_event_registrations_paginated(event_id, 1, per_page, cursor)
+    return jsonify({
+        'success': True,
+        'items': [
+            {
+                'user_id': row['user_id'],
+                'username': row['username'],
+                'avatar_seed': row['avatar_seed'],
+                'avatar_style': row['avatar_style'],
+                'level': row['level'],
+                'synd': row['synd'],
+                'registered_at': row['registered_at'],
+            }
+            for row in data['registrations']
+        ],
+        'total_count': data['total_count'],
+        'next_cursor': data['next_cursor'],
+        'prev_cursor': data['prev_cursor'],
+    })
+
 def get_event_stages(event_id):
     """Возвращает список этапов мероприятия в порядке их следования"""
     conn = get_db_connection()
@@ -7977,38 +9608,225 @@ def create_participant_approvals_for_event(event_id):
     """Создает записи для ревью участников при закрытии регистрации"""
     conn = get_db_connection()
     try:
-        # При закрытии регистрации сначала снимаем все бубенчики за отправленный/неотправленный подарок
-        # (на случай продления мероприятия - они будут начислены заново)
-        _revoke_gift_events(conn, event_id)
-        
-        # Получаем всех зарегистрированных участников
-        registrations = conn.execute('''
-            SELECT user_id FROM event_registrations WHERE event_id = ?
-        ''', (event_id,)).fetchall()
-        
-        # Создаем записи для ревью (если их еще нет)
-        for reg in registrations:
-            conn.execute('''
-                INSERT OR IGNORE INTO event_participant_approvals 
-                (event_id, user_id, approved) 
-                VALUES (?, ?, 0)
-            ''', (event_id, reg['user_id']))
-            _ensure_registration_bonus_event(conn, event_id, reg['user_id'])
-            # Начисляем бубенчики за неотправленный подарок, если подарок не отправлен
-            _ensure_gift_not_sent_event(conn, event_id, reg['user_id'])
-            # Начисляем бубенчики за отправленный подарок, если подарок отправлен
-            _ensure_gift_sent_event(conn, event_id, reg['user_id'])
-        
-        # Начисляем бубенчики за очередность отправки подарка для всех участников, которые отправили
-        _ensure_order_bonus_events(conn, event_id)
-        
-        conn.commit()
-        log_debug(f"Created participant approvals for event {event_id}")
+        # Записи ревью и бубенчики за регистрацию, подарок и очередность сверяются
+        # с текущими данными; при повторном вызове без изменений ничего не пишется
+        changes = reconcile_event_snowflakes(conn, event_id)
+        if any(changes.values()):
+            conn.commit()
+            log_debug(f"Reconciled snowflakes for event {event_id}: {changes}")
+        return changes
     except Exception as e:
         log_error(f"Error creating participant approvals: {e}")
         conn.rollback()
     finally:
         conn.close()
+# ========== Переходы между этапами мероприятий ==========
+# Побочные действия смены этапа (ревью участников, пересчет бубенчиков, награды,
+# напоминания) выполняет cron (run_stage_transitions), а не просмотр страниц.
+# Наступившие границы этапов ищутся по индексам idx_event_stages_type_start/_end
+# в окне stage_transitions_lookback_days. Каждый переход выполняется один раз:
+# строка event_stage_transitions (UNIQUE по мероприятию, этапу и границе) служит
+# одновременно захватом и журналом; упавший переход повторяется до
+# STAGE_TRANSITION_MAX_ATTEMPTS раз. Между закрытием регистрации и завершением
+# мероприятия бубенчики мероприятия сверяются при каждом запуске.
+
+STAGE_TRANSITION_MAX_ATTEMPTS = 3
+STAGE_TRANSITION_STALE_MINUTES = 15
+STAGE_TRANSITION_BATCH = 50
+
+
+def _transition_reconcile(event_id):
+    changes = create_participant_approvals_for_event(event_id)
+    invalidate_event_aggregates(event_id)
+    return changes
+
+
+def _transition_gift_reminders(event_id):
+    """Напоминает Дедам Морозам, еще не отметившим отправку, что начался обмен подарками"""
+    conn = get_db_connection()
+    try:
+        cursor = conn.execute('''
+            INSERT INTO notification_outbox (recipient_user_id, kind, assignment_id)
+            SELECT santa_user_id, 'gift_reminder', id
+            FROM event_assignments
+            WHERE event_id = ? AND is_archived = 0 AND santa_sent_at IS NULL AND santa_user_id IS NOT NULL
+        ''', (event_id,))
+        conn.commit()
+        return cursor.rowcount
+    finally:
+        conn.close()
+
+
+def _transition_awards(event_id):
+    return distribute_event_awards(event_id, require_sent=True)
+
+
+# (этап, граница) -> действия по порядку; граница 'start' - start_datetime, 'end' - end_datetime
+STAGE_TRANSITION_HOOKS = {
+    ('registration_closed', 'start'): (('reconcile', _transition_reconcile),),
+    ('celebration_date', 'start'): (
+        ('reconcile', _transition_reconcile),
+        ('gift_reminders', _transition_gift_reminders),
+    ),
+    ('after_party', 'end'): (
+        ('reconcile', _transition_reconcile),
+        ('awards', _transition_awards),
+    ),
+}
+
+
+def _stage_transition_lookback():
+    try:
+        days = int(get_setting('stage_transitions_lookback_days', '30'))
+    except (TypeError, ValueError):
+        days = 30
+    return max(days, 1)
+
+
+def _due_stage_transitions(conn, now_value, since_value, event_ids=None, limit=STAGE_TRANSITION_BATCH):
+    """Наступившие и еще не выполненные границы этапов: строки (event_id, stage_type, boundary, due_at)"""
+    parts = []
+    params = []
+    event_filter = ''
+    if event_ids:
+        event_filter = f" AND es.event_id IN ({','.join(['?'] * len(event_ids))})"
+    for boundary, column in (('start', 'start_datetime'), ('end', 'end_datetime')):
+        stage_types = [stage_type for stage_type, hook_boundary in STAGE_TRANSITION_HOOKS if hook_boundary == boundary]
+        parts.append(f'''
+            SELECT es.event_id, es.stage_type, '{boundary}' AS boundary, es.{column} AS due_at
+            FROM event_stages es
+            JOIN events e ON e.id = es.event_id AND e.deleted_at IS NULL
+            WHERE es.stage_type IN ({','.join(['?'] * len(stage_types))})
+              AND es.{column} > ? AND es.{column} <= ?{event_filter}
+              AND NOT EXISTS (
+                  SELECT 1 FROM event_stage_transitions t
+                  WHERE t.event_id = es.event_id AND t.stage_type = es.stage_type
+                    AND t.boundary = '{boundary}' AND t.status = 'done'
+              )
+        ''')
+        params.extend(stage_types + [since_value, now_value] + list(event_ids or []))
+    query = ' UNION ALL '.join(parts) + ' ORDER BY due_at LIMIT ?'
+    return conn.execute(query, params + [limit]).fetchall()
+
+
+def _claim_stage_transition(conn, row):
+    """Захватывает переход (commit). False - уже выполнен, выполняется или исчерпал попытки"""
+    stale_before = (datetime.utcnow() - timedelta(minutes=STAGE_TRANSITION_STALE_MINUTES)).strftime('%Y-%m-%d %H:%M:%S')
+    cursor = conn.execute('''
+        INSERT INTO event_stage_transitions (event_id, stage_type, boundary, due_at, status, attempts, started_at)
+        VALUES (?, ?, ?, ?, 'running', 1, CURRENT_TIMESTAMP)
+        ON CONFLICT(event_id, stage_type, boundary) DO UPDATE SET
+            due_at = excluded.due_at,
+            status = 'running',
+            attempts = event_stage_transitions.attempts + 1,
+            started_at = CURRENT_TIMESTAMP,
+            finished_at = NULL
+        WHERE event_stage_transitions.attempts < ?
+          AND (event_stage_transitions.status = 'failed'
+               OR (event_stage_transitions.status = 'running' AND event_stage_transitions.started_at < ?))
+    ''', (row['event_id'], row['stage_type'], row['boundary'], row['due_at'],
+          STAGE_TRANSITION_MAX_ATTEMPTS, stale_before))
+    conn.commit()
+    return cursor.rowcount == 1
+
+
+def _execute_stage_transition(conn, row):
+    """Выполняет действия перехода и записывает результат в журнал переходов"""
+    event_id = row['event_id']
+    details = {}
+    status = 'done'
+    for name, hook in STAGE_TRANSITION_HOOKS[(row['stage_type'], row['boundary'])]:
+        try:
+            details[name] = hook(event_id)
+        except Exception as exc:
+            log_error(f"Stage transition {row['stage_type']}/{row['boundary']} hook {name} failed for event {event_id}: {exc}")
+            details[name] = {'error': str(exc)}
+            status = 'failed'
+            break
+    conn.execute('''
+        UPDATE event_stage_transitions
+        SET status = ?, details = ?, finished_at = CURRENT_TIMESTAMP
+        WHERE event_id = ? AND stage_type = ? AND boundary = ?
+    ''', (status, json.dumps(details, ensure_ascii=False, default=str),
+          event_id, row['stage_type'], row['boundary']))
+    conn.commit()
+    log_activity(
+        'event_stage_transition',
+        details=f'Мероприятие #{event_id}: {row["stage_type"]} ({row["boundary"]}) - {status}',
+        metadata={'event_id': event_id, 'stage_type': row['stage_type'], 'boundary': row['boundary'],
+                  'due_at': row['due_at'], 'status': status, 'result': details}
+    )
+    return status
+
+
+def reconcile_active_events(conn, now_value, event_ids=None):
+    """Сверяет бубенчики мероприятий между закрытием регистрации и завершением"""
+    query = '''
+        SELECT es.event_id
+        FROM event_stages es
+        JOIN events e ON e.id = es.event_id AND e.deleted_at IS NULL
+        LEFT JOIN event_stages ap ON ap.event_id = es.event_id AND ap.stage_type = 'after_party'
+        WHERE es.stage_type = 'registration_closed'
+          AND es.start_datetime <= ?
+          AND (ap.end_datetime IS NULL OR ap.end_datetime > ?)
+    '''
+    params = [now_value, now_value]
+    if event_ids:
+        query += f" AND es.event_id IN ({','.join(['?'] * len(event_ids))})"
+        params.extend(event_ids)
+    reconciled = 0
+    for row in conn.execute(query, params).fetchall():
+        changes = create_participant_approvals_for_event(row['event_id'])
+        if changes and any(changes.values()):
+            invalidate_event_aggregates(row['event_id'])
+            reconciled += 1
+    return reconciled
+
+
+def run_stage_transitions(deadline=None, event_ids=None):
+    """Выполняет наступившие переходы этапов (все мероприятия или указанные)"""
+    now_value = get_event_now().strftime('%Y-%m-%d %H:%M:%S')
+    since_value = (get_event_now() - timedelta(days=_stage_transition_lookback())).strftime('%Y-%m-%d %H:%M:%S')
+    counts = {'done': 0, 'failed': 0, 'skipped': 0}
+    finished = True
+    conn = get_db_connection()
+    try:
+        due = _due_stage_transitions(conn, now_value, since_value, event_ids)
+        for row in due:
+            if deadline is not None and time.monotonic() >= deadline:
+                finished = False
+                break
+            if not _claim_stage_transition(conn, row):
+                counts['skipped'] += 1
+                continue
+            counts[_execute_stage_transition(conn, row)] += 1
+        else:
+            finished = len(due) < STAGE_TRANSITION_BATCH
+        counts['reconciled'] = reconcile_active_events(conn, now_value, event_ids)
+    finally:
+        conn.close()
+    return dict(counts, finished=finished)
+
+
+def get_next_stage_transition_at():
+    """Время (по часам мероприятий) ближайшего будущего перехода или None"""
+    now_value = get_event_now().strftime('%Y-%m-%d %H:%M:%S')
+    conn = get_db_connection()
+    try:
+        candidates = []
+        for stage_type, boundary in STAGE_TRANSITION_HOOKS:
+            column = 'start_datetime' if boundary == 'start' else 'end_datetime'
+            row = conn.execute(f'''
+                SELECT MIN({column}) AS due_at FROM event_stages
+                WHERE stage_type = ? AND {column} > ?
+            ''', (stage_type, now_value)).fetchone()
+            if row and row['due_at']:
+                candidates.append(row['due_at'])
+    finally:
+        conn.close()
+    return parse_event_datetime(min(candidates)) if candidates else None
+
+
 def get_participants_for_review(event_id):
     """Получает список участников для ревью с полной информацией"""
     conn = get_db_connection()
@@ -8064,6 +9882,7 @@ def approve_participant(event_id, user_id, approved_by, approved=True, notes=Non
                 WHERE event_id = ? AND user_id = ?
             ''', (approved_by, notes, event_id, user_id))
         conn.commit()
+        invalidate_event_aggregates(event_id)
         return True
     except Exception as e:
         log_error(f"Error approving participant: {e}")
@@ -8154,9 +9973,11 @@ def save_event_assignments(event_id, assignments, assigned_by, locked_pairs=None
         # Получаем старые назначения для проверки наличия сообщений
         old_assignments_map = {}
         old_assignments_rows = conn.execute('''
-            SELECT id, santa_user_id, recipient_user_id
-            FROM event_assignments
-            WHERE event_id = ?
+            SELECT ea.id, ea.santa_user_id, ea.recipient_user_id, ea.is_archived,
+                   COALESCE(cs.message_count, 0) AS message_count
+            FROM event_assignments ea
+            LEFT JOIN letter_chat_summary cs ON cs.assignment_id = ea.id
+            WHERE ea.event_id = ?
         ''', (event_id,)).fetchall()
         for row in old_assignments_rows:
             key = (row['santa_user_id'], row['recipient_user_id'])
@@ -8169,7 +9990,7 @@ def save_event_assignments(event_id, assignments, assigned_by, locked_pairs=None
         
         # Проверяем все старые назначения и удаляем те, у которых нет сообщений
         # НЕ удаляем архивированные назначения - они уже в архиве
-        deleted_count = 0
+        deleted_ids = []
         kept_count = 0
         archived_count = 0
         for row in old_assignments_rows:
@@ -8177,36 +9998,24 @@ def save_event_assignments(event_id, assignments, assigned_by, locked_pairs=None
             recipient_id = row['recipient_user_id']
             assignment_id = row['id']
             
-            # Проверяем, архивировано ли назначение
-            assignment_check = conn.execute('''
-                SELECT is_archived FROM event_assignments WHERE id = ?
-            ''', (assignment_id,)).fetchone()
-            is_archived = assignment_check and ('is_archived' in assignment_check.keys() and assignment_check['is_archived'] == 1)
-            
-            if is_archived:
+            if row['is_archived'] == 1:
                 # Архивированное назначение - не трогаем
                 archived_count += 1
                 log_debug(f"Skipping archived assignment_id {assignment_id} for pair ({santa_id}, {recipient_id})")
                 continue
             
-            # Проверяем, есть ли сообщения у этого назначения
-            message_count = conn.execute('''
-                SELECT COUNT(*) as cnt FROM letter_messages WHERE assignment_id = ?
-            ''', (assignment_id,)).fetchone()
-            
-            if message_count and message_count['cnt'] > 0:
+            if row['message_count'] > 0:
                 # Есть сообщения - НЕ удаляем, сохраняем чат навсегда
                 kept_count += 1
-                log_debug(f"Keeping assignment_id {assignment_id} for pair ({santa_id}, {recipient_id}) with {message_count['cnt']} messages - chat preserved for admin")
+                log_debug(f"Keeping assignment_id {assignment_id} for pair ({santa_id}, {recipient_id}) with {row['message_count']} messages - chat preserved for admin")
             else:
                 # Нет сообщений - удаляем, даже если для этой пары будет создано новое назначение
-                conn.execute('''
-                    DELETE FROM event_assignments 
-                    WHERE id = ?
-                ''', (assignment_id,))
-                deleted_count += 1
+                deleted_ids.append((assignment_id,))
                 log_debug(f"Deleted assignment_id {assignment_id} for pair ({santa_id}, {recipient_id}) - no messages")
         
+        if deleted_ids:
+            conn.executemany('DELETE FROM event_assignments WHERE id = ?', deleted_ids)
+        deleted_count = len(deleted_ids)
         if deleted_count > 0:
             log_debug(f"Deleted {deleted_count} old assignments without messages")
         if kept_count > 0:
@@ -8386,6 +10195,7 @@ def save_event_assignments(event_id, assignments, assigned_by, locked_pairs=None
         # НЕ переносим сообщения - каждый раз создается новый чат
         
         conn.commit()
+        invalidate_event_aggregates(event_id)
         log_activity(
             'assignments_saved',
             details=f'Сохранено распределение для мероприятия #{event_id}',
@@ -8436,17 +10246,18 @@ def save_event_assignments(event_id, assignments, assigned_by, locked_pairs=None
                 for row in existing_rows
             ])
             conn.commit()
+            invalidate_event_aggregates(event_id)
         except Exception as restore_error:
             log_error(f"Failed to restore previous assignments for event {event_id}: {restore_error}")
         return False, str(e)
 
 def get_user_assignments(user_id):
     """Получает задания пользователя (где он Дед Мороз и где Внучка)
-    Показывает только последнее назначение для каждой пары в рамках мероприятия
+    Показывает только текущее (неархивное) назначение для каждой пары в рамках мероприятия
     """
     conn = get_db_connection()
-    # Получаем задания, где пользователь Дед Мороз
-    # Используем подзапрос для получения только последнего назначения для каждой пары
+    # Получаем задания, где пользователь Дед Мороз. Неархивное назначение у пары одно
+    # (idx_event_assignments_current_pair), поэтому выборка идет по индексу без подзапроса
     as_santa_rows = conn.execute('''
         SELECT 
             ea.*,
@@ -8478,15 +10289,6 @@ def get_user_assignments(user_id):
             ON rd.event_id = ea.event_id AND rd.user_id = ea.recipient_user_id
         WHERE ea.santa_user_id = ?
           AND ea.is_archived = 0
-          AND ea.id = (
-              SELECT id FROM event_assignments ea2
-              WHERE ea2.event_id = ea.event_id
-                AND ea2.santa_user_id = ea.santa_user_id
-                AND ea2.recipient_user_id = ea.recipient_user_id
-                AND ea2.is_archived = 0
-              ORDER BY ea2.assigned_at DESC, ea2.id DESC
-              LIMIT 1
-          )
         ORDER BY ea.assigned_at DESC
     ''', (user_id,)).fetchall()
     
@@ -8526,58 +10328,245 @@ def get_user_assignments(user_id):
             ON rd.event_id = ea.event_id AND rd.user_id = ea.recipient_user_id
         WHERE ea.recipient_user_id = ?
           AND ea.is_archived = 0
-          AND ea.id = (
-              SELECT id FROM event_assignments ea2
-              WHERE ea2.event_id = ea.event_id
-                AND ea2.santa_user_id = ea.santa_user_id
-                AND ea2.recipient_user_id = ea.recipient_user_id
-                AND ea2.is_archived = 0
-              ORDER BY ea2.assigned_at DESC, ea2.id DESC
-              LIMIT 1
-          )
         ORDER BY ea.assigned_at DESC
     ''', (user_id,)).fetchall()
     
-    assignments = []
-    send_info_updates = []
-    thanks_updates = []
-    
-    for row in as_santa_rows:
-        record = dict(row)
-        info = record.get('santa_send_info')
-        if info:
-            normalized = _normalize_multiline_text(info)
-            if normalized != info:
-                record['santa_send_info'] = normalized
-                send_info_updates.append((normalized, record['id']))
-        assignments.append(record)
-    
-    for row in as_recipient_rows:
-        record = dict(row)
-        send_info = record.get('santa_send_info')
-        if send_info:
-            normalized = _normalize_multiline_text(send_info)
-            if normalized != send_info:
-                record['santa_send_info'] = normalized
-                send_info_updates.append((normalized, record['id']))
-        thanks = record.get('recipient_thanks_message')
-        if thanks:
-            normalized_thanks = _normalize_multiline_text(thanks)
-            if normalized_thanks != thanks:
-                record['recipient_thanks_message'] = normalized_thanks
-                thanks_updates.append((normalized_thanks, record['id']))
-        assignments.append(record)
-    
-    if send_info_updates:
-        conn.executemany('UPDATE event_assignments SET santa_send_info = ? WHERE id = ?', send_info_updates)
-    if thanks_updates:
-        conn.executemany('UPDATE event_assignments SET recipient_thanks_message = ? WHERE id = ?', thanks_updates)
-    if send_info_updates or thanks_updates:
-        conn.commit()
     conn.close()
     
+    # Текст уже нормализован при записи (см. _normalize_multiline_text)
+    assignments = [dict(row) for row in as_santa_rows]
+    assignments.extend(dict(row) for row in as_recipient_rows)
     return assignments
 
+# ========== Сводка переписки ==========
+# letter_chat_summary хранит по каждому назначению число сообщений, время и
+# отправителя последнего сообщения и признак сообщения от Деда Мороза.
+# Сводка обновляется в той же транзакции, что и вставка сообщения
+# (add_letter_message), поэтому списки чатов читают ее без подзапросов к letter_messages.
+
+_CHAT_SUMMARY_REFRESH_SQL = '''
+    INSERT OR REPLACE INTO letter_chat_summary (
+        assignment_id, message_count, last_message_id, last_message_at, last_sender, has_santa_message
+    )
+    SELECT agg.assignment_id, agg.message_count, last.id, agg.last_message_at, last.sender, agg.has_santa_message
+    FROM (
+        SELECT assignment_id,
+               COUNT(*) AS message_count,
+               MAX(id) AS last_message_id,
+               MAX(created_at) AS last_message_at,
+               MAX(CASE WHEN sender = 'santa' THEN 1 ELSE 0 END) AS has_santa_message
+        FROM letter_messages
+        {where}
+        GROUP BY assignment_id
+    ) agg
+    JOIN letter_messages last ON last.id = agg.last_message_id
+'''
+
+
+def add_letter_message(conn, assignment_id, sender, message, attachment_path=None, notify='letter_message'):
+    """Добавляет сообщение в переписку и обновляет сводку (без commit). Возвращает id сообщения
+
+    notify - вид уведомления второй стороне (см. NOTIFICATION_KINDS), None - без уведомления.
+    """
+    message = _normalize_multiline_text(message)
+    cursor = conn.execute('''
+        INSERT INTO letter_messages (assignment_id, sender, message, attachment_path)
+        VALUES (?, ?, ?, ?)
+    ''', (assignment_id, sender, message, attachment_path))
+    message_id = cursor.lastrowid
+    conn.execute('''
+        INSERT INTO letter_chat_summary (
+            assignment_id, message_count, last_message_id, last_message_at, last_sender, has_santa_message
+        )
+        VALUES (?, 1, ?, (SELECT created_at FROM letter_messages WHERE id = ?), ?, ?)
+        ON CONFLICT(assignment_id) DO UPDATE SET
+            message_count = message_count + 1,
+            last_message_id = excluded.last_message_id,
+            last_message_at = excluded.last_message_at,
+            last_sender = excluded.last_sender,
+            has_santa_message = MAX(has_santa_message, excluded.has_santa_message)
+    ''', (assignment_id, message_id, message_id, sender, 1 if sender == 'santa' else 0))
+    if notify:
+        enqueue_letter_notification(conn, assignment_id, sender, notify)
+    return message_id
+
+
+def refresh_chat_summary(conn, assignment_ids=None):
+    """Пересчитывает сводку по letter_messages (все назначения или указанные; без commit)"""
+    if assignment_ids is None:
+        conn.execute('DELETE FROM letter_chat_summary')
+        conn.execute(_CHAT_SUMMARY_REFRESH_SQL.format(where=''))
+        return
+    assignment_ids = list(assignment_ids)
+    for start in range(0, len(assignment_ids), 500):
+        chunk = assignment_ids[start:start + 500]
+        placeholders = ','.join(['?'] * len(chunk))
+        conn.execute(f'DELETE FROM letter_chat_summary WHERE assignment_id IN ({placeholders})', chunk)
+        conn.execute(
+            _CHAT_SUMMARY_REFRESH_SQL.format(where=f'WHERE assignment_id IN ({placeholders})'),
+            chunk
+        )
+
+
+# ========== Уведомления участникам ==========
+# Сообщения переписки и отметки об отправке/получении подарка кладут запись в
+# notification_outbox в той же транзакции (add_letter_message), сам запрос в
+# Telegram или на почту не ходит. Рассылку выполняет cron (dispatch_notifications):
+# записи получателя копятся, пока самой старой из них не исполнится
+# notification_coalesce_seconds, и уходят одним сообщением ("3 новых сообщения
+# от Деда Мороза"). Канал - подтвержденный Telegram, иначе email.
+
+NOTIFICATION_KINDS = ('letter_message', 'gift_sent', 'gift_received', 'gift_reminder')
+NOTIFICATION_DISPATCH_LIMIT = 200
+NOTIFICATION_MAX_ATTEMPTS = 3
+
+_NOTIFICATION_SENDER_NAMES = {'santa': 'Деда Мороза', 'grandchild': 'внучка'}
+
+
+def enqueue_letter_notification(conn, assignment_id, sender, kind='letter_message'):
+    """Ставит уведомление второй стороне переписки в очередь (без commit)"""
+    if kind not in NOTIFICATION_KINDS or sender not in _NOTIFICATION_SENDER_NAMES:
+        return
+    conn.execute('''
+        INSERT INTO notification_outbox (recipient_user_id, kind, assignment_id, sender)
+        SELECT CASE WHEN ? = 'santa' THEN recipient_user_id ELSE santa_user_id END, ?, id, ?
+        FROM event_assignments
+        WHERE id = ?
+    ''', (sender, kind, sender, assignment_id))
+
+
+def _notification_settings():
+    try:
+        window = max(int(get_setting('notification_coalesce_seconds', '300')), 0)
+    except (TypeError, ValueError):
+        window = 300
+    return get_setting('notifications_enabled', '1') == '1', window
+
+
+def build_notification_text(groups):
+    """Текст уведомления по сгруппированным записям очереди"""
+    lines = []
+    for group in groups:
+        sender_name = _NOTIFICATION_SENDER_NAMES.get(group['sender'], 'участника')
+        if group['kind'] == 'gift_sent':
+            lines.append('🎁 Дед Мороз отправил подарок! Данные об отправке - в переписке.')
+        elif group['kind'] == 'gift_received':
+            lines.append('🎉 Внучок получил подарок и написал спасибо.')
+        elif group['kind'] == 'gift_reminder':
+            lines.append('⏰ Начался обмен подарками: отправьте подарок внучку и отметьте отправку на сайте.')
+        elif group['count'] == 1:
+            lines.append(f'✉️ Новое сообщение от {sender_name}.')
+        else:
+            lines.append(f'✉️ Новых сообщений от {sender_name}: {group["count"]}.')
+    site_url = get_setting('site_url', '')
+    if site_url:
+        lines.append(f'Открыть переписку: {site_url.rstrip("/")}/letter')
+    return '\n'.join(lines)
+
+
+def dispatch_notifications(deadline=None, limit=NOTIFICATION_DISPATCH_LIMIT):
+    """Рассылает накопившиеся уведомления, по одному сообщению на получателя.
+
+    Получатель обрабатывается, когда самой старой его записи больше
+    notification_coalesce_seconds. Неудачная отправка повторяется при следующих
+    запусках, после NOTIFICATION_MAX_ATTEMPTS попыток записи помечаются failed.
+    """
+    enabled, window = _notification_settings()
+    if not enabled:
+        return {'sent': 0, 'finished': True, 'skipped': True}
+
+    cutoff = (datetime.utcnow() - timedelta(seconds=window)).strftime('%Y-%m-%d %H:%M:%S')
+    telegram_ready = (
+        requests is not None
+        and get_setting('telegram_enabled', '0') == '1'
+        and get_setting('telegram_verified', '0') == '1'
+    )
+    smtp_connection = None
+    smtp_error = None
+    counts = {'sent': 0, 'skipped': 0, 'failed': 0, 'retry': 0}
+    finished = True
+
+    conn = get_db_connection()
+    try:
+        due = conn.execute('''
+            SELECT recipient_user_id, MAX(id) AS max_id
+            FROM notification_outbox
+            WHERE dispatched_at IS NULL
+            GROUP BY recipient_user_id
+            HAVING MIN(created_at) <= ?
+            ORDER BY MIN(created_at)
+            LIMIT ?
+        ''', (cutoff, limit)).fetchall()
+
+        for item in due:
+            if deadline is not None and time.monotonic() >= deadline:
+                finished = False
+                break
+            recipient_id, max_id = item['recipient_user_id'], item['max_id']
+            groups = conn.execute('''
+                SELECT kind, assignment_id, sender, COUNT(*) AS count, MAX(attempts) AS attempts
+                FROM notification_outbox
+                WHERE recipient_user_id = ? AND dispatched_at IS NULL AND id <= ?
+                GROUP BY assignment_id, kind, sender
+                ORDER BY MIN(id)
+            ''', (recipient_id, max_id)).fetchall()
+            target = conn.execute('''
+                SELECT u.email, tu.telegram_chat_id, tu.verified
+                FROM users u
+                LEFT JOIN telegram_users tu ON tu.user_id = u.user_id
+                WHERE u.user_id = ?
+            ''', (recipient_id,)).fetchone()
+
+            text = build_notification_text(groups)
+            status = 'skipped'
+            error = None
+            if target and telegram_ready and target['verified'] and target['telegram_chat_id']:
+                ok, result_message = send_telegram_message(text, chat_id=target['telegram_chat_id'])
+                status, error = ('sent', None) if ok else ('failed', result_message)
+            elif target and target['email']:
+                if smtp_connection is None and smtp_error is None:
+                    server, from_email, smtp_error = open_smtp_connection()
+                    if server:
+                        smtp_connection = (server, from_email)
+                if smtp_connection:
+                    ok, result_message = send_email_via_smtp(
+                        target['email'], 'Новости по вашему заданию - Анонимные Деды Морозы', text,
+                        connection=smtp_connection
+                    )
+                    status, error = ('sent', None) if ok else ('failed', result_message)
+                else:
+                    # SMTP недоступен или не настроен - повторим при следующих запусках
+                    status, error = 'failed', smtp_error
+
+            if status == 'failed' and max(group['attempts'] for group in groups) + 1 < NOTIFICATION_MAX_ATTEMPTS:
+                conn.execute('''
+                    UPDATE notification_outbox
+                    SET attempts = attempts + 1, last_error = ?
+                    WHERE recipient_user_id = ? AND dispatched_at IS NULL AND id <= ?
+                ''', (error, recipient_id, max_id))
+                counts['retry'] += 1
+            else:
+                conn.execute('''
+                    UPDATE notification_outbox
+                    SET dispatched_at = CURRENT_TIMESTAMP, status = ?, attempts = attempts + 1, last_error = ?
+                    WHERE recipient_user_id = ? AND dispatched_at IS NULL AND id <= ?
+                ''', (status, error, recipient_id, max_id))
+                counts[status] += 1
+            conn.commit()
+            if error:
+                log_debug(f"Notification for user {recipient_id} not delivered: {error}")
+        else:
+            finished = len(due) < limit
+    finally:
+        conn.close()
+        if smtp_connection:
+            try:
+                smtp_connection[0].quit()
+            except Exception:
+                pass
+    return dict(counts, finished=finished)
+
+
 def get_admin_letter_assignments():
     """Возвращает все переписки для администраторов"""
     conn = get_db_connection()
@@ -8613,13 +10602,7 @@ def get_admin_letter_assignments():
             ON rd.event_id = ea.event_id AND rd.user_id = ea.recipient_user_id
         LEFT JOIN event_registration_details sd
             ON sd.event_id = ea.event_id AND sd.user_id = ea.santa_user_id
-        LEFT JOIN (
-            SELECT assignment_id,
-                   COUNT(*) AS message_count,
-                   MAX(created_at) AS last_message_at
-            FROM letter_messages
-            GROUP BY assignment_id
-        ) lm ON lm.assignment_id = ea.id
+        LEFT JOIN letter_chat_summary lm ON lm.assignment_id = ea.id
         WHERE ea.is_archived = 0
         ORDER BY
             CASE WHEN lm.last_message_at IS NULL THEN 1 ELSE 0 END,
@@ -8627,23 +10610,11 @@ def get_admin_letter_assignments():
             ea.id ASC
     ''').fetchall()
 
+    conn.close()
+
     assignments = []
-    send_info_updates = []
-    thanks_updates = []
     for row in rows:
         record = dict(row)
-        info = record.get('santa_send_info')
-        if info:
-            normalized = _normalize_multiline_text(info)
-            if normalized != info:
-                record['santa_send_info'] = normalized
-                send_info_updates.append((normalized, record['id']))
-        thanks = record.get('recipient_thanks_message')
-        if thanks:
-            normalized_thanks = _normalize_multiline_text(thanks)
-            if normalized_thanks != thanks:
-                record['recipient_thanks_message'] = normalized_thanks
-                thanks_updates.append((normalized_thanks, record['id']))
         record['message_count'] = record.get('message_count') or 0
         record['last_message_at'] = record.get('last_message_at')
         santa_parts = [record.get('santa_last_name') or '', record.get('santa_first_name') or '', record.get('santa_middle_name') or '']
@@ -8652,14 +10623,6 @@ def get_admin_letter_assignments():
         record['recipient_full_name'] = ' '.join(part for part in recipient_parts if part).strip() or record.get('recipient_username')
         record['chat_role'] = 'admin'
         assignments.append(record)
-
-    if send_info_updates:
-        conn.executemany('UPDATE event_assignments SET santa_send_info = ? WHERE id = ?', send_info_updates)
-    if thanks_updates:
-        conn.executemany('UPDATE event_assignments SET recipient_thanks_message = ? WHERE id = ?', thanks_updates)
-    if send_info_updates or thanks_updates:
-        conn.commit()
-    conn.close()
     return assignments
 
 def mark_assignment_sent(assignment_id, user_id, send_info):
@@ -8703,10 +10666,7 @@ def mark_assignment_sent(assignment_id, user_id, send_info):
                 "Дорогой внучок! Я скорректировал информацию об отправке. "
                 "Если будут вопросы — пиши!"
             )
-            conn.execute('''
-                INSERT INTO letter_messages (assignment_id, sender, message, attachment_path)
-                VALUES (?, 'santa', ?, NULL)
-            ''', (assignment_id, system_message))
+            add_letter_message(conn, assignment_id, 'santa', system_message)
         else:
             chat_message = (
                 f"Дорогой внучок! Я всё отправил! {send_info}\n"
@@ -8733,12 +10693,10 @@ def mark_assignment_sent(assignment_id, user_id, send_info):
                 f"Дорогой внучок! Я всё отправил! {send_info}\n"
                 "Если будут вопросы — пиши!"
             ).strip()
-        conn.execute('''
-            INSERT INTO letter_messages (assignment_id, sender, message, attachment_path)
-            VALUES (?, 'santa', ?, NULL)
-        ''', (assignment_id, chat_message))
+        add_letter_message(conn, assignment_id, 'santa', chat_message, notify='gift_sent')
 
         conn.commit()
+        invalidate_event_aggregates(assignment['event_id'])
         log_activity(
             'assignment_sent',
             details=f'Подарок отправлен по назначению #{assignment_id}',
@@ -8751,10 +10709,164 @@ def mark_assignment_sent(assignment_id, user_id, send_info):
         return False, 'Не удалось сохранить информацию об отправке'
     finally:
         conn.close()
-def mark_assignment_received(assignment_id, user_id, thank_you_message, receipt_file):
-    """Отмечает, что подарок получен"""
+# ========== Обработка загружаемых изображений ==========
+# Тип файла определяется по сигнатуре, а не по расширению. С Pillow изображение
+# поворачивается по EXIF, теряет метаданные, уменьшается до image_max_dimension и
+# сохраняется в WebP вместе с миниатюрой <хэш>_thumb.webp. Имя файла - хэш
+# содержимого, поэтому повторная загрузка того же фото не создает копию.
+# Без Pillow файл сохраняется как есть (из JPEG вырезаются EXIF-сегменты), без миниатюры.
+
+IMAGE_MAX_UPLOAD_BYTES = 15 * 1024 * 1024
+IMAGE_THUMBNAIL_SUFFIX = '_thumb'
+IMAGE_UPLOAD_ERROR_TYPE = 'Допускается загрузка только изображений (PNG, JPG, JPEG, GIF, WEBP).'
+_IMAGE_SIGNATURES = (
+    (b'\x89PNG\r\n\x1a\n', '.png'),
+    (b'\xff\xd8\xff', '.jpg'),
+    (b'GIF87a', '.gif'),
+    (b'GIF89a', '.gif'),
+)
+
+
+def detect_image_extension(data):
+    """Определяет расширение по первым байтам файла (None - не изображение)"""
+    for signature, ext in _IMAGE_SIGNATURES:
+        if data.startswith(signature):
+            return ext
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return '.webp'
+    return None
+
+
+def _image_pipeline_available():
+    if Image is None:
+        return False
     try:
-        user_id_int = int(user_id)
+        from PIL import features
+        return bool(features.check('webp'))
+    except Exception:
+        return False
+
+
+def _get_image_setting(key, default):
+    try:
+        return max(1, int(get_setting(key, str(default))))
+    except (TypeError, ValueError):
+        return default
+
+
+def _strip_jpeg_exif(data):
+    """Удаляет из JPEG сегменты APP1 (EXIF/XMP) без перекодирования"""
+    output = bytearray(data[:2])
+    pos = 2
+    while pos + 4 <= len(data) and data[pos] == 0xFF:
+        marker = data[pos + 1]
+        if marker == 0xDA:  # начало сжатых данных
+            break
+        if marker == 0x01 or 0xD0 <= marker <= 0xD7:
+            output += data[pos:pos + 2]
+            pos += 2
+            continue
+        length = int.from_bytes(data[pos + 2:pos + 4], 'big')
+        if marker != 0xE1:
+            output += data[pos:pos + 2 + length]
+        pos += 2 + length
+    output += data[pos:]
+    return bytes(output)
+
+
+def _encode_webp(image, max_dimension, quality):
+    frame = image.copy()
+    frame.thumbnail((max_dimension, max_dimension))
+    has_alpha = frame.mode in ('RGBA', 'LA', 'PA') or 'transparency' in frame.info
+    if frame.mode not in ('RGB', 'RGBA'):
+        frame = frame.convert('RGBA' if has_alpha else 'RGB')
+    buffer = io.BytesIO()
+    frame.save(buffer, 'WEBP', quality=quality, method=4)
+    return buffer.getvalue()
+
+
+def _write_file_atomic(path, data):
+    tmp_path = f"{path}.{secrets.token_hex(4)}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def get_image_thumbnail_path(relative_path):
+    """Возвращает путь миниатюры (относительно static), если она есть, иначе исходный путь"""
+    if not relative_path:
+        return relative_path
+    thumb_path = f"{os.path.splitext(relative_path)[0]}{IMAGE_THUMBNAIL_SUFFIX}.webp"
+    if os.path.exists(os.path.join(app.static_folder, thumb_path)):
+        return thumb_path
+    return relative_path
+
+
+def store_uploaded_image(file_storage, folder, relative_folder):
+    """Проверяет и сохраняет загруженное изображение.
+
+    Возвращает (относительный путь, создан ли новый файл, текст ошибки).
+    """
+    data = file_storage.read(IMAGE_MAX_UPLOAD_BYTES + 1)
+    if not data:
+        return None, False, 'Файл изображения пуст.'
+    if len(data) > IMAGE_MAX_UPLOAD_BYTES:
+        return None, False, f'Изображение слишком большое (максимум {IMAGE_MAX_UPLOAD_BYTES // (1024 * 1024)} МБ).'
+    ext = detect_image_extension(data)
+    if not ext:
+        return None, False, IMAGE_UPLOAD_ERROR_TYPE
+
+    digest = hashlib.sha256(data).hexdigest()[:40]
+    for candidate in (f"{digest}.webp", f"{digest}{ext}"):
+        if os.path.exists(os.path.join(folder, candidate)):
+            return f"{relative_folder}/{candidate}", False, None
+
+    try:
+        if _image_pipeline_available():
+            max_dimension = _get_image_setting('image_max_dimension', 1920)
+            thumb_dimension = _get_image_setting('image_thumbnail_dimension', 480)
+            quality = _get_image_setting('image_webp_quality', 82)
+            with Image.open(io.BytesIO(data)) as image:
+                image.load()
+                animated = getattr(image, 'is_animated', False)
+                if not animated:
+                    image = ImageOps.exif_transpose(image)
+                _write_file_atomic(
+                    os.path.join(folder, f"{digest}{IMAGE_THUMBNAIL_SUFFIX}.webp"),
+                    _encode_webp(image, thumb_dimension, quality)
+                )
+                if animated:
+                    # Анимацию не перекодируем, чтобы не потерять кадры
+                    name = f"{digest}{ext}"
+                    _write_file_atomic(os.path.join(folder, name), data)
+                else:
+                    name = f"{digest}.webp"
+                    _write_file_atomic(os.path.join(folder, name), _encode_webp(image, max_dimension, quality))
+        else:
+            name = f"{digest}{ext}"
+            _write_file_atomic(os.path.join(folder, name), _strip_jpeg_exif(data) if ext == '.jpg' else data)
+    except Exception as exc:
+        log_error(f"Failed to process uploaded image {digest}: {exc}")
+        return None, False, 'Не удалось обработать изображение.'
+
+    return f"{relative_folder}/{name}", True, None
+
+
+def remove_uploaded_image(relative_path):
+    """Удаляет сохраненное изображение вместе с миниатюрой"""
+    if not relative_path:
+        return
+    for path in {relative_path, get_image_thumbnail_path(relative_path)}:
+        try:
+            os.remove(os.path.join(app.static_folder, path))
+        except OSError:
+            pass
+
+
+def mark_assignment_received(assignment_id, user_id, thank_you_message, receipt_file):
+    """Отмечает, что подарок получен"""
+    try:
+        user_id_int = int(user_id)
     except (TypeError, ValueError):
         return False, 'Некорректный идентификатор пользователя'
     
@@ -8785,22 +10897,13 @@ def mark_assignment_received(assignment_id, user_id, thank_you_message, receipt_
     if not receipt_file or not receipt_file.filename:
         return False, 'Приложите фотографию подарка.'
 
-    filename = secure_filename(receipt_file.filename)
-    _, ext = os.path.splitext(filename)
-    ext = ext.lower()
-    if ext not in ALLOWED_LETTER_IMAGE_EXTENSIONS:
-        return False, 'Допускается загрузка только изображений (PNG, JPG, JPEG, GIF, WEBP).'
-
-    unique_name = f"{assignment_id}_{int(datetime.now().timestamp())}_{secrets.token_hex(4)}{ext}"
-    saved_filepath = os.path.join(ASSIGNMENT_RECEIPT_FOLDER, unique_name)
-    try:
-        receipt_file.save(saved_filepath)
-    except Exception as exc:
-        log_error(f"Failed to save assignment receipt image {unique_name}: {exc}")
-        return False, 'Не удалось загрузить изображение.'
-
-    receipt_relative_path = f"{ASSIGNMENT_RECEIPT_RELATIVE}/{unique_name}"
+    receipt_relative_path, receipt_created, upload_error = store_uploaded_image(
+        receipt_file, ASSIGNMENT_RECEIPT_FOLDER, ASSIGNMENT_RECEIPT_RELATIVE
+    )
+    if upload_error:
+        return False, upload_error
 
+    receipt_saved = False
     conn = get_db_connection()
     try:
         conn.execute('''
@@ -8811,19 +10914,21 @@ def mark_assignment_received(assignment_id, user_id, thank_you_message, receipt_
             WHERE id = ?
         ''', (thank_you_message, receipt_relative_path, assignment_id))
         conn.commit()
+        receipt_saved = True
+        invalidate_event_aggregates(assignment['event_id'])
         log_activity(
             'assignment_received',
             details=f'Получение подарка подтверждено по заданию #{assignment_id}',
             metadata={'assignment_id': assignment_id, 'event_id': assignment['event_id']}
         )
-        conn.execute('''
-            INSERT INTO letter_messages (assignment_id, sender, message, attachment_path)
-            VALUES (?, 'grandchild', ?, ?)
-        ''', (
+        add_letter_message(
+            conn,
             assignment_id,
+            'grandchild',
             f"Дорогой Дед Мороз! Спасибо за подарок! {thank_you_message}",
-            receipt_relative_path
-        ))
+            receipt_relative_path,
+            notify='gift_received'
+        )
         conn.commit()
         
         # Добавляем автоматический комментарий "спасибо от внучка" в профиль получателя
@@ -8837,11 +10942,9 @@ def mark_assignment_received(assignment_id, user_id, thank_you_message, receipt_
     except Exception as e:
         log_error(f"Error marking assignment received (id={assignment_id}): {e}")
         conn.rollback()
-        try:
-            if os.path.exists(saved_filepath):
-                os.remove(saved_filepath)
-        except OSError:
-            pass
+        # Файл удаляем, только если он новый (не общий с другими записями) и еще не сохранен в задании
+        if receipt_created and not receipt_saved:
+            remove_uploaded_image(receipt_relative_path)
         return False, 'Не удалось подтвердить получение подарка'
     finally:
         conn.close()
@@ -9020,22 +11123,16 @@ def event_view(event_id):
     
     # Параметры пагинации для участников
     participants_page = request.args.get('participants_page', 1, type=int)
+    participants_cursor = request.args.get('participants_cursor', '').strip()
     participants_per_page = 20  # По 20 участников на странице
     
     # Получаем участников с пагинацией
-    registrations_data = get_event_registrations_paginated(event_id, participants_page, participants_per_page)
+    registrations_data = get_event_registrations_paginated(event_id, participants_page, participants_per_page, participants_cursor)
     registrations = registrations_data['registrations']
     
     is_admin = 'admin' in session.get('roles', []) if session.get('roles') else False
     
-    award_needed = False
-    if current_stage and current_stage['info']['type'] == 'after_party':
-        award_needed = True
-    elif is_event_finished(event_id):
-        award_needed = True
-
-    if award_needed:
-        distribute_event_awards(event_id, require_sent=True)
+    # Награды за мероприятие выдает run_stage_transitions при его завершении
     
     # Получаем все этапы мероприятия
     conn = get_db_connection()
@@ -9279,7 +11376,9 @@ def event_view(event_id):
                          participants_total_count=registrations_data['total_count'],
                          participants_total_pages=registrations_data['total_pages'],
                          participants_has_prev=registrations_data['has_prev'],
-                         participants_has_next=registrations_data['has_next'])
+                         participants_has_next=registrations_data['has_next'],
+                         participants_prev_cursor=registrations_data['prev_cursor'],
+                         participants_next_cursor=registrations_data['next_cursor'])
 
 def has_required_contacts(user_id):
     """Проверяет, заполнены ли обязательные контактные данные пользователя"""
@@ -9597,6 +11696,7 @@ def event_register(event_id):
                 ''', (event_id, user_id))
 
             conn.commit()
+            invalidate_event_aggregates(event_id)
             return {
                 'status': 'success',
                 'already_registered': already_registered,
@@ -9824,6 +11924,7 @@ def api_profile_update():
         '''
         conn.execute(update_query, update_values)
         conn.commit()
+        refresh_user_directory_entry(user_id)
         
         # Проверяем, что обновление прошло успешно
         verify_user = conn.execute('SELECT email, phone, telegram FROM users WHERE user_id = ?', (user_id,)).fetchone()
@@ -9865,6 +11966,7 @@ def event_unregister(event_id):
             WHERE event_id = ? AND user_id = ?
         ''', (event_id, user_id))
         conn.commit()
+        invalidate_event_aggregates(event_id)
         
         if cursor.rowcount > 0:
             log_activity(
@@ -10028,56 +12130,55 @@ def contacts():
 
 # ========== Логи ==========
 
+def _parse_logs_limit(limit):
+    if not limit or limit <= 0:
+        limit = 200
+    return max(50, min(limit, 1000))
+
+def _parse_logs_date(value, end_of_day=False):
+    """Парсит дату фильтра журнала (YYYY-MM-DD); конец диапазона - начало следующего дня"""
+    if not value:
+        return None
+    try:
+        parsed = datetime.strptime(value.strip(), '%Y-%m-%d')
+    except ValueError:
+        return None
+    return parsed + timedelta(days=1) if end_of_day else parsed
+
+def _get_logs_filters():
+    return {
+        'user_id': request.args.get('user_id', type=int),
+        'action_prefix': request.args.get('action', '').strip() or None,
+        'date_from': _parse_logs_date(request.args.get('date_from', '')),
+        'date_to': _parse_logs_date(request.args.get('date_to', ''), end_of_day=True),
+        'cursor': request.args.get('cursor', '').strip() or None,
+        'limit': _parse_logs_limit(request.args.get('limit', type=int)),
+    }
+
 @app.route('/admin/logs')
 @require_role('admin')
 def admin_logs():
     """Отображение действий пользователей."""
-    limit = request.args.get('limit', type=int)
-    user_filter = request.args.get('user_id', type=int)
-    action_filter = request.args.get('action', '').strip()
-    
-    if not limit or limit <= 0:
-        limit = 200
-    limit = max(50, min(limit, 1000))
-    
-    conn = get_db_connection()
-    params = []
-    where_clauses = []
-    
-    if user_filter:
-        where_clauses.append('user_id = ?')
-        params.append(user_filter)
-    
-    if action_filter:
-        where_clauses.append('action LIKE ?')
-        params.append(f'%{action_filter}%')
-    
-    query = '''
-        SELECT id, user_id, username, action, details, metadata, ip_address, created_at
-        FROM activity_logs
-    '''
-    if where_clauses:
-        query += ' WHERE ' + ' AND '.join(where_clauses)
-    query += ' ORDER BY created_at DESC LIMIT ?'
-    params.append(limit)
-    
-    rows = conn.execute(query, params).fetchall()
-    conn.close()
-    
-    logs = []
-    for row in rows:
-        item = dict(row)
-        metadata_value = item.get('metadata')
-        if metadata_value:
-            try:
-                item['metadata'] = json.loads(metadata_value)
-            except (json.JSONDecodeError, TypeError):
-                item['metadata'] = metadata_value
-        else:
-            item['metadata'] = None
-        logs.append(item)
+    filters = _get_logs_filters()
+    page_data = query_activity_logs(**filters)
     
-    return render_template('admin/logs.html', logs=logs, limit=limit, user_filter=user_filter, action_filter=action_filter)
+    return render_template('admin/logs.html', logs=page_data['items'], limit=filters['limit'],
+                           user_filter=filters['user_id'], action_filter=filters['action_prefix'] or '',
+                           date_from=request.args.get('date_from', ''), date_to=request.args.get('date_to', ''),
+                           prev_cursor=page_data['prev_cursor'], next_cursor=page_data['next_cursor'])
+
+@app.route('/api/admin/logs', methods=['GET'])
+@require_role('admin')
+def api_admin_logs():
+    """JSON API журнала действий с курсорной пагинацией"""
+    include_metadata = request.args.get('metadata', '1') != '0'
+    page_data = query_activity_logs(**_get_logs_filters())
+    return jsonify({
+        'success': True,
+        'items': [record.to_dict(include_metadata=include_metadata) for record in page_data['items']],
+        'next_cursor': page_data['next_cursor'],
+        'prev_cursor': page_data['prev_cursor'],
+    })
 
 # ========== Управление наградами ==========
 @app.route('/admin/awards')
@@ -10145,16 +12246,16 @@ def admin_award_create():
             ''', (title, icon, image_path, sort_order, session['user_id']))
             award_id = cursor.lastrowid
             
-            # Присваиваем награду выбранным пользователям
+            # Присваиваем награду выбранным пользователям в той же транзакции
+            bulk_result = None
             if selected_users:
-                for user_id_str in selected_users:
-                    try:
-                        user_id = int(user_id_str)
-                        assign_award(user_id, award_id, assigned_by=session['user_id'])
-                    except ValueError:
-                        continue
+                bulk_result, _ = apply_bulk_user_operation(
+                    conn, 'assign_award', selected_users, target=award_id, actor_id=session['user_id']
+                )
             
             conn.commit()
+            if bulk_result:
+                finish_bulk_user_operation(bulk_result)
             flash('Награда успешно создана', 'success')
             conn.close()
             return redirect(url_for('admin_awards'))
@@ -10384,7 +12485,6 @@ def admin_events():
         
         if current_stage and current_stage.get('info', {}).get('type') == 'registration_closed':
             event_id = event_dict['id']
-            create_participant_approvals_for_event(event_id)
             conn_counts = get_db_connection()
             counts = conn_counts.execute('''
                 SELECT 
@@ -10510,6 +12610,8 @@ def admin_event_create():
             conn.commit()
             flash('Мероприятие успешно создано', 'success')
             conn.close()
+            # Этапы с датами в прошлом переходят сразу, не дожидаясь cron
+            run_stage_transitions(event_ids=[event_id])
             return redirect(url_for('admin_events'))
         except Exception as e:
             log_error(f"Error creating event: {e}")
@@ -10562,6 +12664,12 @@ def admin_event_view(event_id):
     global_rating_registration = get_rating_setting('rating_event_registration', 1)
     global_rating_gift_not_sent = get_rating_setting('rating_event_gift_not_sent', 0)
     global_rating_gift_sent = get_rating_setting('rating_event_gift_sent', 0)
+
+    try:
+        aggregates = get_event_aggregates(event_id)
+    except Exception as e:
+        log_error(f"Error getting aggregates for event {event_id}: {e}")
+        aggregates = None
     
     return render_template('admin/event_view.html', 
                          event=event_dict, 
@@ -10569,7 +12677,8 @@ def admin_event_view(event_id):
                          current_stage=current_stage,
                          global_rating_registration=global_rating_registration,
                          global_rating_gift_not_sent=global_rating_gift_not_sent,
-                         global_rating_gift_sent=global_rating_gift_sent)
+                         global_rating_gift_sent=global_rating_gift_sent,
+                         aggregates=aggregates)
 
 
 @app.route('/admin/events/<int:event_id>/participants')
@@ -10589,13 +12698,9 @@ def admin_event_participants(event_id):
         flash('Мероприятие не найдено', 'error')
         return redirect(url_for('admin_events'))
 
-    stages = conn.execute('''
-        SELECT stage_type, start_datetime
-        FROM event_stages
-        WHERE event_id = ?
-    ''', (event_id,)).fetchall()
-
-    participants = conn.execute('''
+    # Этап регистрации и статус ревью считаются в SQL (см. _EVENT_PARTICIPANT_BUCKETS_CTE)
+    participants = conn.execute(f'''
+        WITH {_EVENT_PARTICIPANT_BUCKETS_CTE}
         SELECT 
             er.user_id,
             er.registered_at,
@@ -10617,63 +12722,23 @@ def admin_event_participants(event_id):
             u.avatar_seed,
             u.avatar_style,
             u.email,
-            epa.approved AS approval_flag,
             epa.notes AS approval_notes,
-            epa.approved_at AS approval_timestamp,
-            epa.approved_by AS approval_by
+            pb.stage,
+            pb.approval_status
         FROM event_registrations er
         LEFT JOIN users u ON er.user_id = u.user_id
         LEFT JOIN event_registration_details d ON d.event_id = er.event_id AND d.user_id = er.user_id
         LEFT JOIN event_participant_approvals epa ON epa.event_id = er.event_id AND epa.user_id = er.user_id
-        WHERE er.event_id = ?
+        JOIN participant_buckets pb ON pb.user_id = er.user_id
+        WHERE er.event_id = :event_id
         ORDER BY u.username COLLATE NOCASE
-    ''', (event_id,)).fetchall()
+    ''', {'event_id': event_id}).fetchall()
     conn.close()
 
-    stage_times = {row['stage_type']: row['start_datetime'] for row in stages}
-
-    def parse_dt(value):
-        if not value:
-            return None
-        try:
-            return datetime.fromisoformat(str(value))
-        except ValueError:
-            try:
-                return datetime.strptime(str(value), '%Y-%m-%d %H:%M:%S')
-            except ValueError:
-                return None
-
-    pre_start = parse_dt(stage_times.get('pre_registration'))
-    main_start = parse_dt(stage_times.get('main_registration'))
-    registration_closed_start = parse_dt(stage_times.get('registration_closed'))
-
     participants_data = []
     for row in participants:
-        registered_at_dt = parse_dt(row['registered_at'])
-
-        stage_label = 'main'
-        if pre_start and main_start and registered_at_dt:
-            if registered_at_dt >= pre_start and registered_at_dt < main_start:
-                stage_label = 'pre'
-            else:
-                stage_label = 'main'
-        elif pre_start and registered_at_dt and not main_start:
-            if registered_at_dt < pre_start:
-                stage_label = 'pre'
-        elif main_start and registered_at_dt:
-            stage_label = 'pre' if registered_at_dt < main_start else 'main'
-
-        if registration_closed_start and registered_at_dt and registered_at_dt >= registration_closed_start:
-            stage_label = 'main'
-
-        approval_flag = row['approval_flag']
-        approval_timestamp = row['approval_timestamp']
-        approval_status = 'pending'
-        if approval_flag == 1:
-            approval_status = 'approved'
-        elif approval_flag == 0 and approval_timestamp:
-            approval_status = 'rejected'
-
+        stage_label = row['stage']
+        approval_status = row['approval_status']
         approval_notes = row['approval_notes']
 
         participants_data.append({
@@ -10808,7 +12873,7 @@ def admin_event_distribution_positive_view(event_id):
 
         conn_assignments = get_db_connection()
         # Загружаем пары и проверяем наличие сообщений от Деда Мороза для определения статуса отправки
-        # Используем подзапрос для проверки наличия сообщений
+        # (признак берется из сводки переписки letter_chat_summary)
         saved_rows = conn_assignments.execute('''
         SELECT 
             ea.santa_user_id, 
@@ -10821,13 +12886,11 @@ def admin_event_distribution_positive_view(event_id):
             ea.id as assignment_id,
             CASE 
                 WHEN (ea.santa_sent_at IS NOT NULL AND ea.santa_sent_at != '') THEN 1
-                WHEN EXISTS (
-                    SELECT 1 FROM letter_messages lm 
-                    WHERE lm.assignment_id = ea.id AND lm.sender = 'santa'
-                ) THEN 1
+                WHEN cs.has_santa_message = 1 THEN 1
                 ELSE 0 
             END as has_sent_indicator
         FROM event_assignments ea
+        LEFT JOIN letter_chat_summary cs ON cs.assignment_id = ea.id
         WHERE ea.event_id = ?
           AND (ea.is_archived = 0 OR ea.is_archived IS NULL)
         ORDER BY ea.assigned_at ASC, ea.id ASC
@@ -10963,7 +13026,7 @@ def admin_event_distribution_positive_unassign(event_id):
         
         # Проверяем, есть ли сообщения в чате
         message_count = conn.execute('''
-            SELECT COUNT(*) as cnt FROM letter_messages WHERE assignment_id = ?
+            SELECT message_count AS cnt FROM letter_chat_summary WHERE assignment_id = ?
         ''', (assignment_id,)).fetchone()
         
         has_messages = message_count and message_count['cnt'] > 0
@@ -11250,13 +13313,11 @@ def admin_event_distribution_positive_generate(event_id):
             ea.recipient_received_at,
             CASE 
                 WHEN (ea.santa_sent_at IS NOT NULL AND ea.santa_sent_at != '') THEN 1
-                WHEN EXISTS (
-                    SELECT 1 FROM letter_messages lm 
-                    WHERE lm.assignment_id = ea.id AND lm.sender = 'santa'
-                ) THEN 1
+                WHEN cs.has_santa_message = 1 THEN 1
                 ELSE 0 
             END as has_sent_indicator
         FROM event_assignments ea
+        LEFT JOIN letter_chat_summary cs ON cs.assignment_id = ea.id
         WHERE ea.event_id = ?
           AND ea.is_archived = 0
     ''', (event_id,)).fetchall()
@@ -11439,6 +13500,7 @@ def admin_event_participant_add(event_id):
 
         conn.commit()
         conn.close()
+        invalidate_event_aggregates(event_id)
 
         log_activity(
             'admin_event_add_participant',
@@ -11584,6 +13646,7 @@ def admin_event_participant_remove(event_id):
 
         conn.commit()
         conn.close()
+        invalidate_event_aggregates(event_id)
 
         log_activity(
             'admin_event_remove_participant',
@@ -11628,57 +13691,15 @@ def admin_event_participant_confirm(event_id):
             flash('Участник не найден в списке зарегистрированных', 'error')
             return redirect(url_for('admin_event_participants', event_id=event_id))
 
-        stages = conn.execute('''
-            SELECT stage_type, start_datetime
-            FROM event_stages
-            WHERE event_id = ?
-        ''', (event_id,)).fetchall()
-
-        def parse_dt(value):
-            if not value:
-                return None
-            try:
-                return datetime.fromisoformat(str(value))
-            except ValueError:
-                try:
-                    return datetime.strptime(str(value), '%Y-%m-%d %H:%M:%S')
-                except ValueError:
-                    return None
+        timeline = get_event_stage_timeline(conn, event_id)
+        stage_label = registration_stage_label(timeline, registration['registered_at'])
 
-        pre_start = None
-        main_start = None
-        registration_closed_start = None
-        for stage in stages:
-            if stage['stage_type'] == 'pre_registration':
-                pre_start = parse_dt(stage['start_datetime'])
-            elif stage['stage_type'] == 'main_registration':
-                main_start = parse_dt(stage['start_datetime'])
-            elif stage['stage_type'] == 'registration_closed':
-                registration_closed_start = parse_dt(stage['start_datetime'])
-
-        registered_at_dt = parse_dt(registration['registered_at'])
-
-        stage_label = 'main'
-        if pre_start and main_start and registered_at_dt:
-            if registered_at_dt >= pre_start and registered_at_dt < main_start:
-                stage_label = 'pre'
-        elif pre_start and registered_at_dt and not main_start:
-            if registered_at_dt < pre_start:
-                stage_label = 'pre'
-        elif main_start and registered_at_dt:
-            stage_label = 'pre' if registered_at_dt < main_start else 'main'
-
-        if registration_closed_start and registered_at_dt and registered_at_dt >= registration_closed_start:
-            stage_label = 'main'
-
-        if stage_label != 'main' and main_start:
+        if stage_label != 'main' and timeline['main']:
             conn.execute('''
                 UPDATE event_registrations
                 SET registered_at = ?
                 WHERE event_id = ? AND user_id = ?
-            ''', (main_start.strftime('%Y-%m-%d %H:%M:%S'), event_id, user_id_int))
-            registered_at_dt = main_start
-            stage_label = 'main'
+            ''', (timeline['main'].strftime('%Y-%m-%d %H:%M:%S'), event_id, user_id_int))
 
         conn.execute('''
             INSERT INTO event_participant_approvals (event_id, user_id, approved, approved_at, approved_by, notes)
@@ -11691,6 +13712,7 @@ def admin_event_participant_confirm(event_id):
         ''', (event_id, user_id_int, session.get('user_id')))
         conn.commit()
         conn.close()
+        invalidate_event_aggregates(event_id)
 
         log_activity(
             'admin_event_confirm_participant',
@@ -11735,48 +13757,8 @@ def admin_event_participant_reject(event_id):
             flash('Участник не найден в списке зарегистрированных', 'error')
             return redirect(url_for('admin_event_participants', event_id=event_id))
 
-        stages = conn.execute('''
-            SELECT stage_type, start_datetime
-            FROM event_stages
-            WHERE event_id = ?
-        ''', (event_id,)).fetchall()
-
-        def parse_dt(value):
-            if not value:
-                return None
-            try:
-                return datetime.fromisoformat(str(value))
-            except ValueError:
-                try:
-                    return datetime.strptime(str(value), '%Y-%m-%d %H:%M:%S')
-                except ValueError:
-                    return None
-
-        pre_start = None
-        main_start = None
-        registration_closed_start = None
-        for stage in stages:
-            if stage['stage_type'] == 'pre_registration':
-                pre_start = parse_dt(stage['start_datetime'])
-            elif stage['stage_type'] == 'main_registration':
-                main_start = parse_dt(stage['start_datetime'])
-            elif stage['stage_type'] == 'registration_closed':
-                registration_closed_start = parse_dt(stage['start_datetime'])
-
-        registered_at_dt = parse_dt(registration['registered_at'])
-
-        stage_label = 'main'
-        if pre_start and main_start and registered_at_dt:
-            if registered_at_dt < main_start:
-                stage_label = 'pre'
-        elif pre_start and registered_at_dt and not main_start:
-            if registered_at_dt < pre_start:
-                stage_label = 'pre'
-        elif main_start and registered_at_dt:
-            stage_label = 'pre' if registered_at_dt < main_start else 'main'
-
-        if registration_closed_start and registered_at_dt and registered_at_dt >= registration_closed_start:
-            stage_label = 'main'
+        timeline = get_event_stage_timeline(conn, event_id)
+        stage_label = registration_stage_label(timeline, registration['registered_at'])
 
         if stage_label != 'main':
             conn.close()
@@ -11794,6 +13776,7 @@ def admin_event_participant_reject(event_id):
         ''', (event_id, user_id_int, session.get('user_id'), reason or None))
         conn.commit()
         conn.close()
+        invalidate_event_aggregates(event_id)
 
         log_activity(
             'admin_event_reject_participant',
@@ -11811,125 +13794,1084 @@ def admin_event_participant_reject(event_id):
 
     return redirect(url_for('admin_event_participants', event_id=event_id))
 
-@app.route('/admin/events/<int:event_id>/distribution/positive/save', methods=['POST'])
-@require_role('admin')
-def admin_event_distribution_positive_save(event_id):
-    data = request.get_json(silent=True) or {}
-    pairs = data.get('pairs')
-    
-    log_debug(f"admin_event_distribution_positive_save: event_id={event_id}, pairs type={type(pairs)}, pairs length={len(pairs) if pairs else 0}")
-    
-    if not pairs or not isinstance(pairs, list):
-        log_error(f"admin_event_distribution_positive_save: Invalid pairs data. Type: {type(pairs)}, Value: {pairs}")
-        return jsonify({'success': False, 'error': 'Некорректные данные распределения'}), 400
+# ========== Массовое ревью участников ==========
+# Этапы мероприятия читаются и разбираются один раз на запрос, этап регистрации
+# участника определяется так же, как в _EVENT_PARTICIPANT_BUCKETS_CTE.
+# Массовое ревью проверяет все записи в памяти и пишет изменения одной транзакцией.
 
-    enforce_country = bool(data.get('enforce_country'))
+PARTICIPANT_REVIEW_STATUSES = ('approved', 'rejected', 'pending')
+PARTICIPANT_BULK_REVIEW_MAX_ITEMS = 1000
 
-    user_id = session.get('user_id')
-    if not user_id:
-        return jsonify({'success': False, 'error': 'Необходима авторизация'}), 403
 
-    conn = get_db_connection()
-    # Используем ту же логику, что и в генерации: только зарегистрированные И утвержденные участники
-    approved_rows = conn.execute('''
-        SELECT 
-            er.user_id, 
-            COALESCE(d.country, u.country) AS country
-        FROM event_registrations er
-        LEFT JOIN event_participant_approvals epa ON epa.event_id = er.event_id AND epa.user_id = er.user_id
-        JOIN users u ON er.user_id = u.user_id
-        LEFT JOIN event_registration_details d ON d.event_id = er.event_id AND d.user_id = er.user_id
-        WHERE er.event_id = ?
-          AND epa.approved = 1
+def get_event_stage_timeline(conn, event_id):
+    """Начала этапов регистрации мероприятия: {'pre', 'main', 'closed'} -> datetime или None"""
+    stage_keys = {
+        'pre_registration': 'pre',
+        'main_registration': 'main',
+        'registration_closed': 'closed',
+    }
+    timeline = {'pre': None, 'main': None, 'closed': None}
+    rows = conn.execute('''
+        SELECT stage_type, start_datetime
+        FROM event_stages
+        WHERE event_id = ?
     ''', (event_id,)).fetchall()
-    approved_ids = {row['user_id'] for row in approved_rows}
-    country_lookup = {row['user_id']: row['country'] for row in approved_rows}
-    conn.close()
+    for row in rows:
+        key = stage_keys.get(row['stage_type'])
+        if key:
+            timeline[key] = parse_event_datetime(row['start_datetime'])
+    return timeline
+
+
+def registration_stage_label(timeline, registered_at):
+    """Этап регистрации участника ('pre' или 'main') по разобранным этапам мероприятия"""
+    registered_dt = parse_event_datetime(registered_at)
+    pre_start = timeline['pre']
+    main_start = timeline['main']
+    closed_start = timeline['closed']
+    if registered_dt is None:
+        return 'main'
+    if closed_start and registered_dt >= closed_start:
+        return 'main'
+    if pre_start and main_start:
+        return 'pre' if pre_start <= registered_dt < main_start else 'main'
+    if pre_start:
+        return 'pre' if registered_dt < pre_start else 'main'
+    if main_start:
+        return 'pre' if registered_dt < main_start else 'main'
+    return 'main'
+
+
+def _participant_approval_status(approved, approved_at):
+    if approved == 1:
+        return 'approved'
+    if approved == 0 and approved_at:
+        return 'rejected'
+    return 'pending'
+
+
+def _parse_bulk_review_items(data):
+    """Записи ревью из JSON: items или короткая форма user_ids + status + notes"""
+    items = data.get('items')
+    if items is None:
+        user_ids = data.get('user_ids')
+        if not isinstance(user_ids, list):
+            return None
+        items = [
+            {'user_id': user_id, 'status': data.get('status'), 'notes': data.get('notes')}
+            for user_id in user_ids
+        ]
+    return items if isinstance(items, list) else None
 
-    log_debug(f"admin_event_distribution_positive_save: approved_ids count={len(approved_ids)}, approved_ids={sorted(approved_ids)}")
 
-    if len(approved_ids) < 2:
-        log_error(f"admin_event_distribution_positive_save: Not enough approved participants. Count: {len(approved_ids)}")
-        return jsonify({'success': False, 'error': 'Недостаточно утверждённых участников для сохранения распределения'}), 400
+@app.route('/admin/events/<int:event_id>/participants/bulk-review', methods=['POST'])
+@require_role('admin')
+def admin_event_participants_bulk_review(event_id):
+    """Массовое подтверждение, отказ или сброс решения по участникам.
 
-    assignments = []
-    santas_seen = set()
-    recipients_seen = set()
+    Принимает JSON {"items": [{"user_id", "status", "notes"}]} или
+    {"user_ids": [...], "status": ..., "notes": ...}; status - approved/rejected/pending.
+    Возвращает изменения по участникам, ошибки по отдельным записям и новые счетчики вкладок.
+    """
+    data = request.get_json(silent=True) or {}
+    items = _parse_bulk_review_items(data)
+    if not items:
+        return jsonify({'success': False, 'error': 'Не выбраны участники'}), 400
+    if len(items) > PARTICIPANT_BULK_REVIEW_MAX_ITEMS:
+        return jsonify({
+            'success': False,
+            'error': f'За один раз можно обработать не более {PARTICIPANT_BULK_REVIEW_MAX_ITEMS} участников'
+        }), 400
 
-    try:
-        for idx, entry in enumerate(pairs):
-            if not isinstance(entry, dict):
-                log_error(f"admin_event_distribution_positive_save: Entry {idx} is not a dict: {entry}")
-                return jsonify({'success': False, 'error': f'Некорректный формат пары #{idx + 1}'}), 400
-            
-            santa_id_raw = entry.get('santa_id')
-            recipient_id_raw = entry.get('recipient_id')
-            
-            if santa_id_raw is None or recipient_id_raw is None:
-                log_error(f"admin_event_distribution_positive_save: Entry {idx} missing IDs: santa_id={santa_id_raw}, recipient_id={recipient_id_raw}")
-                return jsonify({'success': False, 'error': f'Пара #{idx + 1} содержит некорректные идентификаторы'}), 400
-            
-            try:
-                santa_id = int(santa_id_raw)
-                recipient_id = int(recipient_id_raw)
-            except (TypeError, ValueError) as e:
-                log_error(f"admin_event_distribution_positive_save: Entry {idx} invalid IDs: santa_id={santa_id_raw}, recipient_id={recipient_id_raw}, error={e}")
-                return jsonify({'success': False, 'error': f'Пара #{idx + 1} содержит некорректные идентификаторы'}), 400
-            
-            if santa_id == recipient_id:
-                log_error(f"admin_event_distribution_positive_save: Entry {idx} santa equals recipient: {santa_id}")
-                return jsonify({'success': False, 'error': f'Участник {santa_id} не может быть назначен самому себе'}), 400
-            
-            if santa_id not in approved_ids:
-                log_error(f"admin_event_distribution_positive_save: Entry {idx} santa_id {santa_id} not in approved_ids. Approved: {sorted(approved_ids)}")
-                return jsonify({'success': False, 'error': f'Пользователь {santa_id} не входит в список утверждённых участников'}), 400
-            
-            if recipient_id not in approved_ids:
-                log_error(f"admin_event_distribution_positive_save: Entry {idx} recipient_id {recipient_id} not in approved_ids. Approved: {sorted(approved_ids)}")
-                return jsonify({'success': False, 'error': f'Получатель {recipient_id} не входит в список утверждённых участников'}), 400
-            
-            santa_country = country_lookup.get(santa_id)
-            recipient_country = country_lookup.get(recipient_id)
-            if enforce_country and santa_country and recipient_country and santa_country != recipient_country:
-                log_error(f"admin_event_distribution_positive_save: Entry {idx} country mismatch: santa={santa_country}, recipient={recipient_country}")
-                return jsonify({'success': False, 'error': f'При распределении по странам Дед Мороз ({santa_country}) и Внучок ({recipient_country}) должны быть из одной страны'}), 400
-            
-            if santa_id in santas_seen:
-                log_error(f"admin_event_distribution_positive_save: Entry {idx} duplicate santa_id: {santa_id}")
-                return jsonify({'success': False, 'error': f'Дед Мороз {santa_id} встречается более одного раза'}), 400
-            
-            if recipient_id in recipients_seen:
-                log_error(f"admin_event_distribution_positive_save: Entry {idx} duplicate recipient_id: {recipient_id}")
-                return jsonify({'success': False, 'error': f'Получатель {recipient_id} встречается более одного раза'}), 400
-            
-            santas_seen.add(santa_id)
-            recipients_seen.add(recipient_id)
-            assignments.append((santa_id, recipient_id))
-    except Exception as e:
-        log_error(f"admin_event_distribution_positive_save: Unexpected error processing pairs: {e}")
-        import traceback
-        log_error(traceback.format_exc())
-        return jsonify({'success': False, 'error': f'Ошибка обработки данных: {str(e)}'}), 400
+    errors = []
+    requested = {}
+    for item in items:
+        if not isinstance(item, dict):
+            errors.append({'user_id': None, 'error': 'Некорректная запись'})
+            continue
+        try:
+            user_id = int(item.get('user_id'))
+        except (TypeError, ValueError):
+            errors.append({'user_id': item.get('user_id'), 'error': 'Некорректный участник'})
+            continue
+        status = item.get('status')
+        if status not in PARTICIPANT_REVIEW_STATUSES:
+            errors.append({'user_id': user_id, 'error': 'Неизвестный статус'})
+            continue
+        notes = _normalize_multiline_text(item.get('notes'), max_length=500) or None
+        requested[user_id] = (status, notes)
 
-    locked_pairs_raw = data.get('locked_pairs') or []
-    locked_pairs_set = set()
+    conn = get_db_connection()
     try:
-        for entry in locked_pairs_raw:
-            santa_id = int(entry.get('santa_id'))
-            recipient_id = int(entry.get('recipient_id'))
-            locked_pairs_set.add((santa_id, recipient_id))
-    except (TypeError, ValueError, AttributeError):
-        return jsonify({'success': False, 'error': 'Некорректные данные закреплённых пар'}), 400
+        event = conn.execute('SELECT id FROM events WHERE id = ?', (event_id,)).fetchone()
+        if not event:
+            return jsonify({'success': False, 'error': 'Мероприятие не найдено'}), 404
+
+        timeline = get_event_stage_timeline(conn, event_id)
+        registrations = {}
+        user_ids = list(requested)
+        for start in range(0, len(user_ids), 500):
+            chunk = user_ids[start:start + 500]
+            placeholders = ','.join(['?'] * len(chunk))
+            rows = conn.execute(f'''
+                SELECT er.user_id, er.registered_at, epa.approved, epa.approved_at, epa.notes
+                FROM event_registrations er
+                LEFT JOIN event_participant_approvals epa
+                    ON epa.event_id = er.event_id AND epa.user_id = er.user_id
+                WHERE er.event_id = ? AND er.user_id IN ({placeholders})
+            ''', [event_id] + chunk).fetchall()
+            for row in rows:
+                registrations[row['user_id']] = row
+
+        admin_id = session.get('user_id')
+        main_start_value = timeline['main'].strftime('%Y-%m-%d %H:%M:%S') if timeline['main'] else None
+        stage_updates = []
+        approval_rows = []
+        updated = []
+        unchanged = []
+        for user_id, (status, notes) in requested.items():
+            row = registrations.get(user_id)
+            if row is None:
+                errors.append({'user_id': user_id, 'error': 'Участник не найден в списке зарегистрированных'})
+                continue
+            stage = registration_stage_label(timeline, row['registered_at'])
+            previous = {
+                'stage': stage,
+                'approval_status': _participant_approval_status(row['approved'], row['approved_at']),
+                'approval_notes': row['notes']
+            }
+            if status == 'rejected' and stage != 'main':
+                errors.append({'user_id': user_id, 'error': 'Отказ возможен только для основной регистрации'})
+                continue
 
-    log_debug(f"admin_event_distribution_positive_save: assignments count={len(assignments)}, approved_ids count={len(approved_ids)}")
-    log_debug(f"admin_event_distribution_positive_save: assignments santas={sorted(santas_seen)}, approved_ids={sorted(approved_ids)}")
-    
-    # Проверяем, что все участники из распределения есть в списке утвержденных
-    all_santa_ids = set(pair[0] for pair in assignments)
-    all_recipient_ids = set(pair[1] for pair in assignments)
-    
-    invalid_santas = all_santa_ids - approved_ids
-    invalid_recipients = all_recipient_ids - approved_ids
+            new_stage = stage
+            if status == 'approved':
+                # Как и одиночное подтверждение: переводим в основную регистрацию, заметку очищаем
+                notes = None
+                if stage != 'main' and main_start_value:
+                    stage_updates.append((main_start_value, event_id, user_id))
+                    new_stage = 'main'
+
+            current = {'stage': new_stage, 'approval_status': status, 'approval_notes': notes}
+            if current == previous:
+                unchanged.append(user_id)
+                continue
+            approval_rows.append((
+                event_id, user_id,
+                1 if status == 'approved' else 0,
+                0 if status == 'pending' else 1,
+                admin_id, notes
+            ))
+            updated.append(dict(current, user_id=user_id, previous=previous))
+
+        if stage_updates:
+            conn.executemany('''
+                UPDATE event_registrations
+                SET registered_at = ?
+                WHERE event_id = ? AND user_id = ?
+            ''', stage_updates)
+        if approval_rows:
+            conn.executemany('''
+                INSERT INTO event_participant_approvals (event_id, user_id, approved, approved_at, approved_by, notes)
+                VALUES (?, ?, ?, CASE WHEN ? THEN CURRENT_TIMESTAMP END, ?, ?)
+                ON CONFLICT(event_id, user_id) DO UPDATE SET
+                    approved = excluded.approved,
+                    approved_at = excluded.approved_at,
+                    approved_by = excluded.approved_by,
+                    notes = excluded.notes
+            ''', approval_rows)
+        conn.commit()
+    except Exception as exc:
+        conn.rollback()
+        log_error(f"Error in bulk participant review for event {event_id}: {exc}")
+        return jsonify({'success': False, 'error': 'Не удалось сохранить решения по участникам'}), 500
+    finally:
+        conn.close()
+
+    if updated:
+        invalidate_event_aggregates(event_id)
+        status_counts = {}
+        for change in updated:
+            status_counts[change['approval_status']] = status_counts.get(change['approval_status'], 0) + 1
+        log_activity(
+            'admin_event_bulk_review',
+            details=f'Массовое ревью участников мероприятия #{event_id}: изменено {len(updated)}',
+            metadata={
+                'event_id': event_id,
+                'statuses': status_counts,
+                'target_user_ids': [change['user_id'] for change in updated]
+            }
+        )
+
+    return jsonify({
+        'success': True,
+        'updated': updated,
+        'unchanged': unchanged,
+        'errors': errors,
+        'counts': get_event_aggregates(event_id)['participants']
+    })
+
+
+# ========== Экспорт данных мероприятия ==========
+# Выгрузки участников, подтвержденных, назначений с адресами получателей и статуса
+# подарков. Строки читаются курсором порциями по EXPORT_BATCH_SIZE и сразу отдаются
+# клиенту генератором, поэтому память не растет с числом строк. CSV - UTF-8 с BOM
+# (открывается в Excel), XLSX - один лист без стилей со строками inline.
+
+EXPORT_BATCH_SIZE = 500
+XLSX_MIMETYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+_EXPORT_LABELS = {
+    'stage': {'pre': 'Предварительная', 'main': 'Основная'},
+    'approval_status': {'approved': 'Подтвержден', 'rejected': 'Отклонен', 'pending': 'Ожидает решения'},
+    'gift_status': {'not_sent': 'Не отправлен', 'sent': 'Отправлен', 'received': 'Получен'},
+}
+
+_EXPORT_PARTICIPANT_COLUMNS = (
+    ('user_id', 'ID'),
+    ('username', 'Пользователь'),
+    ('stage', 'Этап регистрации'),
+    ('approval_status', 'Статус'),
+    ('registered_at', 'Дата регистрации'),
+    ('last_name', 'Фамилия'),
+    ('first_name', 'Имя'),
+    ('middle_name', 'Отчество'),
+    ('postal_code', 'Индекс'),
+    ('country', 'Страна'),
+    ('city', 'Город'),
+    ('street', 'Улица'),
+    ('house', 'Дом'),
+    ('building', 'Корпус'),
+    ('apartment', 'Квартира'),
+    ('phone', 'Телефон'),
+    ('email', 'Email'),
+    ('telegram', 'Telegram'),
+    ('whatsapp', 'WhatsApp'),
+    ('viber', 'Viber'),
+)
+
+_EXPORT_PARTICIPANTS_QUERY = f'''
+    WITH {_EVENT_PARTICIPANT_BUCKETS_CTE}
+    SELECT
+        er.user_id,
+        u.username,
+        pb.stage,
+        pb.approval_status,
+        er.registered_at,
+        COALESCE(d.last_name, u.last_name) AS last_name,
+        COALESCE(d.first_name, u.first_name) AS first_name,
+        COALESCE(d.middle_name, u.middle_name) AS middle_name,
+        COALESCE(d.postal_code, u.postal_code) AS postal_code,
+        COALESCE(d.country, u.country) AS country,
+        COALESCE(d.city, u.city) AS city,
+        COALESCE(d.street, u.street) AS street,
+        COALESCE(d.house, u.house) AS house,
+        COALESCE(d.building, u.building) AS building,
+        COALESCE(d.apartment, u.apartment) AS apartment,
+        COALESCE(d.phone, u.phone) AS phone,
+        COALESCE(d.email, u.email) AS email,
+        COALESCE(d.telegram, u.telegram) AS telegram,
+        COALESCE(d.whatsapp, u.whatsapp) AS whatsapp,
+        COALESCE(d.viber, u.viber) AS viber
+    FROM event_registrations er
+    JOIN participant_buckets pb ON pb.user_id = er.user_id
+    LEFT JOIN users u ON u.user_id = er.user_id
+    LEFT JOIN event_registration_details d ON d.event_id = er.event_id AND d.user_id = er.user_id
+    WHERE er.event_id = :event_id {{where}}
+    ORDER BY er.user_id
+'''
+
+_EXPORT_ASSIGNMENTS_QUERY = '''
+    SELECT
+        ea.id AS assignment_id,
+        ea.santa_user_id,
+        su.username AS santa_username,
+        ea.recipient_user_id,
+        ru.username AS recipient_username,
+        COALESCE(d.last_name, ru.last_name) AS last_name,
+        COALESCE(d.first_name, ru.first_name) AS first_name,
+        COALESCE(d.middle_name, ru.middle_name) AS middle_name,
+        COALESCE(d.postal_code, ru.postal_code) AS postal_code,
+        COALESCE(d.country, ru.country) AS country,
+        COALESCE(d.city, ru.city) AS city,
+        COALESCE(d.street, ru.street) AS street,
+        COALESCE(d.house, ru.house) AS house,
+        COALESCE(d.building, ru.building) AS building,
+        COALESCE(d.apartment, ru.apartment) AS apartment,
+        COALESCE(d.phone, ru.phone) AS phone,
+        ea.assigned_at
+    FROM event_assignments ea
+    LEFT JOIN users su ON su.user_id = ea.santa_user_id
+    LEFT JOIN users ru ON ru.user_id = ea.recipient_user_id
+    LEFT JOIN event_registration_details d ON d.event_id = ea.event_id AND d.user_id = ea.recipient_user_id
+    WHERE ea.event_id = :event_id AND ea.is_archived = 0
+    ORDER BY ea.id
+'''
+
+_EXPORT_GIFTS_QUERY = '''
+    SELECT
+        ea.id AS assignment_id,
+        ea.santa_user_id,
+        su.username AS santa_username,
+        ea.recipient_user_id,
+        ru.username AS recipient_username,
+        CASE
+            WHEN COALESCE(ea.recipient_received_at, '') != '' THEN 'received'
+            WHEN COALESCE(ea.santa_sent_at, '') != '' THEN 'sent'
+            ELSE 'not_sent'
+        END AS gift_status,
+        ea.santa_sent_at,
+        ea.santa_send_info,
+        ea.recipient_received_at,
+        ea.recipient_thanks_message
+    FROM event_assignments ea
+    LEFT JOIN users su ON su.user_id = ea.santa_user_id
+    LEFT JOIN users ru ON ru.user_id = ea.recipient_user_id
+    WHERE ea.event_id = :event_id AND ea.is_archived = 0
+    ORDER BY ea.id
+'''
+
+EVENT_EXPORTS = {
+    'participants': {
+        'title': 'Участники',
+        'columns': _EXPORT_PARTICIPANT_COLUMNS,
+        'query': _EXPORT_PARTICIPANTS_QUERY.format(where=''),
+    },
+    'approved': {
+        'title': 'Подтвержденные',
+        'columns': _EXPORT_PARTICIPANT_COLUMNS,
+        'query': _EXPORT_PARTICIPANTS_QUERY.format(where="AND pb.approval_status = 'approved'"),
+    },
+    'assignments': {
+        'title': 'Назначения',
+        'columns': (
+            ('assignment_id', 'ID назначения'),
+            ('santa_user_id', 'ID Деда Мороза'),
+            ('santa_username', 'Дед Мороз'),
+            ('recipient_user_id', 'ID получателя'),
+            ('recipient_username', 'Получатель'),
+            ('last_name', 'Фамилия'),
+            ('first_name', 'Имя'),
+            ('middle_name', 'Отчество'),
+            ('postal_code', 'Индекс'),
+            ('country', 'Страна'),
+            ('city', 'Город'),
+            ('street', 'Улица'),
+            ('house', 'Дом'),
+            ('building', 'Корпус'),
+            ('apartment', 'Квартира'),
+            ('phone', 'Телефон'),
+            ('assigned_at', 'Дата назначения'),
+        ),
+        'query': _EXPORT_ASSIGNMENTS_QUERY,
+    },
+    'gifts': {
+        'title': 'Подарки',
+        'columns': (
+            ('assignment_id', 'ID назначения'),
+            ('santa_user_id', 'ID Деда Мороза'),
+            ('santa_username', 'Дед Мороз'),
+            ('recipient_user_id', 'ID получателя'),
+            ('recipient_username', 'Получатель'),
+            ('gift_status', 'Статус подарка'),
+            ('santa_sent_at', 'Отправлен'),
+            ('santa_send_info', 'Данные об отправке'),
+            ('recipient_received_at', 'Получен'),
+            ('recipient_thanks_message', 'Благодарность'),
+        ),
+        'query': _EXPORT_GIFTS_QUERY,
+    },
+}
+
+
+def iter_export_rows(query, params, columns):
+    """Строки выгрузки (списки значений) порциями из курсора; соединение живет, пока идет чтение"""
+    conn = get_db_connection()
+    try:
+        cursor = conn.execute(query, params)
+        keys = [key for key, _ in columns]
+        while True:
+            batch = cursor.fetchmany(EXPORT_BATCH_SIZE)
+            if not batch:
+                break
+            for row in batch:
+                values = []
+                for key in keys:
+                    value = row[key]
+                    labels = _EXPORT_LABELS.get(key)
+                    values.append(labels.get(value, value) if labels else value)
+                yield values
+    finally:
+        conn.close()
+
+
+# Excel и LibreOffice считают формулой ячейку, начинающуюся с одного из этих символов
+_CSV_FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')
+# Контакты остаются как есть (+7..., @username), если похожи на телефон или ник:
+# без букв и ссылок на ячейки такая "формула" ничего не выполняет
+_CSV_CONTACT_RE = {
+    'phone': re.compile(r'^\+?[\d\s()\-]+$'),
+    'whatsapp': re.compile(r'^\+?[\d\s()\-]+$'),
+    'viber': re.compile(r'^\+?[\d\s()\-]+$'),
+    'telegram': re.compile(r'^@?\w{1,64}$', re.ASCII),
+}
+
+
+def _csv_cell(value, key=None):
+    if value is None:
+        return ''
+    text = str(value)
+    if text.startswith(_CSV_FORMULA_PREFIXES):
+        contact_re = _CSV_CONTACT_RE.get(key)
+        if not (contact_re and contact_re.match(text)):
+            return "'" + text
+    return text
+
+
+def stream_csv(headers, rows, keys=None):
+    """CSV построчно: заголовок и строки отдаются порциями по EXPORT_BATCH_SIZE.
+
+    keys - ключи колонок: по ним телефоны и Telegram не экранируются как формулы.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    buffer.write('\ufeff')
+    writer.writerow(headers)
+    keys = list(keys or [])
+    pending = 0
+    for values in rows:
+        writer.writerow([
+            _csv_cell(value, keys[index] if index < len(keys) else None)
+            for index, value in enumerate(values)
+        ])
+        pending += 1
+        if pending >= EXPORT_BATCH_SIZE:
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+            pending = 0
+    yield buffer.getvalue().encode('utf-8')
+
+
+class _ChunkSink:
+    """Файлоподобный приемник для zipfile: накопленные байты забираются через drain()"""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+_XLSX_INVALID_CHARS_RE = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+_XLSX_STATIC_PARTS = (
+    ('[Content_Types].xml',
+     '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+     '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+     '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+     '<Default Extension="xml" ContentType="application/xml"/>'
+     '<Override PartName="/xl/workbook.xml" '
+     'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+     '<Override PartName="/xl/worksheets/sheet1.xml" '
+     'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+     '</Types>'),
+    ('_rels/.rels',
+     '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+     '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+     '<Relationship Id="rId1" '
+     'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+     'Target="xl/workbook.xml"/>'
+     '</Relationships>'),
+    ('xl/_rels/workbook.xml.rels',
+     '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+     '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+     '<Relationship Id="rId1" '
+     'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" '
+     'Target="worksheets/sheet1.xml"/>'
+     '</Relationships>'),
+)
+
+
+def _xlsx_cell(value):
+    if value is None or value == '':
+        return '<c/>'
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return f'<c><v>{value}</v></c>'
+    text = _XLSX_INVALID_CHARS_RE.sub('', str(value))
+    return f'<c t="inlineStr"><is><t xml:space="preserve">{xml_escape(text)}</t></is></c>'
+
+
+def stream_xlsx(headers, rows, sheet_name='Лист1'):
+    """XLSX с одним листом: лист сжимается и отдается по мере записи строк"""
+    sink = _ChunkSink()
+    with zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        for name, content in _XLSX_STATIC_PARTS:
+            archive.writestr(name, content)
+        archive.writestr(
+            'xl/workbook.xml',
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+            'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+            f'<sheets><sheet name="{xml_escape(sheet_name[:31])}" sheetId="1" r:id="rId1"/></sheets>'
+            '</workbook>'
+        )
+        with archive.open('xl/worksheets/sheet1.xml', 'w') as sheet:
+            sheet.write(
+                '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>'
+                .encode('utf-8')
+            )
+            sheet.write(('<row>' + ''.join(_xlsx_cell(value) for value in headers) + '</row>').encode('utf-8'))
+            pending = 0
+            for values in rows:
+                sheet.write(('<row>' + ''.join(_xlsx_cell(value) for value in values) + '</row>').encode('utf-8'))
+                pending += 1
+                if pending >= EXPORT_BATCH_SIZE:
+                    pending = 0
+                    data = sink.drain()
+                    if data:
+                        yield data
+            sheet.write(b'</sheetData></worksheet>')
+    yield sink.drain()
+
+
+@app.route('/admin/events/<int:event_id>/export/<kind>')
+@require_role('admin')
+def admin_event_export(event_id, kind):
+    """Потоковая выгрузка данных мероприятия в CSV или XLSX (?format=csv|xlsx)"""
+    export = EVENT_EXPORTS.get(kind)
+    if not export:
+        abort(404)
+    export_format = request.args.get('format', 'csv')
+    if export_format not in ('csv', 'xlsx'):
+        abort(400)
+
+    conn = get_db_connection()
+    try:
+        event = conn.execute('SELECT id FROM events WHERE id = ?', (event_id,)).fetchone()
+    finally:
+        conn.close()
+    if not event:
+        abort(404)
+
+    headers = [title for _, title in export['columns']]
+    rows = iter_export_rows(export['query'], {'event_id': event_id}, export['columns'])
+    if export_format == 'xlsx':
+        body = stream_xlsx(headers, rows, sheet_name=export['title'])
+        mimetype = XLSX_MIMETYPE
+    else:
+        body = stream_csv(headers, rows, keys=[key for key, _ in export['columns']])
+        mimetype = 'text/csv'
+
+    log_activity(
+        'admin_event_export',
+        details=f'Выгрузка "{export["title"]}" мероприятия #{event_id} ({export_format})',
+        metadata={'event_id': event_id, 'kind': kind, 'format': export_format}
+    )
+    response = Response(body, mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename="event_{event_id}_{kind}.{export_format}"'
+    return response
+
+
+# ========== Импорт пользователей и участников ==========
+# CSV читается построчно, каждая строка проверяется сразу, корректные строки копятся
+# в порцию по batch_size и пишутся одной транзакцией: пользователи, регистрации и
+# анкеты участников - executemany с ON CONFLICT. Пустые ячейки не затирают
+# существующие данные. В режиме проверки (dry run) порция откатывается вместо commit.
+# Заголовки - ключи полей (user_id, username, city, ...) или названия колонок выгрузки,
+# разделитель ',' или ';' определяется по строке заголовков.
+
+IMPORT_BATCH_SIZE = 1000
+IMPORT_MAX_BATCH_SIZE = 10000
+IMPORT_MAX_ERRORS = 500
+IMPORT_FIELD_MAX_LENGTH = 255
+
+IMPORT_PROFILE_FIELDS = (
+    'last_name', 'first_name', 'middle_name',
+    'postal_code', 'country', 'city', 'street', 'house', 'building', 'apartment',
+    'email', 'phone', 'telegram', 'whatsapp', 'viber',
+)
+
+_IMPORT_STAGE_VALUES = {
+    'pre': 'pre',
+    'main': 'main',
+    'предварительная': 'pre',
+    'основная': 'main',
+}
+
+_IMPORT_PROFILE_COLUMNS = ', '.join(IMPORT_PROFILE_FIELDS)
+_IMPORT_PROFILE_PLACEHOLDERS = ', '.join(['?'] * len(IMPORT_PROFILE_FIELDS))
+
+_IMPORT_USERS_UPSERT = f'''
+    INSERT INTO users (user_id, username, avatar_seed, avatar_style, language, {_IMPORT_PROFILE_COLUMNS})
+    VALUES (?, ?, ?, 'avataaars', 'ru', {_IMPORT_PROFILE_PLACEHOLDERS})
+    ON CONFLICT(user_id) DO UPDATE SET
+        username = COALESCE(NULLIF(excluded.username, ''), users.username),
+        {', '.join(f'{field} = COALESCE(excluded.{field}, users.{field})' for field in IMPORT_PROFILE_FIELDS)}
+'''
+
+_IMPORT_DETAILS_UPSERT = f'''
+    INSERT INTO event_registration_details (event_id, user_id, {_IMPORT_PROFILE_COLUMNS})
+    VALUES (?, ?, {_IMPORT_PROFILE_PLACEHOLDERS})
+    ON CONFLICT(event_id, user_id) DO UPDATE SET
+        {', '.join(f'{field} = COALESCE(excluded.{field}, {field})' for field in IMPORT_PROFILE_FIELDS)},
+        updated_at = CURRENT_TIMESTAMP
+'''
+
+
+def _import_column_map(header):
+    """Номера колонок CSV по ключам полей; понимает и заголовки выгрузки участников"""
+    known = {'user_id', 'username', 'stage'} | set(IMPORT_PROFILE_FIELDS)
+    aliases = {title.lower(): key for key, title in _EXPORT_PARTICIPANT_COLUMNS if key in known}
+    columns = {}
+    for index, name in enumerate(header):
+        name = (name or '').strip().lower()
+        key = name if name in known else aliases.get(name)
+        if key and key not in columns:
+            columns[key] = index
+    return columns
+
+
+def _parse_import_row(values, columns):
+    """Проверяет строку CSV. Возвращает (запись, ошибка)"""
+    def cell(key):
+        index = columns.get(key)
+        if index is None or index >= len(values):
+            return ''
+        return (values[index] or '').strip()
+
+    try:
+        user_id = int(cell('user_id'))
+    except ValueError:
+        return None, 'Некорректный ID пользователя'
+    if user_id <= 0:
+        return None, 'Некорректный ID пользователя'
+
+    username = cell('username')
+    if len(username) > IMPORT_FIELD_MAX_LENGTH:
+        return None, 'Слишком длинное имя пользователя'
+    profile = {}
+    for field in IMPORT_PROFILE_FIELDS:
+        value = cell(field)
+        if len(value) > IMPORT_FIELD_MAX_LENGTH:
+            return None, f'Слишком длинное значение в колонке {field}'
+        profile[field] = value or None
+    if profile['email'] and '@' not in profile['email']:
+        return None, 'Некорректный email'
+
+    stage = None
+    raw_stage = cell('stage')
+    if raw_stage:
+        stage = _IMPORT_STAGE_VALUES.get(raw_stage.lower())
+        if stage is None:
+            return None, 'Неизвестный этап регистрации (pre или main)'
+    return {'user_id': user_id, 'username': username, 'profile': profile, 'stage': stage}, None
+
+
+def _add_import_error(result, line, user_id, error):
+    result['errors_total'] += 1
+    if len(result['errors']) < IMPORT_MAX_ERRORS:
+        result['errors'].append({'line': line, 'user_id': user_id, 'error': error})
+
+
+def _write_import_batch(conn, batch, event_id, stage_times, approve, actor_id, result):
+    """Пишет порцию проверенных строк (без commit). Возвращает id записанных пользователей"""
+    user_ids = [record['user_id'] for record in batch]
+    existing_users = {}
+    registered = set()
+    for start in range(0, len(user_ids), 500):
+        chunk = user_ids[start:start + 500]
+        placeholders = ','.join(['?'] * len(chunk))
+        for row in conn.execute(
+            f'SELECT user_id, {_IMPORT_PROFILE_COLUMNS} FROM users WHERE user_id IN ({placeholders})', chunk
+        ):
+            existing_users[row['user_id']] = row
+        if event_id is not None:
+            registered.update(row['user_id'] for row in conn.execute(
+                f'SELECT user_id FROM event_registrations WHERE event_id = ? AND user_id IN ({placeholders})',
+                [event_id] + chunk
+            ))
+
+    user_rows = []
+    registration_rows = []
+    stage_rows = []
+    detail_rows = []
+    approval_rows = []
+    written = []
+    for record in batch:
+        user_id = record['user_id']
+        profile = record['profile']
+        existing = existing_users.get(user_id)
+        if existing is None and not record['username']:
+            _add_import_error(result, record['line'], user_id, 'Новый пользователь: не указано имя пользователя')
+            continue
+        user_rows.append((
+            user_id,
+            record['username'],
+            generate_unique_avatar_seed(user_id) if existing is None else None,
+            *(profile[field] for field in IMPORT_PROFILE_FIELDS)
+        ))
+        result['users_updated' if existing is not None else 'users_created'] += 1
+        written.append(user_id)
+        if event_id is None:
+            continue
+
+        stage = record['stage'] or 'main'
+        if user_id in registered:
+            result['registrations_existing'] += 1
+            if record['stage']:
+                stage_rows.append((stage_times[stage], event_id, user_id))
+            details = profile
+        else:
+            result['registrations_created'] += 1
+            registration_rows.append((event_id, user_id, stage_times[stage]))
+            if approve:
+                approval_rows.append((event_id, user_id, actor_id, 'Импортирован из CSV'))
+            # Анкета нового участника - снимок профиля с учетом данных из файла
+            details = {
+                field: profile[field] if profile[field] is not None else (existing[field] if existing else None)
+                for field in IMPORT_PROFILE_FIELDS
+            }
+        detail_rows.append((event_id, user_id, *(details[field] for field in IMPORT_PROFILE_FIELDS)))
+
+    if user_rows:
+        conn.executemany(_IMPORT_USERS_UPSERT, user_rows)
+    if registration_rows:
+        conn.executemany('''
+            INSERT INTO event_registrations (event_id, user_id, registered_at)
+            VALUES (?, ?, ?)
+            ON CONFLICT(event_id, user_id) DO NOTHING
+        ''', registration_rows)
+    if stage_rows:
+        conn.executemany('''
+            UPDATE event_registrations
+            SET registered_at = ?
+            WHERE event_id = ? AND user_id = ?
+        ''', stage_rows)
+    if detail_rows:
+        conn.executemany(_IMPORT_DETAILS_UPSERT, detail_rows)
+    if approval_rows:
+        conn.executemany('''
+            INSERT INTO event_participant_approvals (event_id, user_id, approved, approved_at, approved_by, notes)
+            VALUES (?, ?, 1, CURRENT_TIMESTAMP, ?, ?)
+            ON CONFLICT(event_id, user_id) DO UPDATE SET
+                approved = 1,
+                approved_at = CURRENT_TIMESTAMP,
+                approved_by = excluded.approved_by,
+                notes = excluded.notes
+        ''', approval_rows)
+    return written
+
+
+def import_participants_csv(stream, event_id=None, batch_size=IMPORT_BATCH_SIZE, dry_run=False,
+                            approve=False, actor_id=None):
+    """Потоковый импорт пользователей из CSV, а с event_id - и участников мероприятия.
+
+    stream - текстовый поток (UTF-8, newline=''). Возвращает (итоги, ошибка): ошибка -
+    если файл нельзя обработать вовсе, ошибки отдельных строк собираются в итогах.
+    """
+    batch_size = min(max(int(batch_size or IMPORT_BATCH_SIZE), 1), IMPORT_MAX_BATCH_SIZE)
+    started = time.monotonic()
+    result = {
+        'event_id': event_id,
+        'dry_run': dry_run,
+        'batch_size': batch_size,
+        'rows': 0,
+        'imported': 0,
+        'users_created': 0,
+        'users_updated': 0,
+        'registrations_created': 0,
+        'registrations_existing': 0,
+        'errors_total': 0,
+        'errors': [],
+    }
+
+    try:
+        first_line = stream.readline()
+        delimiter = ';' if first_line.count(';') > first_line.count(',') else ','
+        reader = csv.reader(itertools.chain([first_line], stream), delimiter=delimiter)
+        header = next(reader, None)
+    except UnicodeDecodeError:
+        return None, 'Файл не в UTF-8: сохраните его как "CSV UTF-8" и загрузите снова'
+    except csv.Error:
+        header = None
+    columns = _import_column_map(header or [])
+    if 'user_id' not in columns:
+        return None, 'В файле нет колонки user_id (или "ID")'
+
+    conn = get_db_connection()
+    written = []
+    try:
+        stage_times = {}
+        if event_id is not None:
+            event = conn.execute('SELECT id FROM events WHERE id = ?', (event_id,)).fetchone()
+            if not event:
+                return None, 'Мероприятие не найдено'
+            # Как при ручном добавлении: дата регистрации - начало выбранного этапа
+            now_value = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+            starts = {
+                row['stage_type']: row['start_datetime']
+                for row in conn.execute('''
+                    SELECT stage_type, start_datetime FROM event_stages
+                    WHERE event_id = ? AND stage_type IN ('pre_registration', 'main_registration')
+                ''', (event_id,))
+            }
+            stage_times = {
+                'pre': starts.get('pre_registration') or now_value,
+                'main': starts.get('main_registration') or now_value,
+            }
+
+        def flush(batch):
+            try:
+                batch_written = _write_import_batch(conn, batch, event_id, stage_times, approve, actor_id, result)
+                if dry_run:
+                    conn.rollback()
+                else:
+                    conn.commit()
+                    written.extend(batch_written)
+                result['imported'] += len(batch_written)
+            except sqlite3.Error as exc:
+                conn.rollback()
+                log_error(f"Error importing rows {batch[0]['line']}-{batch[-1]['line']}: {exc}")
+                for record in batch:
+                    _add_import_error(result, record['line'], record['user_id'], 'Строка не записана: ошибка базы данных')
+
+        batch = []
+        seen_lines = {}
+        try:
+            for values in reader:
+                if not any((value or '').strip() for value in values):
+                    continue
+                line = reader.line_num
+                result['rows'] += 1
+                record, error = _parse_import_row(values, columns)
+                if error:
+                    _add_import_error(result, line, None, error)
+                    continue
+                user_id = record['user_id']
+                if user_id in seen_lines:
+                    _add_import_error(result, line, user_id, f'ID уже встречался в строке {seen_lines[user_id]}')
+                    continue
+                seen_lines[user_id] = line
+                record['line'] = line
+                batch.append(record)
+                if len(batch) >= batch_size:
+                    flush(batch)
+                    batch = []
+        except (csv.Error, UnicodeDecodeError) as exc:
+            _add_import_error(result, reader.line_num, None, f'Файл прочитан не полностью: {exc}')
+        if batch:
+            flush(batch)
+    finally:
+        conn.close()
+
+    result['duration_ms'] = int((time.monotonic() - started) * 1000)
+    if written:
+        if len(written) > IMPORT_BATCH_SIZE:
+            invalidate_user_directory()
+        else:
+            refresh_user_directory_entry(*written)
+        if event_id is not None:
+            invalidate_event_aggregates(event_id)
+        target = f'мероприятие #{event_id}' if event_id is not None else 'пользователи'
+        log_activity(
+            'admin_import_participants',
+            details=f'Импорт из CSV ({target}): записано строк {len(written)}, ошибок {result["errors_total"]}',
+            metadata={key: result[key] for key in (
+                'event_id', 'rows', 'imported', 'users_created', 'users_updated',
+                'registrations_created', 'registrations_existing', 'errors_total'
+            )},
+            user_id=actor_id
+        )
+    return result, None
+
+
+def _import_upload_response(event_id, redirect_to):
+    """Общий обработчик загрузки CSV: JSON для fetch-запросов, иначе flash и redirect"""
+    wants_json = (
+        request.headers.get('Accept') == 'application/json'
+        or request.headers.get('X-Requested-With') == 'XMLHttpRequest'
+    )
+    upload = request.files.get('file')
+    if not upload or not upload.filename:
+        error = 'Выберите CSV-файл'
+    else:
+        stream = io.TextIOWrapper(upload.stream, encoding='utf-8-sig', newline='')
+        result, error = import_participants_csv(
+            stream,
+            event_id=event_id,
+            batch_size=request.form.get('batch_size', IMPORT_BATCH_SIZE, type=int),
+            dry_run=bool(request.form.get('dry_run')),
+            approve=bool(request.form.get('approve')),
+            actor_id=session.get('user_id')
+        )
+    if error:
+        if wants_json:
+            return jsonify({'success': False, 'error': error}), 400
+        flash(error, 'error')
+        return redirect(redirect_to)
+
+    if wants_json:
+        return jsonify(dict(result, success=True))
+    prefix = 'Проверка файла' if result['dry_run'] else 'Импорт'
+    summary = (
+        f'{prefix}: строк {result["rows"]}, записано {result["imported"]} '
+        f'(новых пользователей {result["users_created"]}, обновлено {result["users_updated"]}'
+    )
+    if event_id is not None:
+        summary += f', новых участников {result["registrations_created"]}'
+    summary += f'), ошибок {result["errors_total"]}'
+    flash(summary, 'warning' if result['errors_total'] else 'success')
+    for item in result['errors'][:10]:
+        flash(f'Строка {item["line"]}: {item["error"]}', 'error')
+    if result['errors_total'] > 10:
+        flash(f'И еще ошибок: {result["errors_total"] - 10}', 'error')
+    return redirect(redirect_to)
+
+
+@app.route('/admin/users/import', methods=['POST'])
+@require_role('admin')
+def admin_users_import():
+    """Массовое создание и обновление пользователей из CSV"""
+    return _import_upload_response(None, url_for('admin_users'))
+
+
+@app.route('/admin/events/<int:event_id>/participants/import', methods=['POST'])
+@require_role('admin')
+def admin_event_participants_import(event_id):
+    """Массовое добавление участников мероприятия из CSV (пользователи создаются при необходимости)"""
+    return _import_upload_response(event_id, url_for('admin_event_participants', event_id=event_id))
+
+
+@app.route('/admin/events/<int:event_id>/distribution/positive/save', methods=['POST'])
+@require_role('admin')
+def admin_event_distribution_positive_save(event_id):
+    data = request.get_json(silent=True) or {}
+    pairs = data.get('pairs')
+    
+    log_debug(f"admin_event_distribution_positive_save: event_id={event_id}, pairs type={type(pairs)}, pairs length={len(pairs) if pairs else 0}")
+    
+    if not pairs or not isinstance(pairs, list):
+        log_error(f"admin_event_distribution_positive_save: Invalid pairs data. Type: {type(pairs)}, Value: {pairs}")
+        return jsonify({'success': False, 'error': 'Некорректные данные распределения'}), 400
+
+    enforce_country = bool(data.get('enforce_country'))
+
+    user_id = session.get('user_id')
+    if not user_id:
+        return jsonify({'success': False, 'error': 'Необходима авторизация'}), 403
+
+    conn = get_db_connection()
+    # Используем ту же логику, что и в генерации: только зарегистрированные И утвержденные участники
+    approved_rows = conn.execute('''
+        SELECT 
+            er.user_id, 
+            COALESCE(d.country, u.country) AS country
+        FROM event_registrations er
+        LEFT JOIN event_participant_approvals epa ON epa.event_id = er.event_id AND epa.user_id = er.user_id
+        JOIN users u ON er.user_id = u.user_id
+        LEFT JOIN event_registration_details d ON d.event_id = er.event_id AND d.user_id = er.user_id
+        WHERE er.event_id = ?
+          AND epa.approved = 1
+    ''', (event_id,)).fetchall()
+    approved_ids = {row['user_id'] for row in approved_rows}
+    country_lookup = {row['user_id']: row['country'] for row in approved_rows}
+    conn.close()
+
+    log_debug(f"admin_event_distribution_positive_save: approved_ids count={len(approved_ids)}, approved_ids={sorted(approved_ids)}")
+
+    if len(approved_ids) < 2:
+        log_error(f"admin_event_distribution_positive_save: Not enough approved participants. Count: {len(approved_ids)}")
+        return jsonify({'success': False, 'error': 'Недостаточно утверждённых участников для сохранения распределения'}), 400
+
+    assignments = []
+    santas_seen = set()
+    recipients_seen = set()
+
+    try:
+        for idx, entry in enumerate(pairs):
+            if not isinstance(entry, dict):
+                log_error(f"admin_event_distribution_positive_save: Entry {idx} is not a dict: {entry}")
+                return jsonify({'success': False, 'error': f'Некорректный формат пары #{idx + 1}'}), 400
+            
+            santa_id_raw = entry.get('santa_id')
+            recipient_id_raw = entry.get('recipient_id')
+            
+            if santa_id_raw is None or recipient_id_raw is None:
+                log_error(f"admin_event_distribution_positive_save: Entry {idx} missing IDs: santa_id={santa_id_raw}, recipient_id={recipient_id_raw}")
+                return jsonify({'success': False, 'error': f'Пара #{idx + 1} содержит некорректные идентификаторы'}), 400
+            
+            try:
+                santa_id = int(santa_id_raw)
+                recipient_id = int(recipient_id_raw)
+            except (TypeError, ValueError) as e:
+                log_error(f"admin_event_distribution_positive_save: Entry {idx} invalid IDs: santa_id={santa_id_raw}, recipient_id={recipient_id_raw}, error={e}")
+                return jsonify({'success': False, 'error': f'Пара #{idx + 1} содержит некорректные идентификаторы'}), 400
+            
+            if santa_id == recipient_id:
+                log_error(f"admin_event_distribution_positive_save: Entry {idx} santa equals recipient: {santa_id}")
+                return jsonify({'success': False, 'error': f'Участник {santa_id} не может быть назначен самому себе'}), 400
+            
+            if santa_id not in approved_ids:
+                log_error(f"admin_event_distribution_positive_save: Entry {idx} santa_id {santa_id} not in approved_ids. Approved: {sorted(approved_ids)}")
+                return jsonify({'success': False, 'error': f'Пользователь {santa_id} не входит в список утверждённых участников'}), 400
+            
+            if recipient_id not in approved_ids:
+                log_error(f"admin_event_distribution_positive_save: Entry {idx} recipient_id {recipient_id} not in approved_ids. Approved: {sorted(approved_ids)}")
+                return jsonify({'success': False, 'error': f'Получатель {recipient_id} не входит в список утверждённых участников'}), 400
+            
+            santa_country = country_lookup.get(santa_id)
+            recipient_country = country_lookup.get(recipient_id)
+            if enforce_country and santa_country and recipient_country and santa_country != recipient_country:
+                log_error(f"admin_event_distribution_positive_save: Entry {idx} country mismatch: santa={santa_country}, recipient={recipient_country}")
+                return jsonify({'success': False, 'error': f'При распределении по странам Дед Мороз ({santa_country}) и Внучок ({recipient_country}) должны быть из одной страны'}), 400
+            
+            if santa_id in santas_seen:
+                log_error(f"admin_event_distribution_positive_save: Entry {idx} duplicate santa_id: {santa_id}")
+                return jsonify({'success': False, 'error': f'Дед Мороз {santa_id} встречается более одного раза'}), 400
+            
+            if recipient_id in recipients_seen:
+                log_error(f"admin_event_distribution_positive_save: Entry {idx} duplicate recipient_id: {recipient_id}")
+                return jsonify({'success': False, 'error': f'Получатель {recipient_id} встречается более одного раза'}), 400
+            
+            santas_seen.add(santa_id)
+            recipients_seen.add(recipient_id)
+            assignments.append((santa_id, recipient_id))
+    except Exception as e:
+        log_error(f"admin_event_distribution_positive_save: Unexpected error processing pairs: {e}")
+        import traceback
+        log_error(traceback.format_exc())
+        return jsonify({'success': False, 'error': f'Ошибка обработки данных: {str(e)}'}), 400
+
+    locked_pairs_raw = data.get('locked_pairs') or []
+    locked_pairs_set = set()
+    try:
+        for entry in locked_pairs_raw:
+            santa_id = int(entry.get('santa_id'))
+            recipient_id = int(entry.get('recipient_id'))
+            locked_pairs_set.add((santa_id, recipient_id))
+    except (TypeError, ValueError, AttributeError):
+        return jsonify({'success': False, 'error': 'Некорректные данные закреплённых пар'}), 400
+
+    log_debug(f"admin_event_distribution_positive_save: assignments count={len(assignments)}, approved_ids count={len(approved_ids)}")
+    log_debug(f"admin_event_distribution_positive_save: assignments santas={sorted(santas_seen)}, approved_ids={sorted(approved_ids)}")
+    
+    # Проверяем, что все участники из распределения есть в списке утвержденных
+    all_santa_ids = set(pair[0] for pair in assignments)
+    all_recipient_ids = set(pair[1] for pair in assignments)
+    
+    invalid_santas = all_santa_ids - approved_ids
+    invalid_recipients = all_recipient_ids - approved_ids
     
     if invalid_santas or invalid_recipients:
         log_error(f"admin_event_distribution_positive_save: Invalid participants in distribution. Invalid santas: {sorted(invalid_santas)}, Invalid recipients: {sorted(invalid_recipients)}")
@@ -12141,8 +15083,11 @@ def admin_event_edit(event_id):
                         ''', (new_points, source))
             
             conn.commit()
+            invalidate_event_aggregates(event_id)
             flash('Мероприятие успешно обновлено', 'success')
             conn.close()
+            # Этапы с датами в прошлом переходят сразу, не дожидаясь cron
+            run_stage_transitions(event_ids=[event_id])
             return redirect(url_for('admin_event_view', event_id=event_id))
         except Exception as e:
             log_error(f"Error updating event: {e}")
@@ -12337,56 +15282,13 @@ def letter():
             return redirect(url_for('letter', assignment_id=selected_assignment.get('id')))
 
     if request.method == 'POST':
-        message = _normalize_multiline_text(request.form.get('message'), max_length=2000)
-        attachment_file = request.files.get('attachment')
-        has_attachment = attachment_file and attachment_file.filename
-
-        if not message and not has_attachment:
-            flash('Введите сообщение или прикрепите изображение.', 'error')
-            return redirect(url_for('letter', assignment_id=selected_assignment.get('id')))
-
-        attachment_relative_path = None
-        saved_filepath = None
-
-        if has_attachment:
-            filename = secure_filename(attachment_file.filename)
-            _, ext = os.path.splitext(filename)
-            ext = ext.lower()
-            if ext not in ALLOWED_LETTER_IMAGE_EXTENSIONS:
-                flash('Допускается загрузка только изображений (PNG, JPG, JPEG, GIF, WEBP).', 'error')
-                return redirect(url_for('letter', assignment_id=selected_assignment.get('id')))
-
-            unique_name = f"{selected_assignment.get('id')}_{int(datetime.now().timestamp())}_{secrets.token_hex(4)}{ext}"
-            saved_filepath = os.path.join(LETTER_UPLOAD_FOLDER, unique_name)
-            try:
-                attachment_file.save(saved_filepath)
-            except Exception as exc:
-                log_error(f"Failed to save letter attachment {unique_name}: {exc}")
-                flash('Не удалось загрузить изображение.', 'error')
-                return redirect(url_for('letter', assignment_id=selected_assignment.get('id')))
-
-            attachment_relative_path = f"{LETTER_UPLOAD_RELATIVE}/{unique_name}"
-
-        conn = get_db_connection()
-        try:
-            conn.execute('''
-                INSERT INTO letter_messages (assignment_id, sender, message, attachment_path)
-                VALUES (?, ?, ?, ?)
-            ''', (selected_assignment.get('id'), user_role, message, attachment_relative_path))
-            conn.commit()
+        _, error = save_letter_message(
+            selected_assignment.get('id'), user_role, request.form.get('message'), request.files.get('attachment')
+        )
+        if error:
+            flash(error, 'error')
+        else:
             flash('Сообщение отправлено.', 'success')
-        except Exception as exc:
-            conn.rollback()
-            if saved_filepath and os.path.exists(saved_filepath):
-                try:
-                    os.remove(saved_filepath)
-                except OSError:
-                    pass
-            log_error(f"Error saving letter message for assignment {selected_assignment.get('id')}: {exc}")
-            flash('Не удалось сохранить сообщение.', 'error')
-        finally:
-            conn.close()
-
         return redirect(url_for('letter', assignment_id=selected_assignment.get('id')))
 
     recipient_first_name = (selected_assignment.get('recipient_first_name')
@@ -12460,53 +15362,12 @@ def letter():
             'recipient_label': assignment.get('recipient_full_name') or assignment.get('recipient_username')
         })
 
-    conn = get_db_connection()
-    raw_messages = conn.execute('''
-        SELECT id, sender, message, created_at, attachment_path
-        FROM letter_messages
-        WHERE assignment_id = ?
-        ORDER BY created_at ASC, id ASC
-    ''', (selected_assignment.get('id'),)).fetchall()
     chat_messages = []
-    message_updates = []
     earliest_dt = None
-    for row in raw_messages:
-        message_text = row['message']
-        if message_text:
-            normalized = _normalize_multiline_text(message_text)
-            if normalized != message_text:
-                message_text = normalized
-                message_updates.append((normalized, row['id']))
-        created_raw = row['created_at']
-        created_display = ''
-        created_dt = None
-        if created_raw:
-            try:
-                created_dt = datetime.fromisoformat(str(created_raw))
-            except ValueError:
-                try:
-                    created_dt = datetime.strptime(str(created_raw), '%Y-%m-%d %H:%M:%S')
-                except ValueError:
-                    created_dt = None
-            if created_dt:
-                created_display = created_dt.strftime('%d.%m.%Y %H:%M')
-                if earliest_dt is None or created_dt < earliest_dt:
-                    earliest_dt = created_dt
-        attachment_rel = row['attachment_path']
-        attachment_url = url_for('static', filename=attachment_rel) if attachment_rel else None
-
-        chat_messages.append({
-            'sender': row['sender'],
-            'message': message_text,
-            'created_display': created_display,
-            'created_iso': str(created_raw) if created_raw is not None else '',
-            'attachment_url': attachment_url
-        })
-
-    if message_updates:
-        conn.executemany('UPDATE letter_messages SET message = ? WHERE id = ?', message_updates)
-        conn.commit()
-    conn.close()
+    for row in get_letter_messages(selected_assignment.get('id')):
+        if earliest_dt is None:
+            earliest_dt = parse_event_datetime(row['created_at'])
+        chat_messages.append(serialize_letter_message(row))
 
     if earliest_dt is None:
         candidate_dates = []
@@ -12535,6 +15396,217 @@ def letter():
     )
 
 
+# ========== API переписки ==========
+# Страница /letter после загрузки получает только новые сообщения:
+# GET /api/letters/<id>/messages?after=<id> отдает сообщения после курсора,
+# GET /api/letters/<id>/poll?after=<id> проверяет новые сообщения,
+# POST /api/letters/<id>/messages сохраняет сообщение и возвращает его.
+# По умолчанию опрос короткий (letter_poll_timeout_seconds = 0): синхронные воркеры
+# PythonAnywhere не держатся открытыми вкладками, а клиент сам увеличивает паузу,
+# пока сообщений нет. Long-polling включается настройкой > 0 там, где воркеров много
+# или они асинхронные. Ожидание будится сразу при сообщении из этого же процесса;
+# сообщения из других процессов замечаются по letter_chat_summary раз в
+# LETTER_POLL_CHECK_SECONDS.
+
+LETTER_MESSAGES_PAGE_SIZE = 200
+LETTER_POLL_CHECK_SECONDS = 2
+_letter_message_condition = threading.Condition()
+_letter_last_message_ids = {}
+
+
+def notify_letter_message(assignment_id, message_id):
+    """Будит long-poll запросы переписки после commit нового сообщения"""
+    with _letter_message_condition:
+        if message_id > _letter_last_message_ids.get(assignment_id, 0):
+            _letter_last_message_ids[assignment_id] = message_id
+        _letter_message_condition.notify_all()
+
+
+def serialize_letter_message(row):
+    """Сообщение переписки в виде, общем для шаблона и JSON API"""
+    created_raw = row['created_at']
+    created_dt = parse_event_datetime(created_raw)
+    attachment_rel = row['attachment_path']
+    return {
+        'id': row['id'],
+        'sender': row['sender'],
+        'message': row['message'],
+        'created_display': created_dt.strftime('%d.%m.%Y %H:%M') if created_dt else '',
+        'created_iso': str(created_raw) if created_raw is not None else '',
+        'attachment_url': url_for('static', filename=attachment_rel) if attachment_rel else None,
+        'attachment_thumb_url': (url_for('static', filename=get_image_thumbnail_path(attachment_rel))
+                                 if attachment_rel else None)
+    }
+
+
+def get_letter_messages(assignment_id, after_id=0, limit=None):
+    """Сообщения переписки с id больше after_id (в порядке добавления)"""
+    conn = get_db_connection()
+    try:
+        query = '''
+            SELECT id, sender, message, created_at, attachment_path
+            FROM letter_messages
+            WHERE assignment_id = ? AND id > ?
+            ORDER BY id ASC
+        '''
+        params = [assignment_id, after_id or 0]
+        if limit:
+            query += ' LIMIT ?'
+            params.append(limit)
+        return conn.execute(query, params).fetchall()
+    finally:
+        conn.close()
+
+
+def get_letter_chat_role(user_id, assignment_id):
+    """Роль пользователя в переписке: (назначение, 'santa'|'grandchild'|'admin') или (None, None).
+
+    Участник видит только текущее (неархивное) назначение пары,
+    как на странице /letter; администратор - любую переписку в режиме чтения.
+    """
+    conn = get_db_connection()
+    try:
+        assignment = conn.execute('''
+            SELECT ea.id, ea.event_id, ea.santa_user_id, ea.recipient_user_id,
+                   ea.is_archived = 0 AS is_current
+            FROM event_assignments ea
+            WHERE ea.id = ?
+        ''', (assignment_id,)).fetchone()
+    finally:
+        conn.close()
+    if not assignment:
+        return None, None
+    if assignment['is_current']:
+        if assignment['santa_user_id'] == user_id:
+            return assignment, 'santa'
+        if assignment['recipient_user_id'] == user_id:
+            return assignment, 'grandchild'
+    if has_role(user_id, 'admin'):
+        return assignment, 'admin'
+    return None, None
+
+
+def save_letter_message(assignment_id, sender, message, attachment_file=None):
+    """Сохраняет сообщение переписки. Возвращает (строка сообщения, ошибка)"""
+    message = _normalize_multiline_text(message, max_length=2000)
+    has_attachment = attachment_file and attachment_file.filename
+    if not message and not has_attachment:
+        return None, 'Введите сообщение или прикрепите изображение.'
+
+    attachment_relative_path = None
+    attachment_created = False
+    if has_attachment:
+        attachment_relative_path, attachment_created, upload_error = store_uploaded_image(
+            attachment_file, LETTER_UPLOAD_FOLDER, LETTER_UPLOAD_RELATIVE
+        )
+        if upload_error:
+            return None, upload_error
+
+    conn = get_db_connection()
+    try:
+        message_id = add_letter_message(conn, assignment_id, sender, message, attachment_relative_path)
+        conn.commit()
+        row = conn.execute('''
+            SELECT id, sender, message, created_at, attachment_path
+            FROM letter_messages WHERE id = ?
+        ''', (message_id,)).fetchone()
+    except Exception as exc:
+        conn.rollback()
+        if attachment_created:
+            remove_uploaded_image(attachment_relative_path)
+        log_error(f"Error saving letter message for assignment {assignment_id}: {exc}")
+        return None, 'Не удалось сохранить сообщение.'
+    finally:
+        conn.close()
+    notify_letter_message(assignment_id, message_id)
+    return row, None
+
+
+def _letter_has_messages_after(assignment_id, after_id):
+    conn = get_db_connection()
+    try:
+        summary = conn.execute(
+            'SELECT last_message_id FROM letter_chat_summary WHERE assignment_id = ?', (assignment_id,)
+        ).fetchone()
+    finally:
+        conn.close()
+    return bool(summary and (summary['last_message_id'] or 0) > after_id)
+
+
+def _letter_cursor_arg():
+    after_id = request.args.get('after', 0, type=int)
+    return max(after_id or 0, 0)
+
+
+@app.route('/api/letters/<int:assignment_id>/messages', methods=['GET', 'POST'])
+@require_login
+def api_letter_messages(assignment_id):
+    """Сообщения переписки после курсора (GET) или отправка сообщения (POST)"""
+    user_id = session.get('user_id')
+    assignment, role = get_letter_chat_role(int(user_id), assignment_id)
+    if not assignment:
+        return jsonify({'success': False, 'error': 'Переписка не найдена'}), 404
+
+    if request.method == 'POST':
+        if role == 'admin':
+            return jsonify({'success': False, 'error': 'Администраторы просматривают переписки только в режиме чтения.'}), 403
+        if is_event_finished(assignment['event_id']):
+            return jsonify({'success': False, 'error': 'Мероприятие завершено. Переписка доступна только для чтения.'}), 403
+        row, error = save_letter_message(
+            assignment_id, role, request.form.get('message'), request.files.get('attachment')
+        )
+        if error:
+            return jsonify({'success': False, 'error': error}), 400
+        return jsonify({'success': True, 'message': serialize_letter_message(row)}), 201
+
+    rows = get_letter_messages(assignment_id, _letter_cursor_arg(), LETTER_MESSAGES_PAGE_SIZE)
+    messages = [serialize_letter_message(row) for row in rows]
+    return jsonify({
+        'success': True,
+        'messages': messages,
+        'cursor': messages[-1]['id'] if messages else _letter_cursor_arg(),
+        'has_more': len(messages) == LETTER_MESSAGES_PAGE_SIZE
+    })
+
+
+@app.route('/api/letters/<int:assignment_id>/poll', methods=['GET'])
+@require_login
+def api_letter_poll(assignment_id):
+    """Новые сообщения после курсора; при letter_poll_timeout_seconds > 0 ждет их (long-polling)"""
+    user_id = session.get('user_id')
+    assignment, _ = get_letter_chat_role(int(user_id), assignment_id)
+    if not assignment:
+        return jsonify({'success': False, 'error': 'Переписка не найдена'}), 404
+
+    after_id = _letter_cursor_arg()
+    try:
+        max_timeout = max(int(get_setting('letter_poll_timeout_seconds', '0')), 0)
+    except (TypeError, ValueError):
+        max_timeout = 0
+    timeout = min(max(request.args.get('timeout', max_timeout, type=int) or 0, 0), max_timeout)
+    deadline = time.monotonic() + timeout
+
+    rows = get_letter_messages(assignment_id, after_id, LETTER_MESSAGES_PAGE_SIZE)
+    while not rows:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        with _letter_message_condition:
+            if _letter_last_message_ids.get(assignment_id, 0) <= after_id:
+                _letter_message_condition.wait(min(remaining, LETTER_POLL_CHECK_SECONDS))
+        # Между выборками смотрим только сводку: это один поиск по первичному ключу
+        if _letter_has_messages_after(assignment_id, after_id):
+            rows = get_letter_messages(assignment_id, after_id, LETTER_MESSAGES_PAGE_SIZE)
+
+    messages = [serialize_letter_message(row) for row in rows]
+    return jsonify({
+        'success': True,
+        'messages': messages,
+        'cursor': messages[-1]['id'] if messages else after_id,
+        'timeout': timeout
+    })
+
+
 @app.route('/assignments')
 @require_login
 def assignments():
@@ -12594,8 +15666,8 @@ def admin_letters_archived():
                 COALESCE(rd.first_name, recipient.first_name) AS recipient_first_name,
                 COALESCE(rd.middle_name, recipient.middle_name) AS recipient_middle_name,
                 archiver.username AS archiver_username,
-                (SELECT COUNT(*) FROM letter_messages WHERE assignment_id = ach.original_assignment_id) AS message_count,
-                (SELECT MAX(created_at) FROM letter_messages WHERE assignment_id = ach.original_assignment_id) AS last_message_at
+                COALESCE(cs.message_count, 0) AS message_count,
+                cs.last_message_at
             FROM assignment_chat_history ach
             JOIN events e ON ach.event_id = e.id
             JOIN users santa ON ach.santa_user_id = santa.user_id
@@ -12603,6 +15675,7 @@ def admin_letters_archived():
             LEFT JOIN event_registration_details rd
                 ON rd.event_id = ach.event_id AND rd.user_id = ach.recipient_user_id
             LEFT JOIN users archiver ON ach.archived_by = archiver.user_id
+            LEFT JOIN letter_chat_summary cs ON cs.assignment_id = ach.original_assignment_id
             ORDER BY ach.archived_at DESC
         ''').fetchall()
         conn.close()
@@ -12787,275 +15860,161 @@ def _sync_contact_snowflakes(conn, user_row):
                 )
 
 
-def _ensure_registration_bonus_event(conn, event_id, user_id):
-    source = f'event:{event_id}:registration_bonus'
-    reason = f'Регистрация закрыта: мероприятие #{event_id}'
-    # Получаем настройку очков за регистрацию: сначала из настроек мероприятия, если не задано - из глобальных
-    event_row = conn.execute('SELECT rating_registration FROM events WHERE id = ?', (event_id,)).fetchone()
-    if event_row and event_row['rating_registration'] is not None:
-        points = int(event_row['rating_registration'])
-    else:
-        points = get_rating_setting('rating_event_registration', 1)
-    existing = conn.execute(
-        '''
-        SELECT id, active, manual_revoked
-        FROM snowflake_events
-        WHERE user_id = ? AND source = ?
-        ''',
-        (user_id, source)
-    ).fetchone()
-    if not existing:
-        conn.execute(
-            '''
-            INSERT INTO snowflake_events (user_id, source, reason, points, active, manual_revoked)
-            VALUES (?, ?, ?, ?, ?, ?)
-            ''',
-            (user_id, source, reason, points, 1, 0)
-        )
-    elif not existing['active']:
-        conn.execute(
-            '''
-            UPDATE snowflake_events
-            SET active = 1,
-                points = ?,
-                manual_revoked = 0,
-                revoked_at = NULL,
-                updated_at = CURRENT_TIMESTAMP
-            WHERE id = ?
-            ''',
-            (points, existing['id'])
-        )
+def _event_rating_points(event_row, column, setting_key, default):
+    """Очки из настроек мероприятия, если заданы, иначе из глобальных настроек рейтинга"""
+    if event_row and event_row[column] is not None:
+        return int(event_row[column])
+    return get_rating_setting(setting_key, default)
+
+
+def _desired_event_snowflakes(event_id, event_row, registered_user_ids, assignments):
+    """Считает, какие бубенчики мероприятия должны быть активны: {(user_id, source): (points, reason)}"""
+    desired = {}
+
+    registration_source = f'event:{event_id}:registration_bonus'
+    registration_reason = f'Регистрация закрыта: мероприятие #{event_id}'
+    registration_points = _event_rating_points(event_row, 'rating_registration', 'rating_event_registration', 1)
+    for user_id in registered_user_ids:
+        desired[(user_id, registration_source)] = (registration_points, registration_reason)
+
+    # Статус подарка берем по первому назначению пользователя как Деда Мороза
+    first_assignment = {}
+    for row in assignments:
+        first_assignment.setdefault(row['santa_user_id'], row)
+
+    not_sent_points = _event_rating_points(event_row, 'rating_gift_not_sent', 'rating_event_gift_not_sent', 0)
+    sent_points = _event_rating_points(event_row, 'rating_gift_sent', 'rating_event_gift_sent', 0)
+    for user_id in registered_user_ids:
+        assignment = first_assignment.get(user_id)
+        if not assignment:
+            continue
+        if assignment['santa_sent_at']:
+            if sent_points != 0:
+                desired[(user_id, f'event:{event_id}:gift_sent')] = (
+                    sent_points, f'Отправленный подарок при закрытии регистрации: мероприятие #{event_id}'
+                )
+        elif not_sent_points != 0:
+            desired[(user_id, f'event:{event_id}:gift_not_sent')] = (
+                not_sent_points, f'Неотправленный подарок при закрытии регистрации: мероприятие #{event_id}'
+            )
+
+    # Очередность отправки: (участников - порядковый номер + 1) * коэффициент
+    coefficient = event_row['rating_order_coefficient'] if event_row else None
+    total = len(first_assignment)
+    if coefficient and total:
+        coefficient = float(coefficient)
+        order_source = f'event:{event_id}:order_bonus'
+        sent_pairs = list(dict.fromkeys(
+            (row['santa_user_id'], row['santa_sent_at']) for row in assignments if row['santa_sent_at']
+        ))
+        sent_pairs.sort(key=lambda pair: str(pair[1]))
+        for order_num, (user_id, _) in enumerate(sent_pairs, start=1):
+            points = float((total - order_num + 1) * coefficient)
+            if points <= 0:
+                continue
+            desired[(user_id, order_source)] = (
+                points, f'Очередность отправки подарка: {order_num}-й из {total} (мероприятие #{event_id})'
+            )
+    return desired
+
 
+def reconcile_event_snowflakes(conn, event_id):
+    """Приводит записи ревью и бубенчики мероприятия к нужному состоянию (без commit).
 
-def _ensure_gift_not_sent_event(conn, event_id, user_id):
-    """Создает или активирует событие бубенчика за неотправленный подарок при закрытии регистрации"""
-    source = f'event:{event_id}:gift_not_sent'
-    reason = f'Неотправленный подарок при закрытии регистрации: мероприятие #{event_id}'
-    # Получаем настройку очков за неотправленный подарок: сначала из настроек мероприятия, если не задано - из глобальных
-    event_row = conn.execute('SELECT rating_gift_not_sent FROM events WHERE id = ?', (event_id,)).fetchone()
-    if event_row and event_row['rating_gift_not_sent'] is not None:
-        points = int(event_row['rating_gift_not_sent'])
-    else:
-        points = get_rating_setting('rating_event_gift_not_sent', 0)
-    
-    # Если очки = 0, не создаем событие
-    if points == 0:
-        return
-    
-    # Проверяем, есть ли у пользователя назначение и не отправлен ли подарок
-    assignment = conn.execute('''
-        SELECT id, santa_sent_at FROM event_assignments
-        WHERE event_id = ? AND santa_user_id = ?
-    ''', (event_id, user_id)).fetchone()
-    
-    # Если нет назначения или подарок уже отправлен - не начисляем
-    if not assignment or assignment['santa_sent_at']:
-        return
-    
-    existing = conn.execute(
-        '''
-        SELECT id, active, manual_revoked
-        FROM snowflake_events
-        WHERE user_id = ? AND source = ?
-        ''',
-        (user_id, source)
-    ).fetchone()
-    
-    if not existing:
-        conn.execute(
-            '''
+    Нужное состояние считается в памяти по трем выборкам (регистрации, назначения,
+    существующие бубенчики мероприятия) и сравнивается с текущим; в базу пишутся
+    только отличия. Повторный вызов без изменений данных ничего не записывает.
+    Бубенчики за регистрацию только добавляются, бубенчики за подарок и
+    очередность снимаются, если перестали полагаться.
+    """
+    event_row = conn.execute('''
+        SELECT rating_registration, rating_gift_not_sent, rating_gift_sent, rating_order_coefficient
+        FROM events WHERE id = ?
+    ''', (event_id,)).fetchone()
+
+    registrations = conn.execute('''
+        SELECT er.user_id, epa.user_id AS approval_user_id
+        FROM event_registrations er
+        LEFT JOIN event_participant_approvals epa
+            ON epa.event_id = er.event_id AND epa.user_id = er.user_id
+        WHERE er.event_id = ?
+    ''', (event_id,)).fetchall()
+    assignments = conn.execute('''
+        SELECT santa_user_id, santa_sent_at
+        FROM event_assignments
+        WHERE event_id = ?
+        ORDER BY id
+    ''', (event_id,)).fetchall()
+    registration_source = f'event:{event_id}:registration_bonus'
+    revocable_sources = (
+        f'event:{event_id}:gift_not_sent',
+        f'event:{event_id}:gift_sent',
+        f'event:{event_id}:order_bonus',
+    )
+    existing = {
+        (row['user_id'], row['source']): row
+        for row in conn.execute('''
+            SELECT id, user_id, source, reason, points, active
+            FROM snowflake_events
+            WHERE source IN (?, ?, ?, ?)
+        ''', (registration_source,) + revocable_sources).fetchall()
+    }
+
+    registered_user_ids = [row['user_id'] for row in registrations]
+    desired = _desired_event_snowflakes(event_id, event_row, registered_user_ids, assignments)
+
+    new_approvals = [(event_id, row['user_id']) for row in registrations if row['approval_user_id'] is None]
+    inserts = []
+    updates = []
+    revokes = []
+    for key, (points, reason) in desired.items():
+        row = existing.get(key)
+        if row is None:
+            inserts.append((key[0], key[1], reason, points))
+        elif not row['active']:
+            # У бубенчика за регистрацию при повторной активации сохраняется прежнее описание
+            updates.append((points, row['reason'] if key[1] == registration_source else reason, row['id']))
+        elif key[1] != registration_source and (row['points'] != points or row['reason'] != reason):
+            updates.append((points, reason, row['id']))
+    for key, row in existing.items():
+        if row['active'] and key[1] in revocable_sources and key not in desired:
+            revokes.append((row['id'],))
+
+    if new_approvals:
+        conn.executemany('''
+            INSERT OR IGNORE INTO event_participant_approvals (event_id, user_id, approved)
+            VALUES (?, ?, 0)
+        ''', new_approvals)
+    if inserts:
+        conn.executemany('''
             INSERT INTO snowflake_events (user_id, source, reason, points, active, manual_revoked)
-            VALUES (?, ?, ?, ?, ?, ?)
-            ''',
-            (user_id, source, reason, points, 1, 0)
-        )
-    elif not existing['active']:
-        conn.execute(
-            '''
+            VALUES (?, ?, ?, ?, 1, 0)
+        ''', inserts)
+    if updates:
+        conn.executemany('''
             UPDATE snowflake_events
             SET active = 1,
                 points = ?,
+                reason = ?,
                 manual_revoked = 0,
                 revoked_at = NULL,
                 updated_at = CURRENT_TIMESTAMP
             WHERE id = ?
-            ''',
-            (points, existing['id'])
-        )
-
-
-def _ensure_gift_sent_event(conn, event_id, user_id):
-    """Создает или активирует событие бубенчика за отправленный подарок при закрытии регистрации"""
-    source = f'event:{event_id}:gift_sent'
-    reason = f'Отправленный подарок при закрытии регистрации: мероприятие #{event_id}'
-    # Получаем настройку очков за отправленный подарок: сначала из настроек мероприятия, если не задано - из глобальных
-    event_row = conn.execute('SELECT rating_gift_sent FROM events WHERE id = ?', (event_id,)).fetchone()
-    if event_row and event_row['rating_gift_sent'] is not None:
-        points = int(event_row['rating_gift_sent'])
-    else:
-        points = get_rating_setting('rating_event_gift_sent', 0)
-    
-    # Если очки = 0, не создаем событие
-    if points == 0:
-        return
-    
-    # Проверяем, есть ли у пользователя назначение и отправлен ли подарок
-    assignment = conn.execute('''
-        SELECT id, santa_sent_at FROM event_assignments
-        WHERE event_id = ? AND santa_user_id = ?
-    ''', (event_id, user_id)).fetchone()
-    
-    # Если нет назначения или подарок не отправлен - не начисляем
-    if not assignment or not assignment['santa_sent_at']:
-        return
-    
-    existing = conn.execute(
-        '''
-        SELECT id, active, manual_revoked
-        FROM snowflake_events
-        WHERE user_id = ? AND source = ?
-        ''',
-        (user_id, source)
-    ).fetchone()
-    
-    if not existing:
-        conn.execute(
-            '''
-            INSERT INTO snowflake_events (user_id, source, reason, points, active, manual_revoked)
-            VALUES (?, ?, ?, ?, ?, ?)
-            ''',
-            (user_id, source, reason, points, 1, 0)
-        )
-    elif not existing['active']:
-        conn.execute(
-            '''
+        ''', updates)
+    if revokes:
+        conn.executemany('''
             UPDATE snowflake_events
-            SET active = 1,
-                points = ?,
-                manual_revoked = 0,
-                revoked_at = NULL,
+            SET active = 0,
+                revoked_at = CURRENT_TIMESTAMP,
                 updated_at = CURRENT_TIMESTAMP
             WHERE id = ?
-            ''',
-            (points, existing['id'])
-        )
-
-
-def _ensure_order_bonus_events(conn, event_id):
-    """Создает или обновляет события бубенчиков за очередность отправки подарка для всех участников при закрытии регистрации"""
-    source = f'event:{event_id}:order_bonus'
-    
-    # Получаем настройки мероприятия
-    event_row = conn.execute('SELECT rating_order_coefficient FROM events WHERE id = ?', (event_id,)).fetchone()
-    if not event_row or event_row['rating_order_coefficient'] is None or event_row['rating_order_coefficient'] == 0:
-        # Коэффициент не задан или равен 0, не начисляем
-        return
-    
-    coefficient = float(event_row['rating_order_coefficient'])
-    
-    # Получаем общее количество участников мероприятия на момент закрытия регистрации (с назначениями)
-    total_participants = conn.execute('''
-        SELECT COUNT(DISTINCT santa_user_id) as total
-        FROM event_assignments
-        WHERE event_id = ?
-    ''', (event_id,)).fetchone()
-    
-    if not total_participants or total_participants['total'] == 0:
-        return
-    
-    total = total_participants['total']
-    
-    # Получаем всех участников, которые отправили подарки, отсортированных по времени отправки
-    sent_assignments = conn.execute('''
-        SELECT DISTINCT santa_user_id, santa_sent_at
-        FROM event_assignments
-        WHERE event_id = ? AND santa_sent_at IS NOT NULL
-        ORDER BY santa_sent_at ASC
-    ''', (event_id,)).fetchall()
-    
-    if not sent_assignments:
-        return
-    
-    # Начисляем бубенчики каждому участнику в порядке отправки
-    for idx, assignment in enumerate(sent_assignments, start=1):
-        user_id = assignment['santa_user_id']
-        order_num = idx
-        
-        # Вычисляем бубенчики: (общее_количество - порядковый_номер + 1) * коэффициент
-        points = float((total - order_num + 1) * coefficient)
-        
-        if points <= 0:
-            continue
-        
-        reason = f'Очередность отправки подарка: {order_num}-й из {total} (мероприятие #{event_id})'
-        
-        # Проверяем, есть ли уже событие
-        existing = conn.execute('''
-            SELECT id, active, manual_revoked
-            FROM snowflake_events
-            WHERE user_id = ? AND source = ?
-        ''', (user_id, source)).fetchone()
-        
-        if not existing:
-            # Создаем новое событие
-            conn.execute('''
-                INSERT INTO snowflake_events (user_id, source, reason, points, active, manual_revoked)
-                VALUES (?, ?, ?, ?, 1, 0)
-            ''', (user_id, source, reason, points))
-        elif not existing['active']:
-            # Активируем и обновляем существующее неактивное событие
-            conn.execute('''
-                UPDATE snowflake_events
-                SET active = 1,
-                    points = ?,
-                    reason = ?,
-                    manual_revoked = 0,
-                    revoked_at = NULL,
-                    updated_at = CURRENT_TIMESTAMP
-                WHERE id = ?
-            ''', (points, reason, existing['id']))
-        else:
-            # Обновляем существующее активное событие, если очки изменились
-            conn.execute('''
-                UPDATE snowflake_events
-                SET points = ?,
-                    reason = ?,
-                    updated_at = CURRENT_TIMESTAMP
-                WHERE id = ?
-            ''', (points, reason, existing['id']))
-
-
-def _revoke_gift_events(conn, event_id):
-    """Снимает бубенчики за отправленный/неотправленный подарок и за очередность при продлении мероприятия"""
-    # Снимаем бубенчики за неотправленный подарок
-    source_not_sent = f'event:{event_id}:gift_not_sent'
-    conn.execute('''
-        UPDATE snowflake_events
-        SET active = 0,
-            revoked_at = CURRENT_TIMESTAMP,
-            updated_at = CURRENT_TIMESTAMP
-        WHERE source = ? AND active = 1
-    ''', (source_not_sent,))
-    
-    # Снимаем бубенчики за отправленный подарок
-    source_sent = f'event:{event_id}:gift_sent'
-    conn.execute('''
-        UPDATE snowflake_events
-        SET active = 0,
-            revoked_at = CURRENT_TIMESTAMP,
-            updated_at = CURRENT_TIMESTAMP
-        WHERE source = ? AND active = 1
-    ''', (source_sent,))
-    
-    # Снимаем бубенчики за очередность отправки
-    source_order = f'event:{event_id}:order_bonus'
-    conn.execute('''
-        UPDATE snowflake_events
-        SET active = 0,
-            revoked_at = CURRENT_TIMESTAMP,
-            updated_at = CURRENT_TIMESTAMP
-        WHERE source = ? AND active = 1
-    ''', (source_order,))
+        ''', revokes)
+    return {
+        'approvals_created': len(new_approvals),
+        'snowflakes_created': len(inserts),
+        'snowflakes_updated': len(updates),
+        'snowflakes_revoked': len(revokes),
+    }
 
 
 def _get_snowflake_source_label(source):
@@ -13279,6 +16238,81 @@ def recalculate_all_snowflake_events(conn, settings_dict):
 
 
 
+# Сортировка рейтинга: по бубенчикам (убывание), имени и user_id как уникальному ключу.
+# Колонки users.rating_points/rating_name покрыты индексом idx_users_rating, поэтому
+# страница выбирается поиском по индексу, без агрегации snowflake_events
+_RATING_QUERY = '''
+    SELECT
+        u.user_id,
+        u.username,
+        u.rating_name AS sort_name,
+        u.rating_points AS total_points
+    FROM users u
+'''
+_RATING_KEY_COLUMNS = ('total_points', 'sort_name', 'user_id')
+_RATING_KEY_DESCENDING = (True, False, False)
+
+
+def rating_sort_name(username):
+    """Имя для сортировки рейтинга (без учета регистра, в том числе кириллицы)"""
+    return (username or '').casefold()
+
+
+def sync_rating_names(conn):
+    """Заполняет users.rating_name у новых и переименованных пользователей
+    (триггеры сбрасывают его в NULL при вставке и смене username)"""
+    pending = conn.execute('SELECT user_id, username FROM users WHERE rating_name IS NULL').fetchall()
+    if pending:
+        conn.executemany(
+            'UPDATE users SET rating_name = ? WHERE user_id = ?',
+            [(rating_sort_name(row['username']), row['user_id']) for row in pending]
+        )
+        conn.commit()
+    return len(pending)
+
+
+def _get_rating_page(page, per_page, cursor=None):
+    """Страница рейтинга: по курсору или (для прямых ссылок на номер страницы) по OFFSET"""
+    conn = get_db_connection()
+    try:
+        sync_rating_names(conn)
+        # Получаем общее количество пользователей для пагинации
+        total_count = conn.execute('SELECT COUNT(*) as count FROM users').fetchone()['count']
+        if cursor or page <= 1:
+            page_data = fetch_keyset_page(
+                conn, _RATING_QUERY, (), _RATING_KEY_COLUMNS, _RATING_KEY_DESCENDING, cursor, per_page
+            )
+        else:
+            offset = (page - 1) * per_page
+            rows = conn.execute(
+                f'{_RATING_QUERY} ORDER BY total_points DESC, sort_name ASC, user_id ASC LIMIT ? OFFSET ?',
+                (per_page + 1, offset)
+            ).fetchall()
+            page_data = _build_keyset_page(rows, _RATING_KEY_COLUMNS, per_page, None, 'next')
+            page_data['has_prev'] = True
+            if page_data['items']:
+                page_data['prev_cursor'] = encode_page_cursor(
+                    tuple(page_data['items'][0][column] for column in _RATING_KEY_COLUMNS), 'prev'
+                )
+    finally:
+        conn.close()
+
+    # Преобразуем результаты
+    rating_rows = []
+    for row in page_data['items']:
+        try:
+            rating_rows.append({
+                'user_id': row['user_id'],
+                'username': row['username'],
+                'rating': float(row['total_points']) if row['total_points'] is not None else 0.0,
+            })
+        except (ValueError, TypeError):
+            continue
+    page_data['items'] = rating_rows
+    page_data['total_count'] = total_count
+    return page_data
+
+
 @app.route('/rating')
 def user_rating():
     """Простая система рейтинга участников (прямая ссылка)."""
@@ -13298,55 +16332,14 @@ def user_rating():
     per_page = min(max(per_page, 10), 200)
     page = max(1, page)
 
-    conn = get_db_connection()
-    try:
-        # Оптимизация: используем SQL агрегацию с JOIN для получения рейтинга и пользователей
-        # Сортируем по рейтингу (убывание) и имени (возрастание)
-        rating_query = '''
-            SELECT 
-                u.user_id,
-                u.username,
-                COALESCE(SUM(CAST(se.points AS REAL)), 0.0) as total_points
-            FROM users u
-            LEFT JOIN snowflake_events se ON u.user_id = se.user_id
-                AND (se.active = 1 OR CAST(se.active AS INTEGER) = 1)
-                AND (se.manual_revoked IS NULL OR se.manual_revoked = 0 OR CAST(se.manual_revoked AS INTEGER) = 0)
-            GROUP BY u.user_id, u.username
-            ORDER BY total_points DESC, LOWER(u.username) ASC
-        '''
-        
-        # Получаем общее количество пользователей для пагинации
-        total_count = conn.execute('SELECT COUNT(*) as count FROM users').fetchone()['count']
-        
-        # Вычисляем смещение для пагинации
-        offset = (page - 1) * per_page
-        
-        # Получаем данные с пагинацией
-        # Используем параметризованный запрос для безопасности
-        rating_rows_raw = conn.execute(
-            rating_query + ' LIMIT ? OFFSET ?', 
-            (per_page, offset)
-        ).fetchall()
-        
-    finally:
-        conn.close()
+    cursor = request.args.get('cursor', '').strip()
 
-    # Преобразуем результаты
-    rating_rows = []
-    for row in rating_rows_raw:
-        try:
-            rating_rows.append({
-                'user_id': row['user_id'],
-                'username': row['username'],
-                'rating': float(row['total_points']) if row['total_points'] is not None else 0.0,
-            })
-        except (ValueError, TypeError):
-            continue
+    page_data = _get_rating_page(page, per_page, cursor)
+    rating_rows = page_data['items']
+    total_count = page_data['total_count']
 
     # Вычисляем информацию о пагинации
     total_pages = (total_count + per_page - 1) // per_page if total_count > 0 else 1
-    has_prev = page > 1
-    has_next = page < total_pages
 
     resp = make_response(render_template(
         'rating.html', 
@@ -13356,8 +16349,10 @@ def user_rating():
         per_page=per_page,
         total_count=total_count,
         total_pages=total_pages,
-        has_prev=has_prev,
-        has_next=has_next
+        has_prev=page_data['has_prev'],
+        has_next=page_data['has_next'],
+        prev_cursor=page_data['prev_cursor'],
+        next_cursor=page_data['next_cursor']
     ))
     resp.headers['Cache-Control'] = 'no-store, no-cache, must-revalidate, max-age=0'
     resp.headers['Pragma'] = 'no-cache'
@@ -13365,6 +16360,25 @@ def user_rating():
     return resp
 
 
+@app.route('/api/rating', methods=['GET'])
+def api_user_rating():
+    """JSON API рейтинга с курсорной пагинацией"""
+    per_page = min(max(request.args.get('per_page', 50, type=int), 10), 200)
+    cursor = request.args.get('cursor', '').strip()
+    try:
+        page_data = _get_rating_page(1, per_page, cursor)
+    except Exception as e:
+        log_error(f"Error in api_user_rating: {e}")
+        return jsonify({'success': False, 'error': 'Не удалось загрузить рейтинг'}), 500
+    return jsonify({
+        'success': True,
+        'items': page_data['items'],
+        'total_count': page_data['total_count'],
+        'next_cursor': page_data['next_cursor'],
+        'prev_cursor': page_data['prev_cursor'],
+    })
+
+
 @app.route('/admin/rating/<int:user_id>')
 @require_role('admin')
 def admin_rating_detail(user_id):
@@ -13550,16 +16564,8 @@ def handle_unexpected_error(error):
 
 
 
-@app.route('/cron/run', methods=['GET', 'POST'])
-def cron_run():
-    """HTTP endpoint для запуска cron задач из внешнего сервиса
-    
-    Защищен секретным токеном, который можно настроить через переменную окружения
-    CRON_SECRET_TOKEN или через настройку в БД.
-    
-    Использование:
-    https://gwadm.pythonanywhere.com/cron/run?token=YOUR_SECRET_TOKEN
-    """
+def _get_cron_secret_token():
+    """Секретный токен cron: CRON_SECRET_TOKEN или настройка (создается при первом обращении)"""
     # Получаем секретный токен из переменной окружения или настроек
     expected_token = os.getenv('CRON_SECRET_TOKEN') or get_setting('cron_secret_token', '')
     
@@ -13587,50 +16593,74 @@ def cron_run():
             log_error(f"Error getting/setting cron token: {e}")
         finally:
             conn.close()
-    
-    # Проверяем токен из запроса
+    return expected_token
+
+
+def _cron_token_valid():
     provided_token = request.args.get('token') or request.form.get('token')
+    return bool(provided_token) and secrets.compare_digest(provided_token, _get_cron_secret_token())
+
+
+def _cron_param(name, default=None):
+    return request.args.get(name, request.form.get(name, default))
+
+
+@app.route('/cron/run', methods=['GET', 'POST'])
+def cron_run():
+    """HTTP endpoint для запуска cron задач из внешнего сервиса
+    
+    Защищен секретным токеном, который можно настроить через переменную окружения
+    CRON_SECRET_TOKEN или через настройку в БД. Задачи выполняются в этом же запросе
+    (на PythonAnywhere веб-воркеры не поддерживают потоки); background=1 - запустить
+    в фоновом потоке и сразу вернуть run_id (статус - /cron/runs/<run_id>).
+    backup=1, cleanup_logs=1 (logs_days=N) и task=<имя> выполняют задачи вне расписания.
     
-    if not provided_token or provided_token != expected_token:
+    Использование:
+    https://gwadm.pythonanywhere.com/cron/run?token=YOUR_SECRET_TOKEN
+    """
+    if not _cron_token_valid():
         return jsonify({
             'success': False,
             'error': 'Invalid or missing token'
         }), 401
     
-    # Запускаем задачи
     try:
-        from cron_tasks import cleanup_expired_verification_codes, cleanup_old_activity_logs, backup_database
-        
-        results = {
-            'timestamp': datetime.now().isoformat(),
-            'tasks': {}
-        }
-        
-        # Очистка истекших кодов верификации
-        cleaned_codes = cleanup_expired_verification_codes()
-        results['tasks']['cleanup_expired_verification_codes'] = {
+        from cron_tasks import CRON_TASKS, start_cron_run, execute_cron_run, skipped_cron_run
+        
+        force = request.args.getlist('task') + request.form.getlist('task')
+        unknown = [name for name in force if name not in CRON_TASKS]
+        if unknown:
+            return jsonify({'success': False, 'error': f'Unknown task: {", ".join(unknown)}'}), 400
+        task_kwargs = {}
+        if _cron_param('backup') == '1':
+            force.append('backup_database')
+        if _cron_param('cleanup_logs') == '1':
+            force.append('cleanup_old_activity_logs')
+            task_kwargs['cleanup_old_activity_logs'] = {'days': int(_cron_param('logs_days', 90))}
+        
+        run_id, active_run_id = start_cron_run('http')
+        if run_id is None:
+            # Предыдущий запуск еще идет - задачи не запускаются повторно
+            result = skipped_cron_run(active_run_id, force)
+            result['timestamp'] = datetime.now().isoformat()
+            return jsonify(result), 200 if result['success'] else 409
+        
+        if _cron_param('background') != '1':
+            result = execute_cron_run(run_id, force, task_kwargs)
+            result['timestamp'] = datetime.now().isoformat()
+            return jsonify(result), 200
+        
+        threading.Thread(
+            target=execute_cron_run, args=(run_id, force, task_kwargs),
+            name=f'cron-run-{run_id}', daemon=True
+        ).start()
+        return jsonify({
             'success': True,
-            'cleaned_count': cleaned_codes
-        }
-        
-        # Опциональные задачи (можно включить через параметры)
-        if request.args.get('cleanup_logs') == '1' or request.form.get('cleanup_logs') == '1':
-            days = int(request.args.get('logs_days', request.form.get('logs_days', 90)))
-            cleaned_logs = cleanup_old_activity_logs(days=days)
-            results['tasks']['cleanup_old_activity_logs'] = {
-                'success': True,
-                'cleaned_count': cleaned_logs,
-                'days': days
-            }
-        
-        if request.args.get('backup') == '1' or request.form.get('backup') == '1':
-            backup_success = backup_database()
-            results['tasks']['backup_database'] = {
-                'success': backup_success
-            }
-        
-        results['success'] = True
-        return jsonify(results), 200
+            'run_id': run_id,
+            'status': 'running',
+            'status_url': url_for('cron_run_status', run_id=run_id),
+            'timestamp': datetime.now().isoformat()
+        }), 202
         
     except Exception as e:
         log_error(f"Error running cron tasks: {e}")
@@ -13642,5 +16672,20 @@ def cron_run():
             'timestamp': datetime.now().isoformat()
         }), 500
 
+
+@app.route('/cron/runs/<int:run_id>')
+def cron_run_status(run_id):
+    """Статус запуска cron с результатами задач (тот же токен, что и для /cron/run)"""
+    if not _cron_token_valid():
+        return jsonify({
+            'success': False,
+            'error': 'Invalid or missing token'
+        }), 401
+    from cron_tasks import get_cron_run
+    run = get_cron_run(run_id)
+    if run is None:
+        return jsonify({'success': False, 'error': 'Run not found'}), 404
+    return jsonify(dict(run, success=run['status'] not in ('error', 'abandoned'))), 200
+
 if __name__ == '__main__':
     app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк проверки подписей входа через GWars
+
+Сравнивает прежний перебор всех вариантов имени с SignatureVerifier
+на типичных кириллических и латинских именах.
+
+Запуск: python bench_signatures.py [--rounds 20000]
+"""
+
+import argparse
+import hashlib
+import time
+from urllib.parse import quote_from_bytes, unquote_plus, unquote_to_bytes
+
+from gwars_signatures import SignatureVerifier, SIGN_VARIANTS
+
+SECRET = 'benchmark-secret'
+
+# (имя, кодировка байтов в URL, вариант, по которому GWars посчитал подпись)
+CASES = [
+    ('Дед Мороз', 'cp1251', 'bytes'),
+    ('Снегурочка', 'cp1251', 'bytes'),
+    ('Иван Петров', 'cp1251', 'bytes_space'),
+    ('Мария', 'utf-8', 'decoded'),
+    ('SantaClaus', 'utf-8', 'bytes'),
+    ('john doe', 'utf-8', 'bytes_space'),
+    ('Player_2025', 'utf-8', 'bytes'),
+]
+
+
+def _encode(name, encoding):
+    return quote_from_bytes(name.encode(encoding), safe='').replace('%20', '+')
+
+
+def _sign_for(variant, name, encoded_name, user_id):
+    if variant == 'bytes':
+        name_bytes = unquote_to_bytes(encoded_name)
+    elif variant == 'bytes_space':
+        name_bytes = unquote_to_bytes(encoded_name.replace('+', '%20'))
+    else:
+        name_bytes = name.encode('utf-8')
+    return hashlib.md5(SECRET.encode('utf-8') + name_bytes + str(user_id).encode('utf-8')).hexdigest()
+
+
+def legacy_verify(username, user_id, sign, encoded_name):
+    """Прежний алгоритм: все варианты считаются заранее, затем сравниваются"""
+    variants = []
+    encoded_variations = [encoded_name]
+    if '+' in encoded_name:
+        encoded_variations.append(encoded_name.replace('+', '%20'))
+    for encoded_variant in encoded_variations:
+        variants.append(hashlib.md5(
+            SECRET.encode('utf-8') + unquote_to_bytes(encoded_variant) + str(user_id).encode('utf-8')
+        ).hexdigest())
+    variants.append(hashlib.md5((SECRET + username + str(user_id)).encode('utf-8')).hexdigest())
+    for encoded_variant in encoded_variations:
+        variants.append(hashlib.md5((SECRET + encoded_variant + str(user_id)).encode('utf-8')).hexdigest())
+    name_cp1251 = unquote_plus(encoded_name, encoding='cp1251')
+    variants.append(hashlib.md5((SECRET + name_cp1251 + str(user_id)).encode('utf-8')).hexdigest())
+    name_latin1 = unquote_plus(encoded_name, encoding='latin1')
+    variants.append(hashlib.md5(
+        SECRET.encode('utf-8') + name_latin1.encode('latin1') + str(user_id).encode('utf-8')
+    ).hexdigest())
+    return any(variant == sign for variant in variants)
+
+
+def _prepare():
+    prepared = []
+    for index, (name, encoding, variant) in enumerate(CASES, start=1000):
+        encoded_name = _encode(name, encoding)
+        # login() декодирует имя как CP1251
+        decoded = unquote_plus(encoded_name, encoding='cp1251') if variant != 'decoded' else name
+        prepared.append((index, name, decoded, encoded_name, _sign_for(variant, name, encoded_name, index)))
+    return prepared
+
+
+def _measure(func, cases, rounds):
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for case in cases:
+            assert func(*case)
+    elapsed = time.perf_counter() - started
+    return elapsed / (rounds * len(cases)) * 1e6
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Бенчмарк проверки подписей GWars')
+    parser.add_argument('--rounds', type=int, default=20000)
+    args = parser.parse_args(argv)
+
+    prepared = _prepare()
+    legacy_cases = [(decoded, user_id, sign, encoded) for user_id, _, decoded, encoded, sign in prepared]
+
+    def cold(user_id, decoded, encoded, sign):
+        return SignatureVerifier(SECRET, SIGN_VARIANTS).verify(user_id, sign, decoded, encoded)[0]
+
+    warm_verifier = SignatureVerifier(SECRET, SIGN_VARIANTS)
+
+    def warm(user_id, decoded, encoded, sign):
+        return warm_verifier.verify(user_id, sign, decoded, encoded)[0]
+
+    verifier_cases = [(user_id, decoded, encoded, sign) for user_id, _, decoded, encoded, sign in prepared]
+    print(f"{'case':<16}{'variant':<14}{'tried (cold)':>14}{'tried (warm)':>14}")
+    for (user_id, decoded, encoded, sign), (name, _, _) in zip(verifier_cases, CASES):
+        cold_variant, cold_tried = SignatureVerifier(SECRET, SIGN_VARIANTS).verify(user_id, sign, decoded, encoded)
+        warm_verifier.verify(user_id, sign, decoded, encoded)
+        _, warm_tried = warm_verifier.verify(user_id, sign, decoded, encoded)
+        print(f"{name:<16}{cold_variant:<14}{cold_tried:>14}{warm_tried:>14}")
+
+    print()
+    print(f"legacy (all variants):   {_measure(legacy_verify, legacy_cases, args.rounds):7.2f} us/login")
+    print(f"verifier, first login:   {_measure(cold, verifier_cases, args.rounds):7.2f} us/login")
+    print(f"verifier, known variant: {_measure(warm, verifier_cases, args.rounds):7.2f} us/login")
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
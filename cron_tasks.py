@@ -4,15 +4,35 @@
 Запускается через cron на PythonAnywhere
 
 Задачи:
-- Очистка истекших кодов верификации Telegram
+- Переходы между этапами мероприятий (ревью участников, бубенчики, награды, напоминания)
+- Рассылка уведомлений участникам (новые сообщения, отправка и получение подарка)
+- Очистка истекших кодов верификации Telegram и брошенных привязок
+- Удаление неиспользуемых файлов вложений писем и фото получения
+- Очистка архива чатов старше срока хранения (если задан)
+- Однократная нормализация текста переписки и данных об отправке в старых записях
+- Обезличивание журнала действий удаленных пользователей и удаление неактивных учетных записей
+- Очистка истории запусков cron
 - Очистка старых логов (опционально)
+- Архивация старых помесячных партиций журнала действий
 - Резервное копирование базы данных (опционально)
 """
 
 import os
 import sys
+import re
+import gzip
+import json
+import time
+import shutil
+import hashlib
 import sqlite3
+import argparse
+import tempfile
 from datetime import datetime, timedelta
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 # Добавляем путь к проекту
 project_path = os.path.dirname(os.path.abspath(__file__))
@@ -20,112 +40,1137 @@ if project_path not in sys.path:
     sys.path.insert(0, project_path)
 
 # Импортируем функции из app.py
-from app import get_db_connection, log_error, log_debug
+from app import (
+    get_db_connection, get_db_path, get_setting, set_setting, log_error, log_debug, log_activity,
+    archive_activity_log_partitions, migrate_legacy_activity_logs, get_activity_log_tables,
+    list_activity_log_partitions, remove_users, find_inactive_user_ids, import_participants_csv,
+    dispatch_notifications, run_stage_transitions, get_next_stage_transition_at, get_event_now,
+    IMPORT_BATCH_SIZE,
+    LETTER_UPLOAD_FOLDER, LETTER_UPLOAD_RELATIVE, ASSIGNMENT_RECEIPT_FOLDER, ASSIGNMENT_RECEIPT_RELATIVE,
+    IMAGE_THUMBNAIL_SUFFIX, _normalize_multiline_text
+)
 
-def cleanup_expired_verification_codes():
-    """Очищает истекшие коды верификации Telegram"""
-    conn = None
+# ========== Очистка порциями ==========
+# Задачи удаляют/обновляют строки порциями через "WHERE rowid IN (SELECT rowid ... LIMIT ?)",
+# сравнивая временные метки как есть (без datetime(), чтобы работали индексы).
+# Каждая порция коммитится отдельно с паузой между ними, чтобы не держать блокировку
+# базы. Если время вышло, граница запоминается в cron_checkpoints и следующий запуск
+# продолжает с того же места.
+
+CLEANUP_CHUNK_SIZE = 500
+CLEANUP_PAUSE_SECONDS = 0.05
+STAGE_WATCH_MAX_SLEEP_SECONDS = 300
+
+
+def _utc_cutoff(**delta):
+    """Граница в формате CURRENT_TIMESTAMP (UTC) для сравнения строк без datetime()"""
+    return (datetime.utcnow() - timedelta(**delta)).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def get_checkpoint(conn, task):
+    """Возвращает сохраненный прогресс задачи или None"""
+    row = conn.execute('SELECT checkpoint FROM cron_checkpoints WHERE task = ?', (task,)).fetchone()
+    if not row or not row['checkpoint']:
+        return None
     try:
-        conn = get_db_connection()
-        # Удаляем истекшие коды верификации (старше 10 минут)
-        result = conn.execute('''
-            UPDATE telegram_users
-            SET verification_code = NULL,
-                verification_code_expires_at = NULL
+        return json.loads(row['checkpoint'])
+    except (TypeError, ValueError):
+        return None
+
+
+def set_checkpoint(conn, task, value):
+    """Сохраняет прогресс задачи (None - задача завершена, прогресс сбрасывается)"""
+    if value is None:
+        conn.execute('DELETE FROM cron_checkpoints WHERE task = ?', (task,))
+    else:
+        conn.execute('''
+            INSERT INTO cron_checkpoints (task, checkpoint, updated_at)
+            VALUES (?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT(task) DO UPDATE SET
+                checkpoint = excluded.checkpoint,
+                updated_at = CURRENT_TIMESTAMP
+        ''', (task, json.dumps(value, ensure_ascii=False)))
+    conn.commit()
+
+
+def run_chunked(conn, sql, params=(), chunk_size=CLEANUP_CHUNK_SIZE, deadline=None):
+    """Выполняет запрос с "LIMIT ?" в подзапросе, пока он затрагивает полные порции.
+
+    Возвращает (число затронутых строк, завершено ли).
+    """
+    total = 0
+    while True:
+        affected = conn.execute(sql, tuple(params) + (chunk_size,)).rowcount
+        conn.commit()
+        total += affected
+        if affected < chunk_size:
+            return total, True
+        if deadline is not None and time.monotonic() >= deadline:
+            return total, False
+        time.sleep(CLEANUP_PAUSE_SECONDS)
+
+
+def _run_chunked_task(task, statements, cutoff, deadline=None):
+    """Выполняет запросы задачи по очереди; граница берется из незавершенного прошлого запуска"""
+    conn = get_db_connection()
+    try:
+        checkpoint = get_checkpoint(conn, task) or {}
+        cutoff = checkpoint.get('cutoff') or cutoff
+        total = 0
+        finished = True
+        for sql in statements:
+            affected, finished = run_chunked(conn, sql, (cutoff,), deadline=deadline)
+            total += affected
+            if not finished:
+                break
+        set_checkpoint(conn, task, None if finished else {'cutoff': cutoff})
+        return {'count': total, 'finished': finished}
+    finally:
+        conn.close()
+
+
+def cleanup_expired_verification_codes(deadline=None):
+    """Очищает истекшие коды верификации Telegram (старше 10 минут)"""
+    result = _run_chunked_task('cleanup_expired_verification_codes', ['''
+        UPDATE telegram_users
+        SET verification_code = NULL,
+            verification_code_expires_at = NULL
+        WHERE rowid IN (
+            SELECT rowid FROM telegram_users
             WHERE verified = 0
               AND verification_code_expires_at IS NOT NULL
-              AND datetime(verification_code_expires_at) < datetime('now', '-10 minutes')
+              AND verification_code_expires_at < ?
+            LIMIT ?
+        )
+    '''], _utc_cutoff(minutes=10), deadline)
+    if result['count'] > 0:
+        log_debug(f"Cleaned up {result['count']} expired verification codes")
+    return result
+
+
+def cleanup_expired_telegram_codes(days=1, deadline=None):
+    """Удаляет брошенные привязки Telegram: без подтверждения, кода и chat_id"""
+    result = _run_chunked_task('cleanup_expired_telegram_codes', ['''
+        DELETE FROM telegram_users
+        WHERE rowid IN (
+            SELECT rowid FROM telegram_users
+            WHERE verified = 0
+              AND verification_code IS NULL
+              AND (telegram_chat_id IS NULL OR telegram_chat_id = '')
+              AND created_at < ?
+            LIMIT ?
+        )
+    '''], _utc_cutoff(days=days), deadline)
+    if result['count'] > 0:
+        log_debug(f"Removed {result['count']} abandoned Telegram bindings")
+    return result
+
+
+def cleanup_notification_outbox(days=30, deadline=None):
+    """Удаляет разосланные уведомления старше указанного количества дней"""
+    result = _run_chunked_task('cleanup_notification_outbox', ['''
+        DELETE FROM notification_outbox
+        WHERE rowid IN (
+            SELECT rowid FROM notification_outbox
+            WHERE dispatched_at IS NOT NULL
+              AND dispatched_at < ?
+            LIMIT ?
+        )
+    '''], _utc_cutoff(days=days), deadline)
+    if result['count'] > 0:
+        log_debug(f"Removed {result['count']} dispatched notifications")
+    return result
+
+
+def cleanup_cron_history(days=30, deadline=None):
+    """Удаляет историю запусков cron старше указанного количества дней"""
+    result = _run_chunked_task('cleanup_cron_history', ['''
+        DELETE FROM cron_run_tasks
+        WHERE rowid IN (
+            SELECT rowid FROM cron_run_tasks
+            WHERE run_id IN (SELECT id FROM cron_runs WHERE started_at < ?)
+            LIMIT ?
+        )
+    ''', '''
+        DELETE FROM cron_runs
+        WHERE rowid IN (
+            SELECT rowid FROM cron_runs
+            WHERE started_at < ? AND status != 'running'
+            LIMIT ?
+        )
+    '''], _utc_cutoff(days=days), deadline)
+    if result['count'] > 0:
+        log_debug(f"Removed {result['count']} cron history rows")
+    return result
+
+
+def cleanup_old_activity_logs(days=90, deadline=None):
+    """Очищает старые логи активности (старше указанного количества дней) во всех партициях"""
+    conn = get_db_connection()
+    try:
+        tables = get_activity_log_tables(conn)
+    finally:
+        conn.close()
+    statements = [f'''
+        DELETE FROM {table_name}
+        WHERE rowid IN (
+            SELECT rowid FROM {table_name}
+            WHERE created_at < ?
+            LIMIT ?
+        )
+    ''' for table_name in tables]
+    result = _run_chunked_task('cleanup_old_activity_logs', statements, _utc_cutoff(days=days), deadline)
+    result['days'] = days
+    if result['count'] > 0:
+        log_debug(f"Cleaned up {result['count']} old activity logs (older than {days} days)")
+    return result
+
+
+def prune_archived_chats(days=None, deadline=None):
+    """Удаляет архивные чаты старше срока хранения (archived_chats_retention_days, 0 - хранить всегда).
+
+    Сообщения удаляются, только если исходное назначение удалено или архивировано.
+    """
+    if days is None:
+        try:
+            days = int(get_setting('archived_chats_retention_days', '0'))
+        except (TypeError, ValueError):
+            days = 0
+    if days <= 0:
+        return {'count': 0, 'finished': True, 'skipped': True}
+    statements = ['''
+        DELETE FROM letter_messages
+        WHERE rowid IN (
+            SELECT lm.rowid FROM letter_messages lm
+            JOIN assignment_chat_history ach ON ach.original_assignment_id = lm.assignment_id
+            LEFT JOIN event_assignments ea ON ea.id = lm.assignment_id
+            WHERE ach.archived_at < ?
+              AND (ea.id IS NULL OR ea.is_archived = 1)
+            LIMIT ?
+        )
+    ''', '''
+        DELETE FROM letter_chat_summary
+        WHERE assignment_id IN (
+            SELECT cs.assignment_id FROM letter_chat_summary cs
+            JOIN assignment_chat_history ach ON ach.original_assignment_id = cs.assignment_id
+            LEFT JOIN event_assignments ea ON ea.id = cs.assignment_id
+            WHERE ach.archived_at < ?
+              AND (ea.id IS NULL OR ea.is_archived = 1)
+            LIMIT ?
+        )
+    ''', '''
+        DELETE FROM assignment_chat_history
+        WHERE rowid IN (
+            SELECT rowid FROM assignment_chat_history
+            WHERE archived_at < ?
+            LIMIT ?
+        )
+    ''']
+    result = _run_chunked_task('prune_archived_chats', statements, _utc_cutoff(days=days), deadline)
+    result['days'] = days
+    if result['count'] > 0:
+        log_debug(f"Pruned {result['count']} archived chat rows (older than {days} days)")
+    return result
+
+
+def cleanup_orphaned_letter_attachments(grace_hours=24, deadline=None):
+    """Удаляет файлы вложений писем и фото получения, на которые не ссылается ни одна запись"""
+    task = 'cleanup_orphaned_letter_attachments'
+    conn = get_db_connection()
+    try:
+        referenced = {row[0] for row in conn.execute(
+            'SELECT attachment_path FROM letter_messages WHERE attachment_path IS NOT NULL'
+        )}
+        referenced.update(row[0] for row in conn.execute(
+            'SELECT recipient_receipt_image FROM event_assignments WHERE recipient_receipt_image IS NOT NULL'
+        ))
+        referenced_stems = {os.path.splitext(path)[0] for path in referenced}
+        checkpoint = get_checkpoint(conn, task) or {}
+        min_age = time.time() - grace_hours * 3600
+        removed = 0
+        finished = True
+        for folder, relative in ((LETTER_UPLOAD_FOLDER, LETTER_UPLOAD_RELATIVE),
+                                 (ASSIGNMENT_RECEIPT_FOLDER, ASSIGNMENT_RECEIPT_RELATIVE)):
+            if not os.path.isdir(folder):
+                continue
+            last_name = checkpoint.get(relative, '')
+            names = sorted(name for name in os.listdir(folder) if name > last_name)
+            for index, name in enumerate(names, 1):
+                path = os.path.join(folder, name)
+                # Миниатюра <хэш>_thumb.webp нужна, пока используется сам <хэш>.*
+                stem = os.path.splitext(name)[0]
+                if stem.endswith(IMAGE_THUMBNAIL_SUFFIX):
+                    stem = stem[:-len(IMAGE_THUMBNAIL_SUFFIX)]
+                if (f'{relative}/{stem}' not in referenced_stems
+                        and os.path.isfile(path)
+                        and os.path.getmtime(path) < min_age):
+                    try:
+                        os.remove(path)
+                        removed += 1
+                    except OSError as e:
+                        log_error(f"Error removing orphaned attachment {path}: {e}")
+                if index % CLEANUP_CHUNK_SIZE == 0 and deadline is not None and time.monotonic() >= deadline:
+                    checkpoint[relative] = name
+                    finished = False
+                    break
+            if not finished:
+                break
+            checkpoint.pop(relative, None)
+        set_checkpoint(conn, task, None if finished else checkpoint)
+    finally:
+        conn.close()
+    if removed > 0:
+        log_debug(f"Removed {removed} orphaned letter attachments")
+    return {'count': removed, 'finished': finished}
+
+
+# ========== Нормализация текста старых записей ==========
+# Текст переписки, данных об отправке и благодарностей нормализуется при записи.
+# Записи, сохраненные раньше, приводятся к тому же виду один раз: порциями по id,
+# с продолжением с места остановки. После завершения ставится настройка
+# legacy_text_normalized, и задача больше ничего не читает.
+
+LEGACY_TEXT_COLUMNS = (
+    ('letter_messages', ('message',)),
+    ('event_assignments', ('santa_send_info', 'recipient_thanks_message')),
+)
+
+
+def normalize_legacy_text(deadline=None, chunk_size=CLEANUP_CHUNK_SIZE):
+    """Нормализует многострочный текст в записях, сохраненных до нормализации при записи"""
+    task = 'normalize_legacy_text'
+    if get_setting('legacy_text_normalized', '0') == '1':
+        return {'count': 0, 'finished': True, 'skipped': True}
+    conn = get_db_connection()
+    try:
+        checkpoint = get_checkpoint(conn, task) or {}
+        done_tables = checkpoint.setdefault('done', [])
+        updated = 0
+        finished = True
+        for table, columns in LEGACY_TEXT_COLUMNS:
+            if table in done_tables:
+                continue
+            last_id = checkpoint.get(table, 0)
+            select_sql = f"SELECT id, {', '.join(columns)} FROM {table} WHERE id > ? ORDER BY id LIMIT ?"
+            update_sql = f"UPDATE {table} SET {', '.join(f'{column} = ?' for column in columns)} WHERE id = ?"
+            while True:
+                rows = conn.execute(select_sql, (last_id, chunk_size)).fetchall()
+                updates = []
+                for row in rows:
+                    values = [row[column] for column in columns]
+                    normalized = [_normalize_multiline_text(value) if value else value for value in values]
+                    if normalized != values:
+                        updates.append((*normalized, row['id']))
+                if updates:
+                    conn.executemany(update_sql, updates)
+                    conn.commit()
+                    updated += len(updates)
+                if len(rows) < chunk_size:
+                    done_tables.append(table)
+                    checkpoint.pop(table, None)
+                    break
+                last_id = rows[-1]['id']
+                checkpoint[table] = last_id
+                if deadline is not None and time.monotonic() >= deadline:
+                    finished = False
+                    break
+                time.sleep(CLEANUP_PAUSE_SECONDS)
+            if not finished:
+                break
+        set_checkpoint(conn, task, None if finished else checkpoint)
+    finally:
+        conn.close()
+    if finished:
+        set_setting('legacy_text_normalized', '1')
+    if updated > 0:
+        log_debug(f"Normalized text in {updated} legacy rows")
+    return {'count': updated, 'finished': finished}
+
+
+# ========== Удаление пользователей ==========
+# Записи журнала удаленных пользователей обезличиваются порциями по очереди
+# user_log_anonymization_queue; пользователь уходит из очереди, когда обработаны
+# все таблицы журнала. Записи новее момента удаления не трогаются: пользователь
+# с тем же id мог зарегистрироваться снова.
+# Неактивные учетные записи (без входа inactive_users_purge_days дней и без участия
+# в мероприятиях) удаляются пачками по USER_PURGE_BATCH_SIZE, каждая пачка - отдельная транзакция.
+
+USER_PURGE_BATCH_SIZE = 100
+
+
+def anonymize_deleted_user_logs(deadline=None, chunk_size=CLEANUP_CHUNK_SIZE):
+    """Обнуляет user_id в журнале действий для пользователей из очереди обезличивания"""
+    conn = get_db_connection()
+    try:
+        queue = conn.execute('''
+            SELECT user_id, deleted_before FROM user_log_anonymization_queue
+            ORDER BY requested_at, user_id
+        ''').fetchall()
+        if not queue:
+            return {'count': 0, 'users': 0, 'finished': True}
+        tables = get_activity_log_tables(conn)
+        partition_months = dict(list_activity_log_partitions(conn))
+        total = 0
+        users_done = 0
+        finished = True
+        for item in queue:
+            deleted_month = str(item['deleted_before'])[:7]
+            for table_name in tables:
+                # Партиции за месяцы после удаления не могут содержать старых записей
+                if partition_months.get(table_name, '') > deleted_month:
+                    continue
+                affected, finished = run_chunked(conn, f'''
+                    UPDATE {table_name}
+                    SET user_id = NULL
+                    WHERE rowid IN (
+                        SELECT rowid FROM {table_name}
+                        WHERE user_id = ? AND created_at <= ?
+                        LIMIT ?
+                    )
+                ''', (item['user_id'], item['deleted_before']), chunk_size=chunk_size, deadline=deadline)
+                total += affected
+                if not finished:
+                    break
+            if not finished:
+                break
+            conn.execute('DELETE FROM user_log_anonymization_queue WHERE user_id = ?', (item['user_id'],))
+            conn.commit()
+            users_done += 1
+            if deadline is not None and time.monotonic() >= deadline and users_done < len(queue):
+                finished = False
+                break
+    finally:
+        conn.close()
+    if total > 0:
+        log_debug(f"Anonymized {total} activity log rows of {users_done} deleted users")
+    return {'count': total, 'users': users_done, 'finished': finished}
+
+
+def purge_inactive_users(days=None, dry_run=False, limit=None, deadline=None, batch_size=USER_PURGE_BATCH_SIZE):
+    """Удаляет неактивные учетные записи (days=None - из настройки inactive_users_purge_days, 0 - выключено)"""
+    if days is None:
+        try:
+            days = int(get_setting('inactive_users_purge_days', '0'))
+        except (TypeError, ValueError):
+            days = 0
+    if not days or days <= 0:
+        return {'count': 0, 'finished': True, 'skipped': True}
+
+    conn = get_db_connection()
+    try:
+        candidates = find_inactive_user_ids(conn, _utc_cutoff(days=days), limit)
+        if dry_run:
+            return {'count': len(candidates), 'user_ids': candidates, 'days': days, 'dry_run': True}
+        removed = []
+        finished = True
+        for start in range(0, len(candidates), batch_size):
+            removed.extend(remove_users(conn, candidates[start:start + batch_size]))
+            conn.commit()
+            if start + batch_size >= len(candidates):
+                break
+            if deadline is not None and time.monotonic() >= deadline:
+                finished = False
+                break
+            time.sleep(CLEANUP_PAUSE_SECONDS)
+    finally:
+        conn.close()
+    if removed:
+        log_activity(
+            'users_purge_inactive',
+            details=f'Удалено неактивных пользователей: {len(removed)} (без входа {days} дн.)',
+            metadata={'target_user_ids': removed, 'days': days}
+        )
+    return {'count': len(removed), 'days': days, 'finished': finished}
+
+
+def import_participants_file(path, event_id=None, batch_size=IMPORT_BATCH_SIZE, dry_run=False, approve=False):
+    """Импорт пользователей/участников из CSV-файла (см. import_participants_csv в app.py)"""
+    with open(path, encoding='utf-8-sig', newline='') as stream:
+        result, error = import_participants_csv(
+            stream, event_id=event_id, batch_size=batch_size, dry_run=dry_run, approve=approve
+        )
+    if error:
+        return {'success': False, 'error': error}
+    result['success'] = True
+    return result
+
+
+def watch_stage_transitions(max_sleep=STAGE_WATCH_MAX_SLEEP_SECONDS):
+    """Постоянный процесс: выполняет переходы этапов и спит до ближайшего следующего"""
+    while True:
+        result = run_timed('stage_transitions', run_stage_transitions)
+        log_debug(f"Stage transitions: {result}")
+        next_at = get_next_stage_transition_at()
+        sleep_for = max_sleep
+        if next_at is not None:
+            sleep_for = min(max((next_at - get_event_now()).total_seconds(), 1), max_sleep)
+        time.sleep(sleep_for)
+
+
+def run_timed(name, func, *args, **kwargs):
+    """Запускает задачу и возвращает ее результат с длительностью в мс"""
+    started = time.monotonic()
+    try:
+        result = func(*args, **kwargs)
+        if not isinstance(result, dict):
+            result = {'result': result}
+        result.setdefault('success', True)
+    except Exception as e:
+        log_error(f"Error in cron task {name}: {e}")
+        result = {'success': False, 'error': str(e)}
+    result['duration_ms'] = int((time.monotonic() - started) * 1000)
+    return result
+
+
+def archive_activity_logs(keep_months=None):
+    """Переносит старую таблицу журнала в партиции и архивирует партиции старше keep_months"""
+    try:
+        moved = migrate_legacy_activity_logs()
+        archived = archive_activity_log_partitions(keep_months)
+        return {'moved_legacy_rows': moved, 'archived_partitions': archived}
+    except Exception as e:
+        log_error(f"Error archiving activity logs: {e}")
+        return None
+
+# ========== Резервное копирование ==========
+
+BACKUP_PREFIX = 'database.db.backup_'
+BACKUP_PAGES_PER_STEP = 256
+_BACKUP_NAME_RE = re.compile(r'^database\.db\.backup_(\d{8}_\d{6})(\.db\.(gz|zst))?$')
+
+
+def _get_backup_setting(key, default):
+    try:
+        return int(get_setting(key, str(default)))
+    except (TypeError, ValueError):
+        return default
+
+
+def get_backup_dir():
+    """Каталог бэкапов: BACKUP_DIR или каталог с базой данных"""
+    backup_dir = os.getenv('BACKUP_DIR') or os.path.dirname(get_db_path())
+    os.makedirs(backup_dir, exist_ok=True)
+    return backup_dir
+
+
+def _open_compressed(path, mode):
+    """Открывает gzip- или zstd-файл (zstd только при установленном zstandard)"""
+    if path.endswith('.zst'):
+        if zstandard is None:
+            raise RuntimeError('Для .zst бэкапов нужен пакет zstandard')
+        raw = open(path, mode)
+        if 'w' in mode:
+            return zstandard.ZstdCompressor(level=10).stream_writer(raw, closefd=True)
+        return zstandard.ZstdDecompressor().stream_reader(raw, closefd=True)
+    return gzip.open(path, mode, compresslevel=6) if 'w' in mode else gzip.open(path, mode)
+
+
+def _file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def list_backups(backup_dir=None):
+    """Список бэкапов (новые первыми): имя, путь, размер, время создания"""
+    backup_dir = backup_dir or get_backup_dir()
+    backups = []
+    for name in os.listdir(backup_dir):
+        match = _BACKUP_NAME_RE.match(name)
+        path = os.path.join(backup_dir, name)
+        if not match or not os.path.isfile(path):
+            continue
+        backups.append({
+            'name': name,
+            'path': path,
+            'size_bytes': os.path.getsize(path),
+            'created_at': datetime.strptime(match.group(1), '%Y%m%d_%H%M%S').isoformat(),
+            'compressed': bool(match.group(2)),
+        })
+    backups.sort(key=lambda item: item['name'], reverse=True)
+    return backups
+
+
+def apply_backup_retention(keep_count=None, keep_days=None, backup_dir=None):
+    """Удаляет бэкапы сверх keep_count и старше keep_days (последний бэкап сохраняется всегда)"""
+    if keep_count is None:
+        keep_count = _get_backup_setting('backup_retention_count', 7)
+    if keep_days is None:
+        keep_days = _get_backup_setting('backup_retention_days', 0)
+    keep_count = max(keep_count, 1)
+    cutoff = datetime.now() - timedelta(days=keep_days) if keep_days > 0 else None
+
+    removed = []
+    for index, backup in enumerate(list_backups(backup_dir)):
+        expired = cutoff is not None and datetime.fromisoformat(backup['created_at']) < cutoff
+        if index == 0 or (index < keep_count and not expired):
+            continue
+        try:
+            os.remove(backup['path'])
+            checksum_path = backup['path'] + '.sha256'
+            if os.path.exists(checksum_path):
+                os.remove(checksum_path)
+            removed.append(backup['name'])
+            log_debug(f"Removed old backup: {backup['name']}")
+        except OSError as e:
+            log_error(f"Error removing old backup {backup['path']}: {e}")
+    return removed
+
+
+def backup_database(compression=None):
+    """Создает согласованный сжатый бэкап базы через sqlite3 backup API.
+
+    Страницы копируются порциями, между которыми писатели не блокируются.
+    Рядом с архивом сохраняется файл .sha256. Возвращает словарь с результатом
+    (или None при ошибке).
+    """
+    started = time.monotonic()
+    db_path = get_db_path()
+    if not os.path.exists(db_path):
+        log_debug("Database file not found, skipping backup")
+        return None
+
+    compression = compression or get_setting('backup_compression', 'gzip')
+    if compression == 'zstd' and zstandard is None:
+        log_debug("zstandard is not installed, falling back to gzip backup")
+        compression = 'gzip'
+    extension = '.db.zst' if compression == 'zstd' else '.db.gz'
+
+    backup_dir = get_backup_dir()
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    backup_path = os.path.join(backup_dir, f'{BACKUP_PREFIX}{timestamp}{extension}')
+    snapshot_path = backup_path + '.snapshot'
+    source = None
+    snapshot = None
+    try:
+        # 1. Согласованный снимок через backup API, порциями страниц
+        source = sqlite3.connect(db_path)
+        snapshot = sqlite3.connect(snapshot_path)
+        source.backup(snapshot, pages=BACKUP_PAGES_PER_STEP, sleep=0.005)
+        snapshot.close()
+        snapshot = None
+        source.close()
+        source = None
+
+        # 2. Потоковое сжатие снимка
+        with open(snapshot_path, 'rb') as src, _open_compressed(backup_path, 'wb') as dst:
+            for chunk in iter(lambda: src.read(1024 * 1024), b''):
+                dst.write(chunk)
+        db_size = os.path.getsize(snapshot_path)
+        os.remove(snapshot_path)
+
+        # 3. Контрольная сумма архива
+        checksum = _file_sha256(backup_path)
+        with open(backup_path + '.sha256', 'w', encoding='utf-8') as f:
+            f.write(f'{checksum}  {os.path.basename(backup_path)}\n')
+
+        removed = apply_backup_retention(backup_dir=backup_dir)
+        result = {
+            'file': os.path.basename(backup_path),
+            'compression': compression,
+            'db_size_bytes': db_size,
+            'size_bytes': os.path.getsize(backup_path),
+            'sha256': checksum,
+            'duration_ms': int((time.monotonic() - started) * 1000),
+            'removed': removed,
+        }
+        log_debug(f"Database backup created: {result['file']} ({result['size_bytes']} bytes, {result['duration_ms']} ms)")
+        return result
+    except Exception as e:
+        log_error(f"Error creating database backup: {e}")
+        for path in (snapshot_path, backup_path):
+            try:
+                if os.path.exists(path):
+                    os.remove(path)
+            except OSError:
+                pass
+        return None
+    finally:
+        if snapshot is not None:
+            snapshot.close()
+        if source is not None:
+            source.close()
+
+
+def _resolve_backup_path(name_or_path):
+    if os.path.isabs(name_or_path) or os.path.exists(name_or_path):
+        return name_or_path
+    return os.path.join(get_backup_dir(), name_or_path)
+
+
+def _decompress_backup(backup_path, target_path):
+    with _open_compressed(backup_path, 'rb') as src, open(target_path, 'wb') as dst:
+        for chunk in iter(lambda: src.read(1024 * 1024), b''):
+            dst.write(chunk)
+
+
+def verify_backup(name_or_path):
+    """Проверяет контрольную сумму и целостность бэкапа (PRAGMA integrity_check)"""
+    backup_path = _resolve_backup_path(name_or_path)
+    result = {'file': os.path.basename(backup_path), 'checksum_ok': None, 'integrity': None, 'success': False}
+    if not os.path.exists(backup_path):
+        result['error'] = 'Файл бэкапа не найден'
+        return result
+
+    checksum_path = backup_path + '.sha256'
+    if os.path.exists(checksum_path):
+        with open(checksum_path, 'r', encoding='utf-8') as f:
+            expected = f.read().split()[0]
+        result['checksum_ok'] = _file_sha256(backup_path) == expected
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        check_path = os.path.join(tmp_dir, 'verify.db')
+        try:
+            if backup_path.endswith(('.gz', '.zst')):
+                _decompress_backup(backup_path, check_path)
+            else:
+                shutil.copyfile(backup_path, check_path)
+            conn = sqlite3.connect(check_path)
+            try:
+                result['integrity'] = conn.execute('PRAGMA integrity_check').fetchone()[0]
+            finally:
+                conn.close()
+        except Exception as e:
+            result['error'] = str(e)
+            return result
+
+    result['success'] = result['integrity'] == 'ok' and result['checksum_ok'] is not False
+    return result
+
+
+def restore_backup(name_or_path):
+    """Восстанавливает базу из бэкапа (после проверки) через backup API поверх рабочей БД"""
+    verification = verify_backup(name_or_path)
+    if not verification['success']:
+        log_error(f"Backup verification failed, restore aborted: {verification}")
+        return verification
+
+    backup_path = _resolve_backup_path(name_or_path)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        restore_path = os.path.join(tmp_dir, 'restore.db')
+        if backup_path.endswith(('.gz', '.zst')):
+            _decompress_backup(backup_path, restore_path)
+        else:
+            shutil.copyfile(backup_path, restore_path)
+        source = sqlite3.connect(restore_path)
+        target = sqlite3.connect(get_db_path())
+        try:
+            source.backup(target, pages=BACKUP_PAGES_PER_STEP, sleep=0.005)
+        finally:
+            target.close()
+            source.close()
+    log_debug(f"Database restored from backup {verification['file']}")
+    verification['restored'] = True
+    return verification
+
+# ========== Реестр задач ==========
+# Регулярные задачи описаны в CRON_TASKS: функция, интервал в секундах и ключ
+# результата с числом обработанных строк. Интервал переопределяется настройкой
+# cron_interval_<задача> (0 - задача выключена и выполняется только явно).
+# Запуск держит аренду в cron_leases, поэтому одновременные вызовы /cron/run и
+# cron_tasks.py не выполняют задачи дважды. Задачи делят бюджет
+# cron_time_budget_seconds: задача, вернувшая finished = False, и задачи, до которых
+# не дошла очередь, остаются к выполнению и продолжаются при следующем запуске.
+# История запусков - в cron_runs и cron_run_tasks (длительность и число строк).
+
+CRON_LEASE_NAME = 'cron_run'
+CRON_LEASE_SECONDS = 900
+CRON_TIME_BUDGET_SECONDS = 60
+CRON_SCHEDULE_SLACK_SECONDS = 5
+CRON_HISTORY_DAYS = 30
+
+
+def _archived_rows(result):
+    partitions = result.get('archived_partitions') or []
+    return (result.get('moved_legacy_rows') or 0) + sum(item.get('rows') or 0 for item in partitions)
+
+
+# Порядок важен: переходы этапов ставят напоминания в очередь уведомлений
+CRON_TASKS = {
+    'stage_transitions': {'func': run_stage_transitions, 'interval': 60, 'rows': 'done'},
+    'dispatch_notifications': {'func': dispatch_notifications, 'interval': 60, 'rows': 'sent'},
+    'cleanup_expired_verification_codes': {'func': cleanup_expired_verification_codes, 'interval': 600},
+    'cleanup_expired_telegram_codes': {'func': cleanup_expired_telegram_codes, 'interval': 3600},
+    'cleanup_notification_outbox': {'func': cleanup_notification_outbox, 'interval': 3600},
+    'cleanup_orphaned_letter_attachments': {'func': cleanup_orphaned_letter_attachments, 'interval': 3600},
+    'prune_archived_chats': {'func': prune_archived_chats, 'interval': 86400},
+    'normalize_legacy_text': {'func': normalize_legacy_text, 'interval': 3600},
+    'anonymize_deleted_user_logs': {'func': anonymize_deleted_user_logs, 'interval': 600},
+    'purge_inactive_users': {'func': purge_inactive_users, 'interval': 86400},
+    'cleanup_cron_history': {'func': cleanup_cron_history, 'interval': 86400, 'kwargs': {'days': CRON_HISTORY_DAYS}},
+    'cleanup_old_activity_logs': {'func': cleanup_old_activity_logs, 'interval': 0},
+    'archive_activity_logs': {'func': archive_activity_logs, 'interval': 86400, 'rows': _archived_rows, 'deadline': False},
+    'backup_database': {'func': backup_database, 'interval': 0, 'rows': None, 'deadline': False},
+}
+
+
+def _cron_timestamp(seconds=0):
+    return (datetime.utcnow() + timedelta(seconds=seconds)).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def get_cron_task_interval(name):
+    """Интервал задачи в секундах из настройки cron_interval_<задача> (0 - выключена)"""
+    default = CRON_TASKS[name]['interval']
+    try:
+        return max(int(get_setting(f'cron_interval_{name}', str(default))), 0)
+    except (TypeError, ValueError):
+        return default
+
+
+def get_cron_time_budget():
+    try:
+        return max(int(get_setting('cron_time_budget_seconds', str(CRON_TIME_BUDGET_SECONDS))), 0)
+    except (TypeError, ValueError):
+        return CRON_TIME_BUDGET_SECONDS
+
+
+def get_due_cron_tasks(conn, force=()):
+    """Задачи, которые пора выполнить, в порядке реестра.
+
+    Задача к выполнению, если ее интервал прошел с прошлого запуска или прошлый
+    запуск не завершил работу (finished = 0). Задачи из force выполняются всегда.
+    """
+    last_runs = {
+        row['task']: row
+        for row in conn.execute('''
+            SELECT t.task, t.started_at, t.finished
+            FROM cron_run_tasks t
+            JOIN (SELECT task, MAX(id) AS id FROM cron_run_tasks GROUP BY task) latest ON latest.id = t.id
         ''')
+    }
+    due = []
+    for name in CRON_TASKS:
+        if name in force:
+            due.append(name)
+            continue
+        interval = get_cron_task_interval(name)
+        if not interval:
+            continue
+        last = last_runs.get(name)
+        if (last is None or not last['finished']
+                or last['started_at'] <= _utc_cutoff(seconds=max(interval - CRON_SCHEDULE_SLACK_SECONDS, 0))):
+            due.append(name)
+    return due
+
+
+def acquire_cron_lease(holder, seconds=CRON_LEASE_SECONDS, name=CRON_LEASE_NAME):
+    """Берет или продлевает аренду. False - аренду держит другой владелец и она не истекла"""
+    conn = get_db_connection()
+    try:
+        cursor = conn.execute('''
+            INSERT INTO cron_leases (name, holder, expires_at)
+            VALUES (?, ?, ?)
+            ON CONFLICT(name) DO UPDATE SET
+                holder = excluded.holder,
+                expires_at = excluded.expires_at
+            WHERE cron_leases.holder = excluded.holder OR cron_leases.expires_at < ?
+        ''', (name, holder, _cron_timestamp(seconds), _cron_timestamp()))
         conn.commit()
-        deleted_count = result.rowcount
-        if deleted_count > 0:
-            log_debug(f"Cleaned up {deleted_count} expired verification codes")
+        return cursor.rowcount == 1
+    finally:
         conn.close()
-        return deleted_count
-    except Exception as e:
-        log_error(f"Error cleaning up expired verification codes: {e}")
-        if conn:
-            conn.close()
-        return 0
 
-def cleanup_old_activity_logs(days=90):
-    """Очищает старые логи активности (старше указанного количества дней)"""
-    conn = None
+
+def release_cron_lease(holder, name=CRON_LEASE_NAME):
+    conn = get_db_connection()
+    try:
+        conn.execute('DELETE FROM cron_leases WHERE name = ? AND holder = ?', (name, holder))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def _cron_lease_holder(run_id):
+    return f'run:{run_id}'
+
+
+def start_cron_run(trigger='cli'):
+    """Создает запись запуска и берет аренду.
+
+    Возвращает (run_id, None) или (None, id выполняющегося запуска), если аренду держит другой запуск.
+    """
+    conn = get_db_connection()
     try:
+        run_id = conn.execute("INSERT INTO cron_runs (trigger, status) VALUES (?, 'running')", (trigger,)).lastrowid
+        conn.commit()
+    finally:
+        conn.close()
+
+    if acquire_cron_lease(_cron_lease_holder(run_id)):
+        # Аренда у нас, значит остальные "running" запуски прерваны (перезапуск процесса и т.п.)
         conn = get_db_connection()
-        # Удаляем логи старше указанного количества дней
-        result = conn.execute('''
-            DELETE FROM activity_logs
-            WHERE datetime(created_at) < datetime('now', '-' || ? || ' days')
-        ''', (days,))
+        try:
+            conn.execute('''
+                UPDATE cron_run_tasks SET status = 'abandoned'
+                WHERE status = 'running' AND run_id IN (SELECT id FROM cron_runs WHERE status = 'running' AND id != ?)
+            ''', (run_id,))
+            conn.execute('''
+                UPDATE cron_runs SET status = 'abandoned', finished_at = CURRENT_TIMESTAMP
+                WHERE status = 'running' AND id != ?
+            ''', (run_id,))
+            conn.commit()
+        finally:
+            conn.close()
+        return run_id, None
+
+    conn = get_db_connection()
+    try:
+        conn.execute('DELETE FROM cron_runs WHERE id = ?', (run_id,))
         conn.commit()
-        deleted_count = result.rowcount
-        if deleted_count > 0:
-            log_debug(f"Cleaned up {deleted_count} old activity logs (older than {days} days)")
+        lease = conn.execute('SELECT holder FROM cron_leases WHERE name = ?', (CRON_LEASE_NAME,)).fetchone()
+    finally:
         conn.close()
-        return deleted_count
-    except Exception as e:
-        log_error(f"Error cleaning up old activity logs: {e}")
-        if conn:
+    active_run_id = None
+    if lease and lease['holder'].startswith('run:'):
+        active_run_id = int(lease['holder'][len('run:'):])
+    log_debug(f"Cron run skipped: run {active_run_id} is still in progress")
+    return None, active_run_id
+
+
+def _task_rows(spec, result):
+    rows = spec.get('rows', 'count')
+    if rows is None:
+        return None
+    value = rows(result) if callable(rows) else result.get(rows)
+    return value if isinstance(value, int) else None
+
+
+def _run_cron_task(run_id, name, deadline, extra_kwargs=None):
+    """Выполняет задачу реестра и записывает ее в cron_run_tasks, возвращает (результат, строки)"""
+    spec = CRON_TASKS[name]
+    kwargs = dict(spec.get('kwargs', {}), **(extra_kwargs or {}))
+    if spec.get('deadline', True):
+        kwargs['deadline'] = deadline
+
+    conn = get_db_connection()
+    try:
+        # finished = 0 до завершения: задача прерванного запуска продолжится при следующем
+        task_id = conn.execute(
+            'INSERT INTO cron_run_tasks (run_id, task, finished) VALUES (?, ?, 0)', (run_id, name)
+        ).lastrowid
+        conn.commit()
+    finally:
+        conn.close()
+
+    result = run_timed(name, spec['func'], **kwargs)
+    if result.get('result', True) is None:
+        result['success'] = False
+    rows = _task_rows(spec, result) if result['success'] else None
+    # Упавшая задача повторяется по расписанию, а не на каждом запуске
+    finished = bool(result.get('finished', True)) or not result['success']
+    if not result['success']:
+        status = 'error'
+    else:
+        status = 'ok' if finished else 'partial'
+
+    conn = get_db_connection()
+    try:
+        conn.execute('''
+            UPDATE cron_run_tasks
+            SET status = ?, duration_ms = ?, rows_count = ?, finished = ?, result = ?
+            WHERE id = ?
+        ''', (status, result['duration_ms'], rows, 1 if finished else 0,
+              json.dumps(result, ensure_ascii=False, default=str), task_id))
+        conn.commit()
+    finally:
+        conn.close()
+    return result, rows
+
+
+def execute_cron_run(run_id, force=(), task_kwargs=None, time_budget=None):
+    """Выполняет задачи запуска, созданного start_cron_run, и освобождает аренду"""
+    holder = _cron_lease_holder(run_id)
+    started = time.monotonic()
+    if time_budget is None:
+        time_budget = get_cron_time_budget()
+    deadline = started + time_budget if time_budget else None
+    task_kwargs = task_kwargs or {}
+    tasks = {}
+    deferred = []
+    total_rows = 0
+    error = None
+    log_debug(f"Cron run {run_id} started at {datetime.now()}")
+    try:
+        conn = get_db_connection()
+        try:
+            due = get_due_cron_tasks(conn, force)
+        finally:
             conn.close()
-        return 0
-
-def backup_database():
-    """Создает резервную копию базы данных"""
-    try:
-        db_path = os.path.join(project_path, 'database.db')
-        if not os.path.exists(db_path):
-            log_debug("Database file not found, skipping backup")
-            return False
-        
-        # Создаем имя файла бэкапа с датой и временем
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        backup_path = os.path.join(project_path, f'database.db.backup_{timestamp}')
-        
-        # Копируем файл базы данных
-        import shutil
-        shutil.copy2(db_path, backup_path)
-        
-        # Удаляем старые бэкапы (оставляем только последние 7)
-        backup_files = []
-        for file in os.listdir(project_path):
-            if file.startswith('database.db.backup_') and file.endswith('.backup') == False:
-                file_path = os.path.join(project_path, file)
-                if os.path.isfile(file_path):
-                    backup_files.append((os.path.getmtime(file_path), file_path))
-        
-        # Сортируем по времени модификации (новые первыми)
-        backup_files.sort(reverse=True)
-        
-        # Удаляем старые бэкапы, оставляя только последние 7
-        if len(backup_files) > 7:
-            for _, old_backup in backup_files[7:]:
-                try:
-                    os.remove(old_backup)
-                    log_debug(f"Removed old backup: {os.path.basename(old_backup)}")
-                except Exception as e:
-                    log_error(f"Error removing old backup {old_backup}: {e}")
-        
-        log_debug(f"Database backup created: {os.path.basename(backup_path)}")
-        return True
+        for index, name in enumerate(due):
+            if deadline is not None and time.monotonic() >= deadline:
+                deferred = due[index:]
+                break
+            if not acquire_cron_lease(holder):
+                error = 'Аренда запуска потеряна'
+                deferred = due[index:]
+                break
+            tasks[name], rows = _run_cron_task(run_id, name, deadline, task_kwargs.get(name))
+            total_rows += rows or 0
+            log_debug(f"Cron task {name}: {tasks[name]}")
     except Exception as e:
-        log_error(f"Error creating database backup: {e}")
-        return False
-
-def main():
-    """Основная функция для выполнения всех задач"""
-    log_debug(f"Cron tasks started at {datetime.now()}")
-    
-    # Очистка истекших кодов верификации
-    cleanup_expired_verification_codes()
-    
-    # Очистка старых логов (опционально, раскомментируйте если нужно)
-    # cleanup_old_activity_logs(days=90)
-    
-    # Резервное копирование базы данных (опционально, раскомментируйте если нужно)
-    # backup_database()
-    
-    log_debug(f"Cron tasks completed at {datetime.now()}")
+        log_error(f"Error in cron run {run_id}: {e}")
+        error = str(e)
+    finally:
+        release_cron_lease(holder)
+
+    if error or any(not result['success'] for result in tasks.values()):
+        status = 'error'
+    elif deferred or any(not result.get('finished', True) for result in tasks.values()):
+        status = 'partial'
+    else:
+        status = 'ok'
+    duration_ms = int((time.monotonic() - started) * 1000)
+    conn = get_db_connection()
+    try:
+        conn.execute('''
+            UPDATE cron_runs
+            SET status = ?, finished_at = CURRENT_TIMESTAMP, duration_ms = ?, tasks_count = ?,
+                rows_count = ?, deferred = ?, error = ?
+            WHERE id = ?
+        ''', (status, duration_ms, len(tasks), total_rows,
+              json.dumps(deferred) if deferred else None, error, run_id))
+        conn.commit()
+    finally:
+        conn.close()
+    log_debug(f"Cron run {run_id} finished: {status}, {len(tasks)} tasks, {total_rows} rows, {duration_ms} ms")
+    return {
+        'run_id': run_id,
+        'status': status,
+        'success': status != 'error',
+        'duration_ms': duration_ms,
+        'rows': total_rows,
+        'tasks': tasks,
+        'deferred': deferred,
+        'error': error,
+    }
+
+
+def skipped_cron_run(active_run_id, force=()):
+    """Результат запуска, пропущенного из-за уже идущего: задачи по расписанию
+    выполнит идущий запуск, а явно запрошенные (force) не выполнены - это ошибка"""
+    result = {'success': not force, 'skipped': True, 'run_id': active_run_id}
+    if force:
+        result['error'] = f'Cron run {active_run_id} is in progress, tasks not run: {", ".join(force)}'
+    return result
+
+
+def run_cron_tasks(trigger='cli', force=(), task_kwargs=None, time_budget=None):
+    """Выполняет задачи, которые пора выполнить, если не идет другой запуск"""
+    run_id, active_run_id = start_cron_run(trigger)
+    if run_id is None:
+        return skipped_cron_run(active_run_id, force)
+    return execute_cron_run(run_id, force, task_kwargs, time_budget)
+
+
+def get_cron_run(run_id):
+    """Запуск с его задачами или None"""
+    conn = get_db_connection()
+    try:
+        run = conn.execute('SELECT * FROM cron_runs WHERE id = ?', (run_id,)).fetchone()
+        if not run:
+            return None
+        tasks = conn.execute('''
+            SELECT task, status, started_at, duration_ms, rows_count, finished, result
+            FROM cron_run_tasks WHERE run_id = ? ORDER BY id
+        ''', (run_id,)).fetchall()
+    finally:
+        conn.close()
+    result = dict(run)
+    result['deferred'] = json.loads(run['deferred']) if run['deferred'] else []
+    result['tasks'] = []
+    for task in tasks:
+        item = dict(task)
+        item['finished'] = bool(item['finished'])
+        item['result'] = json.loads(task['result']) if task['result'] else None
+        result['tasks'].append(item)
+    return result
+
+
+def list_cron_runs(limit=20):
+    """Последние запуски (без результатов задач)"""
+    conn = get_db_connection()
+    try:
+        rows = conn.execute('SELECT * FROM cron_runs ORDER BY id DESC LIMIT ?', (limit,)).fetchall()
+    finally:
+        conn.close()
+    return [dict(row) for row in rows]
+
+def run_all(force=()):
+    """Выполняет регулярные задачи, которые пора выполнить (и задачи из force)"""
+    return run_cron_tasks('cli', force=force)
+
+def main(argv=None):
+    """Точка входа: без аргументов выполняет все задачи, иначе - команду обслуживания"""
+    parser = argparse.ArgumentParser(description='Периодические задачи и обслуживание БД')
+    subparsers = parser.add_subparsers(dest='command')
+    run_parser = subparsers.add_parser('run', help='выполнить задачи, которые пора выполнить (по умолчанию)')
+    run_parser.add_argument('--task', action='append', choices=list(CRON_TASKS), default=[],
+                            help='выполнить задачу независимо от расписания (можно несколько раз)')
+    run_parser.add_argument('--budget', type=int, help='бюджет времени в секундах (по умолчанию - настройка)')
+    runs_parser = subparsers.add_parser('runs', help='показать историю запусков')
+    runs_parser.add_argument('run_id', nargs='?', type=int, help='показать запуск с результатами задач')
+    runs_parser.add_argument('--limit', type=int, default=20)
+    backup_parser = subparsers.add_parser('backup', help='создать бэкап базы данных')
+    backup_parser.add_argument('--compression', choices=['gzip', 'zstd'])
+    subparsers.add_parser('list', help='показать список бэкапов')
+    verify_parser = subparsers.add_parser('verify', help='проверить бэкап')
+    verify_parser.add_argument('backup')
+    restore_parser = subparsers.add_parser('restore', help='восстановить базу из бэкапа')
+    restore_parser.add_argument('backup')
+    subparsers.add_parser('normalize-text', help='нормализовать текст переписки в старых записях')
+    purge_parser = subparsers.add_parser('purge-inactive', help='удалить неактивные учетные записи')
+    purge_parser.add_argument('--days', type=int, help='без входа дольше N дней (по умолчанию - настройка)')
+    purge_parser.add_argument('--limit', type=int, help='не больше N пользователей за запуск')
+    purge_parser.add_argument('--dry-run', action='store_true', help='только показать, кто будет удален')
+    subparsers.add_parser('anonymize-logs', help='обезличить журнал действий удаленных пользователей')
+    subparsers.add_parser('dispatch-notifications', help='разослать накопившиеся уведомления участникам')
+    transitions_parser = subparsers.add_parser('stage-transitions', help='выполнить наступившие переходы этапов мероприятий')
+    transitions_parser.add_argument('--watch', action='store_true', help='работать постоянно, просыпаясь к следующему переходу')
+    import_parser = subparsers.add_parser('import-participants', help='импортировать пользователей/участников из CSV')
+    import_parser.add_argument('file')
+    import_parser.add_argument('--event-id', type=int, help='добавить строки участниками мероприятия')
+    import_parser.add_argument('--batch-size', type=int, default=IMPORT_BATCH_SIZE, help='строк в одной транзакции')
+    import_parser.add_argument('--approve', action='store_true', help='сразу одобрить новых участников')
+    import_parser.add_argument('--dry-run', action='store_true', help='только проверить файл, ничего не записывать')
+    args = parser.parse_args(argv)
+
+    if args.command is None:
+        result = run_all()
+    elif args.command == 'run':
+        result = run_cron_tasks('cli', force=args.task, time_budget=args.budget)
+    elif args.command == 'runs':
+        result = get_cron_run(args.run_id) if args.run_id else list_cron_runs(args.limit)
+    elif args.command == 'backup':
+        result = backup_database(args.compression)
+    elif args.command == 'list':
+        result = list_backups()
+    elif args.command == 'verify':
+        result = verify_backup(args.backup)
+    elif args.command == 'normalize-text':
+        result = normalize_legacy_text()
+    elif args.command == 'purge-inactive':
+        result = purge_inactive_users(args.days, dry_run=args.dry_run, limit=args.limit)
+    elif args.command == 'anonymize-logs':
+        result = anonymize_deleted_user_logs()
+    elif args.command == 'dispatch-notifications':
+        result = dispatch_notifications()
+    elif args.command == 'stage-transitions':
+        if args.watch:
+            watch_stage_transitions()  # Не возвращается: процесс работает до остановки
+        else:
+            result = run_stage_transitions()
+    elif args.command == 'import-participants':
+        result = import_participants_file(
+            args.file, args.event_id, args.batch_size, dry_run=args.dry_run, approve=args.approve
+        )
+    else:
+        result = restore_backup(args.backup)
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    if result is None or (isinstance(result, dict) and not result.get('success', True)):
+        return 1
+    return 0
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
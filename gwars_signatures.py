@@ -0,0 +1,105 @@
+"""
+Проверка подписей входа через GWars (sign и sign3)
+
+GWars считает подпись как md5(пароль + имя + данные) от исходных байтов имени,
+но в разных браузерах и версиях сервера имя приходит по-разному закодированным.
+Поэтому проверяются варианты представления имени: сначала канонический
+(исходные байты из URL), остальные - только при несовпадении. Вариант, который
+подошел, запоминается для пользователя и при следующем входе пробуется первым.
+"""
+
+import hashlib
+import hmac
+import threading
+from collections import OrderedDict
+from urllib.parse import unquote_plus, unquote_to_bytes
+
+# Варианты представления имени в порядке проверки
+SIGN_VARIANTS = ('bytes', 'bytes_space', 'decoded', 'encoded', 'encoded_space', 'cp1251', 'latin1_bytes')
+SIGN3_VARIANTS = ('bytes', 'bytes_space', 'decoded')
+
+_HEX_DIGITS = frozenset('0123456789abcdef')
+
+
+def _name_variant(variant, username, encoded_name):
+    """Байты имени для варианта (None - вариант неприменим)"""
+    if variant == 'decoded':
+        return (username or '').encode('utf-8')
+    if not encoded_name:
+        return None
+    if variant.endswith('_space'):
+        if '+' not in encoded_name:
+            return None
+        encoded_name = encoded_name.replace('+', '%20')
+    if variant in ('bytes', 'bytes_space'):
+        return unquote_to_bytes(encoded_name)
+    if variant in ('encoded', 'encoded_space'):
+        return encoded_name.encode('utf-8')
+    if variant == 'cp1251':
+        return unquote_plus(encoded_name, encoding='cp1251').encode('utf-8')
+    if variant == 'latin1_bytes':
+        return unquote_plus(encoded_name, encoding='latin1').encode('latin1')
+    return None
+
+
+class SignatureVerifier:
+    """Проверяет подпись md5(secret + имя + suffix) по вариантам имени"""
+
+    __slots__ = ('secret', 'variants', 'length', 'max_remembered', '_preferred', '_lock')
+
+    def __init__(self, secret, variants=SIGN_VARIANTS, length=None, max_remembered=10000):
+        self.secret = secret.encode('utf-8')
+        self.variants = tuple(variants)
+        self.length = length
+        self.max_remembered = max_remembered
+        self._preferred = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _order(self, user_id):
+        with self._lock:
+            preferred = self._preferred.get(user_id)
+            if preferred is not None:
+                self._preferred.move_to_end(user_id)
+        if preferred is None or preferred == self.variants[0]:
+            return self.variants
+        return (preferred,) + tuple(v for v in self.variants if v != preferred)
+
+    def _remember(self, user_id, variant):
+        with self._lock:
+            self._preferred[user_id] = variant
+            self._preferred.move_to_end(user_id)
+            while len(self._preferred) > self.max_remembered:
+                self._preferred.popitem(last=False)
+
+    def verify(self, user_id, sign, username, encoded_name=None, suffix=''):
+        """Возвращает (вариант, который подошел, или None; число проверенных вариантов)"""
+        if not sign:
+            return None, 0
+        sign = str(sign).lower()
+        # Подпись - hex md5; прочее (в том числе не-ASCII, на котором падает
+        # hmac.compare_digest) сразу считаем несовпадением
+        if not _HEX_DIGITS.issuperset(sign):
+            return None, 0
+        tail = f"{user_id}{suffix}".encode('utf-8')
+        seen = set()
+        tried = 0
+        for variant in self._order(user_id):
+            try:
+                name_bytes = _name_variant(variant, username, encoded_name)
+            except (UnicodeError, ValueError):
+                name_bytes = None
+            if name_bytes is None or name_bytes in seen:
+                continue
+            seen.add(name_bytes)
+            tried += 1
+            expected = hashlib.md5(self.secret + name_bytes + tail).hexdigest()
+            if self.length:
+                expected = expected[:self.length]
+            if hmac.compare_digest(expected, sign):
+                self._remember(user_id, variant)
+                return variant, tried
+        return None, tried
+
+    def preferred_variant(self, user_id):
+        with self._lock:
+            return self._preferred.get(user_id)